@@ -0,0 +1,119 @@
+"""Synthetic icon corpus for the benchmarks.
+
+Icons are random multi-shape svgs of varying size, some wrapped in the
+metadata editors leave behind, tagged from a vocabulary where a few tags
+are far more common than the rest, with several versions each.
+"""
+import io
+import os
+import random
+import zipfile
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from icon_commons import tagindex
+from icon_commons.importer import bulk_import
+from icon_commons.importer import prepare_svg
+from icon_commons.models import Collection
+from icon_commons.models import Icon
+
+
+_editor_head = ('<svg xmlns="http://www.w3.org/2000/svg" '
+                'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" '
+                'xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" '
+                'viewBox="0 0 100 100" width="100" height="100" inkscape:version="0.92.4">\n'
+                '  <!-- Created with Inkscape (http://www.inkscape.org/) -->\n'
+                '  <defs id="defs2"><linearGradient id="unused"><stop offset="0"/></linearGradient></defs>\n'
+                '  <sodipodi:namedview id="base" pagecolor="#ffffff" inkscape:zoom="2.8"/>\n'
+                '  <metadata id="metadata5"/>\n'
+                '  <g inkscape:label="Layer 1" inkscape:groupmode="layer" id="layer1">\n')
+
+
+def icon_svg(rand, editor=None):
+    """A random icon svg, about one in three written as an editor would."""
+    if editor is None:
+        editor = rand.random() < 0.3
+    shapes = []
+    for i in range(max(1, int(rand.lognormvariate(2, 0.7)))):
+        kind = rand.random()
+        if kind < 0.7:
+            d = 'M%.6f %.6f' % (rand.uniform(0, 100), rand.uniform(0, 100))
+            d += ''.join(' C%.6f %.6f %.6f %.6f %.6f %.6f' % tuple(rand.uniform(0, 100) for _ in range(6))
+                         for _ in range(rand.randint(2, 12)))
+            shapes.append('<path style="fill:#%06x;stroke:#000000;stroke-width:0.5" d="%sZ"/>' % (
+                rand.randrange(0xffffff), d))
+        elif kind < 0.9:
+            shapes.append('<circle fill="#%06x" cx="%.3f" cy="%.3f" r="%.3f"/>' % (
+                rand.randrange(0xffffff), rand.uniform(0, 100), rand.uniform(0, 100), rand.uniform(1, 20)))
+        else:
+            shapes.append('<rect fill="none" stroke="#%06x" x="%.3f" y="%.3f" width="%.3f" height="%.3f"/>' % (
+                rand.randrange(0xffffff), rand.uniform(0, 50), rand.uniform(0, 50), rand.uniform(5, 50),
+                rand.uniform(5, 50)))
+    if editor:
+        return _editor_head + ''.join('    %s\n' % s for s in shapes) + '  </g>\n</svg>\n'
+    return '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><g>%s</g></svg>' % ''.join(shapes)
+
+
+def icon_tags(rand, vocabulary):
+    # zipf like, the first tags are on a large share of the icons
+    weights = [1.0 / (i + 1) for i in range(len(vocabulary))]
+    return sorted(set(rand.choices(vocabulary, weights, k=rand.randint(1, 4))))
+
+
+class Corpus(object):
+    """What generate wrote, for the scenarios to pick their inputs from."""
+
+    def __init__(self, collections, icons, versions, tags, seed):
+        self.params = {'collections': collections, 'icons': icons, 'versions': versions, 'tags': tags,
+                       'seed': seed}
+        self.vocabulary = ['tag-%d' % i for i in range(tags)]
+        self.ids = []
+        self.fqns = []
+        self.sample_svg = None
+        # run when the benchmark is done
+        self.cleanup = []
+
+    def rand(self, salt=''):
+        return random.Random('%s:%s' % (self.params['seed'], salt))
+
+    def zip_bytes(self, count, salt):
+        """A zip of count new icon svgs, as uploaded."""
+        rand = self.rand(salt)
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for i in range(count):
+                archive.writestr('icons/upload-%d.svg' % i, icon_svg(rand))
+        return buf.getvalue()
+
+    def write_tree(self, dirname, collections, icons, salt):
+        """Write collections directories of icons svg files to ingest."""
+        rand = self.rand(salt)
+        for c in range(collections):
+            path = os.path.join(dirname, '%s-%d' % (salt, c))
+            os.makedirs(path)
+            for i in range(icons):
+                with open(os.path.join(path, 'icon-%d.svg' % i), 'w') as fp:
+                    fp.write(icon_svg(rand))
+
+
+def generate(collections=20, icons=50, versions=2, tags=200, seed=0):
+    """Write collections x icons icons, each with versions versions, to the
+    database and return the Corpus."""
+    corpus = Corpus(collections, icons, versions, tags, seed)
+    rand = corpus.rand('corpus')
+    owner = User.objects.create_user('benchmark')
+    for c in range(collections):
+        with transaction.atomic():
+            collection = Collection.objects.create(name='collection-%d' % c)
+            names = ['icon-%d-%d' % (c, i) for i in range(icons)]
+            tagged = dict((name, icon_tags(rand, corpus.vocabulary)) for name in names)
+            for v in range(versions):
+                entries = [prepare_svg(name, icon_svg(rand), tagged[name]) for name in names]
+                bulk_import(collection, entries, owner=owner)
+    for id, collection, icon in Icon.objects.values_list('id', 'collection__slug', 'slug').order_by('id'):
+        corpus.ids.append(id)
+        corpus.fqns.append((collection, icon))
+    corpus.sample_svg = icon_svg(corpus.rand('sample'), editor=False)
+    tagindex.invalidate()
+    return corpus
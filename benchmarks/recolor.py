@@ -0,0 +1,44 @@
+"""Compare process_svg against precompiled recolor templates.
+
+Run from the repository root: python -m benchmarks.recolor [paths] [iterations]
+"""
+import random
+import sys
+import timeit
+
+from icon_commons.utils import compile_svg
+from icon_commons.utils import process_svg
+from icon_commons.utils import render_template
+
+
+def multi_path_svg(paths, seed=0):
+    rand = random.Random(seed)
+    shapes = []
+    for i in range(paths):
+        d = 'M%.4f %.4f' % (rand.uniform(0, 100), rand.uniform(0, 100))
+        d += ''.join(' L%.4f %.4f' % (rand.uniform(0, 100), rand.uniform(0, 100)) for _ in range(8))
+        if i % 3:
+            shapes.append('<path style="fill:#%06x;stroke:#000000;stroke-width:0.5" d="%sZ"/>' % (rand.randrange(0xffffff), d))
+        else:
+            shapes.append('<path fill="#%06x" d="%sZ"/>' % (rand.randrange(0xffffff), d))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><g>%s</g></svg>' % ''.join(shapes))
+
+
+def main(argv):
+    paths = int(argv[0]) if argv else 500
+    iterations = int(argv[1]) if len(argv) > 1 else 200
+    svg = multi_path_svg(paths)
+    params = {'fill': '#ff0000', 'stroke': '#00ff00'}
+    template = compile_svg(svg)
+    assert render_template(template, params) == process_svg(svg, params)
+    compile_time = timeit.timeit(lambda: compile_svg(svg), number=1)
+    baseline = timeit.timeit(lambda: process_svg(svg, params), number=iterations)
+    compiled = timeit.timeit(lambda: render_template(template, params), number=iterations)
+    print('%d paths, %d bytes, compile once %.2fms' % (paths, len(svg), compile_time * 1000))
+    print('process_svg      %8.3fms/op' % (baseline / iterations * 1000))
+    print('render_template  %8.3fms/op' % (compiled / iterations * 1000))
+    print('speedup          %8.1fx' % (baseline / compiled))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
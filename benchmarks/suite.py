@@ -0,0 +1,277 @@
+"""Timed scenarios over the hot paths, against a generated corpus.
+
+Run from the repository root:
+
+    python -m benchmarks.suite [--icons M] [--collections N] [--only name ...]
+        [--output results.json] [--baseline baseline.json]
+
+The corpus is written to a throwaway test database. Each scenario reports
+throughput, latency percentiles and queries per operation; with
+--baseline the run is compared to a stored --output and exits with status
+1 if a scenario got slower than --tolerance or runs more queries.
+"""
+from collections import OrderedDict
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+
+scenarios = OrderedDict()
+
+
+def scenario(name, iterations=200):
+    """Register a scenario. setup(corpus, client, iterations) returns the
+    operation to time, called with the iteration number."""
+    def register(setup):
+        scenarios[name] = (setup, iterations)
+        return setup
+    return register
+
+
+def get(client, path, params=None):
+    def op(i):
+        r = client.get(path(i) if callable(path) else path, params(i) if callable(params) else params)
+        if r.status_code != 200:
+            raise AssertionError('%s answered %s' % (r.request['PATH_INFO'], r.status_code))
+    return op
+
+
+@scenario('process_svg')
+def process_svg_plain(corpus, client, iterations):
+    from icon_commons.utils import process_svg
+    return lambda i: process_svg(corpus.sample_svg, {})
+
+
+@scenario('process_svg_recolor')
+def process_svg_recolor(corpus, client, iterations):
+    from icon_commons.utils import process_svg
+    params = {'fill': '#ff0000', 'stroke': '#00ff00'}
+    return lambda i: process_svg(corpus.sample_svg, params)
+
+
+@scenario('icon_by_id', 1000)
+def icon_by_id(corpus, client, iterations):
+    from django.urls import reverse
+    ids = corpus.ids
+    return get(client, lambda i: reverse('iconcommons_icon_view', kwargs={'id': ids[i * 7919 % len(ids)]}))
+
+
+@scenario('icon_by_fqn', 1000)
+def icon_by_fqn(corpus, client, iterations):
+    from django.urls import reverse
+    fqns = corpus.fqns
+    return get(client, lambda i: reverse('iconcommons_icon_by_fqn', kwargs=dict(
+        zip(('collection', 'icon'), fqns[i * 7919 % len(fqns)]))))
+
+
+@scenario('icon_list_tags')
+def icon_list_tags(corpus, client, iterations):
+    from django.urls import reverse
+    common = corpus.vocabulary[:20]
+    return get(client, reverse('iconcommons_icon_list'), lambda i: {
+        'tag': [common[i % len(common)], common[(i + 3) % len(common)]], 'facets': 10})
+
+
+@scenario('icon_list_deep_page')
+def icon_list_deep_page(corpus, client, iterations):
+    from django.urls import reverse
+    url = reverse('iconcommons_icon_list')
+    last = json.loads(client.get(url).content.decode())['pages']
+    return get(client, url, lambda i: {'page': max(1, last - i % 5), 'fields': 'tags,version'})
+
+
+@scenario('collection_list')
+def collection_list(corpus, client, iterations):
+    from django.urls import reverse
+    return get(client, reverse('iconcommons_collection_list'))
+
+
+@scenario('search_tags', 1000)
+def search_tags(corpus, client, iterations):
+    from django.urls import reverse
+    queries = ['t', 'ta', 'tag', 'tag-1', 'ag-2', 'g-10']
+    return get(client, reverse('iconcommons_search_tags'), lambda i: {'query': queries[i % len(queries)]})
+
+
+@scenario('upload_zip', 10)
+def upload_zip(corpus, client, iterations):
+    from django.contrib.auth.models import User
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+    from django.test import override_settings
+    from django.urls import reverse
+    archive = corpus.zip_bytes(50, 'upload')
+    # every upload goes to a new collection named after its user
+    clients = []
+    for n in range(iterations + warmup(iterations)):
+        c = Client()
+        c.force_login(User.objects.create_user('uploader-%d' % n))
+        clients.append(c)
+
+    def op(i):
+        with override_settings(ICON_COMMONS_UPLOAD_JOBS=None):
+            r = clients[i].post(reverse('upload'), {
+                'tags': 'a, b', 'svg': SimpleUploadedFile('icons.zip', archive, 'application/zip')})
+        if r.status_code != 200:
+            raise AssertionError('upload answered %s' % r.status_code)
+    return op
+
+
+@scenario('ingest', 3)
+def ingest(corpus, client, iterations):
+    from django.core.management import call_command
+    dirname = tempfile.mkdtemp(prefix='icon-commons-bench-')
+    corpus.cleanup.append(lambda: shutil.rmtree(dirname))
+    dirs = []
+    for n in range(iterations + warmup(iterations)):
+        path = os.path.join(dirname, str(n))
+        corpus.write_tree(path, 5, 100, 'ingest-%d' % n)
+        dirs.append(path)
+
+    def op(i):
+        call_command('ingest', dirs[i], workers=1, stdout=io.StringIO())
+    return op
+
+
+def warmup(iterations):
+    return max(1, iterations // 10)
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def run(name, corpus, client, iterations=None):
+    """Run a scenario, returning its stats. The warmup iterations count the
+    queries, the timed ones run without counting."""
+    from django.db import connection
+    setup, default = scenarios[name]
+    iterations = iterations or default
+    op = setup(corpus, client, iterations)
+    warm = warmup(iterations)
+    queries = []
+
+    def count(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+    with connection.execute_wrapper(count):
+        for i in range(warm):
+            op(i)
+    latencies = []
+    for i in range(warm, warm + iterations):
+        t = time.perf_counter()
+        op(i)
+        latencies.append(time.perf_counter() - t)
+    ordered = sorted(latencies)
+    return OrderedDict([
+        ('iterations', iterations),
+        ('ops_per_sec', iterations / sum(latencies)),
+        ('mean_ms', sum(latencies) / iterations * 1000),
+        ('p50_ms', percentile(ordered, 50) * 1000),
+        ('p90_ms', percentile(ordered, 90) * 1000),
+        ('p99_ms', percentile(ordered, 99) * 1000),
+        ('max_ms', ordered[-1] * 1000),
+        ('queries', len(queries) / float(warm)),
+    ])
+
+
+def compare(results, baseline, tolerance):
+    """Return (lines, regressions) comparing scenarios present in both."""
+    lines, regressions = [], []
+    for name, stats in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            lines.append('%-22s new' % name)
+            continue
+        ratio = stats['p50_ms'] / base['p50_ms'] if base['p50_ms'] else 1.0
+        slower = ratio > 1 + tolerance
+        more_queries = stats['queries'] > base['queries']
+        lines.append('%-22s p50 %8.3fms -> %8.3fms (%+.0f%%), queries %.1f -> %.1f%s' % (
+            name, base['p50_ms'], stats['p50_ms'], (ratio - 1) * 100, base['queries'], stats['queries'],
+            '  REGRESSION' if slower or more_queries else ''))
+        if slower or more_queries:
+            regressions.append(name)
+    return lines, regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the icon commons hot paths')
+    parser.add_argument('--collections', type=int, default=20)
+    parser.add_argument('--icons', type=int, default=50, help='icons per collection')
+    parser.add_argument('--versions', type=int, default=2)
+    parser.add_argument('--tags', type=int, default=200, help='size of the tag vocabulary')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, help='override the iterations of every scenario')
+    parser.add_argument('--only', nargs='+', choices=list(scenarios), help='scenarios to run')
+    parser.add_argument('-o', '--output', help='write the results as JSON, - for stdout')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='p50 slowdown accepted before a scenario counts as a regression')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test.test_settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    from django.test.utils import teardown_test_environment
+    from benchmarks.corpus import generate
+
+    setup_test_environment(debug=False)
+    if getattr(settings, 'ICON_COMMONS_TAG_INDEX_CACHE', None) is None:
+        # a single process, its local memory cache is shared by all there is
+        settings.ICON_COMMONS_TAG_INDEX_CACHE = 'default'
+    old_name = connection.creation.create_test_db(verbosity=0)
+    corpus = None
+    try:
+        t = time.perf_counter()
+        corpus = generate(args.collections, args.icons, args.versions, args.tags, args.seed)
+        sys.stderr.write('corpus of %s icons generated in %.1fs\n' % (len(corpus.ids), time.perf_counter() - t))
+        results = OrderedDict([
+            ('corpus', corpus.params),
+            ('environment', OrderedDict([
+                ('python', platform.python_version()),
+                ('django', django.get_version()),
+                ('database', '%s %s' % (connection.vendor, connection.Database.sqlite_version
+                                        if connection.vendor == 'sqlite' else '')),
+            ])),
+            ('scenarios', OrderedDict()),
+        ])
+        client = Client()
+        for name in args.only or scenarios:
+            stats = results['scenarios'][name] = run(name, corpus, client, args.iterations)
+            sys.stderr.write('%-22s %9.1f ops/s  p50 %8.3fms  p90 %8.3fms  p99 %8.3fms  %5.1f queries\n' % (
+                name, stats['ops_per_sec'], stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['queries']))
+    finally:
+        if corpus is not None:
+            for cleanup in corpus.cleanup:
+                cleanup()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+    if args.output:
+        data = json.dumps(results, indent=2) + '\n'
+        if args.output == '-':
+            sys.stdout.write(data)
+        else:
+            with open(args.output, 'w') as fp:
+                fp.write(data)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            lines, regressions = compare(results, json.load(fp), args.tolerance)
+        sys.stderr.write('\n'.join(lines) + '\n')
+        if regressions:
+            sys.stderr.write('%s regressed: %s\n' % (len(regressions), ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1 @@
+default_app_config = 'icon_commons.apps.IconCommonsConfig'
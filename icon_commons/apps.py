@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class IconCommonsConfig(AppConfig):
+    name = 'icon_commons'
+
+    def ready(self):
+        # connects the tag index, icon counter and resolver signal handlers
+        from icon_commons import counters  # noqa
+        from icon_commons import resolver  # noqa
+        from icon_commons import tagindex  # noqa
@@ -0,0 +1,207 @@
+from collections import OrderedDict
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from icon_commons.metrics import phase
+from icon_commons.utils import compress_svg
+from icon_commons.utils import recolor_params
+
+
+# default in-process budget for rendered (recolored) svg output
+_default_max_bytes = 16 * 1024 * 1024
+
+
+def _size(value):
+    # values are byte strings or dicts of encoded byte strings
+    if isinstance(value, dict):
+        return sum(len(v) for v in value.values() if v is not None)
+    return len(value)
+
+
+class LocalRenderCache(object):
+    """In-process LRU of rendered svg bytes bounded by total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._icons = {}
+        self._lock = threading.Lock()
+
+    def get(self, icon_id, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, icon_id, key, value):
+        if _size(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (icon_id, value)
+            self._icons.setdefault(icon_id, set()).add(key)
+            self.size += _size(value)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def invalidate(self, icon_id):
+        with self._lock:
+            for key in list(self._icons.get(icon_id, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._icons.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'backend': 'local',
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            icon_id, value = entry
+            self.size -= _size(value)
+            keys = self._icons.get(icon_id)
+            keys.discard(key)
+            if not keys:
+                del self._icons[icon_id]
+
+
+class DjangoRenderCache(object):
+    """Render cache stored in a configured Django cache alias.
+
+    Size and eviction are left to the backend. Invalidation bumps a
+    per-icon generation that is folded into every key.
+    """
+
+    def __init__(self, alias, max_bytes):
+        self.alias = alias
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _generation_key(self, icon_id):
+        return 'icon_commons:render-gen:%s' % icon_id
+
+    def _key(self, icon_id, key):
+        generation = self.cache.get(self._generation_key(icon_id), 0)
+        # the recolor params are raw request values, hashed so any backend
+        # (memcached refuses spaces and long keys) accepts the key
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return 'icon_commons:render:%s:%s:%s' % (icon_id, generation, digest)
+
+    def get(self, icon_id, key):
+        value = self.cache.get(self._key(icon_id, key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, icon_id, key, value):
+        if _size(value) > self.max_bytes:
+            return
+        self.cache.set(self._key(icon_id, key), value)
+
+    def invalidate(self, icon_id):
+        gen_key = self._generation_key(icon_id)
+        try:
+            self.cache.incr(gen_key)
+        except ValueError:
+            self.cache.set(gen_key, 1, None)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return {
+            'backend': self.alias,
+            'hits': self.hits,
+            'misses': self.misses,
+            'max_bytes': self.max_bytes,
+        }
+
+
+_render_cache = None
+
+
+def get_render_cache():
+    """Return the configured render cache, or None if it is disabled.
+
+    ICON_COMMONS_RENDER_CACHE_BYTES bounds the cache (0 disables it) and
+    ICON_COMMONS_RENDER_CACHE_ALIAS selects a Django cache instead of the
+    in-process LRU.
+    """
+    global _render_cache
+    if _render_cache is None:
+        max_bytes = getattr(settings, 'ICON_COMMONS_RENDER_CACHE_BYTES', _default_max_bytes)
+        if not max_bytes:
+            return None
+        alias = getattr(settings, 'ICON_COMMONS_RENDER_CACHE_ALIAS', None)
+        if alias:
+            _render_cache = DjangoRenderCache(alias, max_bytes)
+        else:
+            _render_cache = LocalRenderCache(max_bytes)
+    return _render_cache
+
+
+@receiver(setting_changed)
+def _reset_render_cache(setting, **kwargs):
+    global _render_cache
+    if setting.startswith('ICON_COMMONS_RENDER_CACHE'):
+        _render_cache = None
+
+
+def invalidate_icon(icon_id):
+    cache = get_render_cache()
+    if cache is not None:
+        cache.invalidate(icon_id)
+
+
+def render_svg(icon_data, params):
+    """Recolor the svg of icon_data, consulting the render cache.
+
+    Returns a tuple of the svg bytes by content encoding (see
+    utils.compress_svg) and whether it came from the cache.
+    """
+    cache = get_render_cache()
+    key = (icon_data.id, icon_data.version) + recolor_params(params)
+    if cache is not None:
+        variants = cache.get(icon_data.icon_id, key)
+        if variants is not None:
+            return variants, True
+    with phase('svg'):
+        svg = icon_data.render(params)
+        variants = dict(compress_svg(svg, best=False), identity=svg)
+    if cache is not None:
+        cache.set(icon_data.icon_id, key, variants)
+    return variants, False
@@ -0,0 +1,61 @@
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import OuterRef
+from django.db.models import Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from icon_commons.models import Collection
+from icon_commons.models import Icon
+
+
+def icons_added(collection_id, count=1, using=None):
+    """Add count to the icon_count of a collection, negative for removals.
+
+    Code creating or deleting Icon rows without signals (bulk_create,
+    queryset update) has to call this, see importer.bulk_import.
+    """
+    if count:
+        Collection.objects.using(using).filter(id=collection_id).update(
+            icon_count=F('icon_count') + count, modified=timezone.now())
+
+
+def recount(using=None):
+    """Set every icon_count that drifted from the icons in the collection,
+    returning the number of collections fixed."""
+    counts = Icon.objects.using(using).filter(collection=OuterRef('id')).order_by().values(
+        'collection').annotate(count=Count('id')).values('count')
+    actual = Coalesce(Subquery(counts), 0)
+    drifted = Collection.objects.using(using).annotate(actual=actual).exclude(icon_count=F('actual'))
+    fixed = 0
+    for id, count in drifted.values_list('id', 'actual'):
+        Collection.objects.using(using).filter(id=id).update(icon_count=count, modified=timezone.now())
+        fixed += 1
+    return fixed
+
+
+@receiver(pre_save, sender=Icon)
+def _icon_saving(sender, instance, update_fields, using, **kwargs):
+    instance._moved_from = None
+    if instance.pk and (update_fields is None or 'collection' in update_fields):
+        old = Icon.objects.using(using).filter(pk=instance.pk).values_list('collection_id', flat=True).first()
+        if old is not None and old != instance.collection_id:
+            instance._moved_from = old
+
+
+@receiver(post_save, sender=Icon)
+def _icon_saved(sender, instance, created, using, **kwargs):
+    if created:
+        icons_added(instance.collection_id, using=using)
+    elif getattr(instance, '_moved_from', None) is not None:
+        icons_added(instance._moved_from, -1, using=using)
+        icons_added(instance.collection_id, using=using)
+
+
+@receiver(post_delete, sender=Icon)
+def _icon_deleted(sender, instance, using, **kwargs):
+    icons_added(instance.collection_id, -1, using=using)
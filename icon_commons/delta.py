@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from difflib import SequenceMatcher
+import json
+import re
+import threading
+import zlib
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+# numbers and names, whitespace and single characters, so a moved path
+# point costs a token or two of the delta, not the whole element
+_token = re.compile(r'[^\s<>"=/]+|\s+|.', re.S)
+
+# default number of reconstructed versions kept in process
+_default_cache_size = 128
+
+
+def tokenize(svg):
+    return _token.findall(svg)
+
+
+def encode(base, svg):
+    """The delta turning base into svg: zlib compressed JSON of token
+    ranges of base to copy, as [start, end], and strings to insert."""
+    a, b = tokenize(base), tokenize(svg)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 < j2:
+            text = ''.join(b[j1:j2])
+            if ops and not isinstance(ops[-1], list):
+                ops[-1] += text
+            else:
+                ops.append(text)
+    return zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf-8'), 9)
+
+
+def apply(base, delta):
+    """The svg delta (see encode) was computed for, from base."""
+    tokens = tokenize(base)
+    ops = json.loads(zlib.decompress(bytes(delta)).decode('utf-8'))
+    return ''.join(''.join(tokens[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+
+def enabled():
+    """Whether versions replaced as current are stored as deltas,
+    ICON_COMMONS_DELTA_HISTORY."""
+    return getattr(settings, 'ICON_COMMONS_DELTA_HISTORY', False)
+
+
+def keyframe_interval():
+    """Every ICON_COMMONS_DELTA_KEYFRAME-th version stays stored in full,
+    bounding the deltas applied to reconstruct any version."""
+    return max(1, getattr(settings, 'ICON_COMMONS_DELTA_KEYFRAME', 10))
+
+
+def is_keyframe(version, interval=None):
+    return version % (interval or keyframe_interval()) == 0
+
+
+class VersionCache(object):
+    """In-process LRU of reconstructed svg by IconData id and sha256, and
+    of their served encodings."""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            svg = self._entries.get(key, None)
+            if svg is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return svg
+
+    def set(self, key, svg):
+        with self._lock:
+            self._entries[key] = svg
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_version_cache = None
+
+
+def get_version_cache():
+    """Return the reconstructed version cache, None if
+    ICON_COMMONS_DELTA_CACHE_SIZE is 0."""
+    global _version_cache
+    if _version_cache is None:
+        size = getattr(settings, 'ICON_COMMONS_DELTA_CACHE_SIZE', _default_cache_size)
+        if not size:
+            return None
+        _version_cache = VersionCache(size)
+    return _version_cache
+
+
+@receiver(setting_changed)
+def _reset_version_cache(setting, **kwargs):
+    global _version_cache
+    if setting == 'ICON_COMMONS_DELTA_CACHE_SIZE':
+        _version_cache = None
@@ -0,0 +1,145 @@
+from itertools import islice
+import json
+import zipfile
+
+from datetime import datetime
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.dateparse import parse_datetime
+
+from icon_commons.models import IconData
+from icon_commons.serializers import href_template
+from icon_commons.serializers import tags_by_icon
+
+
+# rows fetched per database round trip, also the batch tags are loaded for
+_chunk_size = 500
+
+_columns = ('icon_id', 'icon__name', 'icon__slug', 'icon__collection_id', 'icon__collection__name',
+            'icon__collection__slug', 'version', 'modified', 'icon__modified', 'sha256', 'blob__svg')
+
+
+def current_versions(collection=None, since=None, gzip=False):
+    """Iterate over the current version of every icon as dicts, ordered by
+    icon id, without holding more than a chunk of rows in memory. modified
+    is the later of the icon's and the version's.
+
+    collection is a Collection id or name, since limits the export to icons
+    modified at or after that datetime. gzip adds the stored gzip encoding
+    of the svg, None if there is none.
+    """
+    query = IconData.objects.filter(icon__current=F('id'))
+    if collection is not None:
+        if str(collection).isdigit():
+            query = query.filter(icon__collection_id=collection)
+        else:
+            query = query.filter(icon__collection__name=collection)
+    if since is not None:
+        query = query.filter(icon__modified__gte=since)
+    columns = _columns + ('blob__gzip',) if gzip else _columns
+    rows = query.order_by('icon_id').values_list(*columns).iterator(chunk_size=_chunk_size)
+    href = href_template('iconcommons_icon_view', 'id')
+    while True:
+        chunk = list(islice(rows, _chunk_size))
+        if not chunk:
+            return
+        tags = tags_by_icon([r[0] for r in chunk])
+        for row in chunk:
+            id, name, slug, collection_id, collection_name, collection_slug, version, modified, icon_modified, \
+                sha256, svg = row[:11]
+            icon = {
+                'id': id,
+                'name': name,
+                'slug': slug,
+                'collection': {'id': collection_id, 'name': collection_name, 'slug': collection_slug},
+                'version': version,
+                'modified': max(modified, icon_modified),
+                'sha256': sha256,
+                'tags': tags[id],
+                'href': href % id,
+                'svg': svg,
+            }
+            if gzip:
+                icon['gzip'] = row[11]
+            yield icon
+
+
+def ndjson(icons):
+    """Encode icons as newline delimited JSON, one bytes line per icon."""
+    for icon in icons:
+        icon = dict(icon, modified=icon['modified'].isoformat())
+        yield json.dumps(icon).encode('utf-8') + b'\n'
+
+
+def zip_path(icon, used=None):
+    """The member name of an icon, collection/icon.svg. Names already in
+    used (lower cased, for case insensitive file systems) get the icon id
+    appended, the name is added to it."""
+    def clean(name):
+        return name.replace('/', '_').replace('\\', '_').lstrip('.') or '_'
+    name = icon['name']
+    if name.lower().endswith('.svg'):
+        name = name[:-4]
+    path = '%s/%s.svg' % (clean(icon['collection']['name']), clean(name))
+    if used is not None:
+        if path.lower() in used:
+            path = '%s-%s.svg' % (path[:-4], icon['id'])
+        used.add(path.lower())
+    return path
+
+
+class _Sink(object):
+    # a write only, unseekable file collecting what ZipFile writes
+    def __init__(self):
+        self.data = []
+
+    def write(self, b):
+        self.data.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.data)
+        self.data = []
+        return data
+
+
+def zipped(icons):
+    """Encode icons as a zip of collection/icon.svg, yielding the archive
+    in pieces as each member is written."""
+    sink = _Sink()
+    used = set()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for icon in icons:
+            # zip timestamps can't predate 1980
+            date_time = max(icon['modified'].timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+            info = zipfile.ZipInfo(zip_path(icon, used), date_time=date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, icon['svg'].encode('utf-8'))
+            yield sink.take()
+    yield sink.take()
+
+
+def parse_since(value):
+    """Parse an ISO 8601 datetime or date, None if it is neither."""
+    try:
+        since = parse_datetime(value)
+        if since is None:
+            date = parse_date(value)
+            since = date and datetime(date.year, date.month, date.day)
+    except ValueError:
+        return None
+    if since is not None and settings.USE_TZ and timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.utc)
+    return since
+
+
+# encoder, content type and file extension by format name
+formats = {
+    'ndjson': (ndjson, 'application/x-ndjson', 'ndjson'),
+    'zip': (zipped, 'application/zip', 'zip'),
+}
@@ -0,0 +1,241 @@
+from collections import defaultdict
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import islice
+import os
+import time
+import zipfile
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db import router
+from django.template.defaultfilters import slugify
+from django.utils import timezone
+from lxml import etree
+from taggit.models import Tag
+from taggit.models import TaggedItem
+
+from icon_commons import delta as deltas
+from icon_commons.cache import invalidate_icon
+from icon_commons.counters import icons_added
+from icon_commons.models import Icon
+from icon_commons.models import IconData
+from icon_commons.models import SVGBlob
+from icon_commons.optimize import optimize_svg
+from icon_commons import resolver
+from icon_commons.tagindex import index_changed
+from icon_commons.utils import compile_svg
+from icon_commons.utils import compress_svg
+from icon_commons.utils import svg_hash
+
+
+# an svg ready to be written by bulk_import. sha256, template, gzip and br
+# are the derived SVGBlob fields, computed up front so it can happen off the
+# main process. svg is optimized, original is the svg as read if that
+# changed it.
+SVGEntry = namedtuple('SVGEntry', 'name svg sha256 template gzip br tags original')
+
+
+class Timings(object):
+    """Accumulates wall clock time per named phase."""
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.time() - t
+
+    def summary(self):
+        return ', '.join('%s %.3fs' % kv for kv in self.phases.items())
+
+
+def prepare_svg(name, data, tags=()):
+    """Decode, validate and precompute the stored fields of an svg.
+
+    Raises ValueError if data isn't a well formed svg document.
+    """
+    try:
+        original = data.decode('utf-8-sig') if isinstance(data, bytes) else data
+        etree.fromstring(original.encode('utf-8'))
+    except (UnicodeDecodeError, etree.XMLSyntaxError) as e:
+        raise ValueError('%s: %s' % (name, e))
+    svg = optimize_svg(original)
+    encoded = compress_svg(svg)
+    return SVGEntry(name, svg, svg_hash(svg), compile_svg(svg), encoded['gzip'], encoded['br'], list(tags),
+                    original if svg != original else None)
+
+
+def chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_zip(fileobj, max_members=None, max_bytes=None):
+    """Open a zip file and list its svg members.
+
+    The limits default to ICON_COMMONS_UPLOAD_MAX_MEMBERS and
+    ICON_COMMONS_UPLOAD_MAX_BYTES (total uncompressed size) and raise
+    ValueError before anything is decompressed.
+    """
+    if max_members is None:
+        max_members = getattr(settings, 'ICON_COMMONS_UPLOAD_MAX_MEMBERS', 5000)
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'ICON_COMMONS_UPLOAD_MAX_BYTES', 50 * 1024 * 1024)
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipfile as e:
+        raise ValueError('Invalid zip file: %s' % e)
+    members = [m for m in archive.infolist()
+               if not m.is_dir() and os.path.splitext(m.filename)[1].lower() == '.svg']
+    if len(members) > max_members:
+        raise ValueError('Too many icons in zip file, the limit is %s' % max_members)
+    if sum(m.file_size for m in members) > max_bytes:
+        raise ValueError('Zip file is too large, the limit is %s bytes uncompressed' % max_bytes)
+    return archive, members
+
+
+def read_members(archive, members, tags=()):
+    """Yield an (SVGEntry, None) or (None, error) for each zip member."""
+    for m in members:
+        name = os.path.splitext(os.path.basename(m.filename))[0]
+        try:
+            yield prepare_svg(m.filename, archive.read(m), tags)._replace(name=name), None
+        except (ValueError, zipfile.BadZipfile) as e:
+            yield None, str(e)
+
+
+def read_zip(fileobj, tags=(), max_members=None, max_bytes=None):
+    """Read the svg members of a zip file, see open_zip for the limits.
+
+    Returns the SVGEntry items and a list of errors for members that aren't
+    valid svg.
+    """
+    archive, members = open_zip(fileobj, max_members, max_bytes)
+    results = list(read_members(archive, members, tags))
+    return [e for e, error in results if e], [error for e, error in results if error]
+
+
+def get_tags(names, cache=None):
+    """Return Tag objects for names, creating the missing ones."""
+    cache = {} if cache is None else cache
+    missing = set(names).difference(cache)
+    if missing:
+        for tag in Tag.objects.filter(name__in=missing):
+            cache[tag.name] = tag
+        for name in missing.difference(cache):
+            cache[name] = Tag.objects.create(name=name)
+    return [cache[n] for n in names]
+
+
+def unchanged(current, entry):
+    """Whether entry holds the svg current was stored from. Versions stored
+    before optimize_svg (or with other settings) match the file as read."""
+    read = svg_hash(entry.original) if entry.original is not None else entry.sha256
+    return entry.sha256 == current.sha256 or read in (current.sha256, current.original_id)
+
+
+def locked_icons(collection, names):
+    """The icons of collection named in names with their current version,
+    locking the icon rows. Only the icon rows: the outer joined current
+    version can not be locked on PostgreSQL."""
+    of = ('self',) if connections[router.db_for_write(Icon)].features.has_select_for_update_of else ()
+    return Icon.objects.select_for_update(of=of).filter(collection=collection, name__in=names).select_related(
+        'current').only('id', 'name', 'current_version', 'current__sha256', 'current__original')
+
+
+def bulk_import(collection, entries, owner=None, timings=None, tag_cache=None):
+    """Create or update the icons of one collection from SVGEntry items.
+
+    New icons get an 'initial import' version, icons whose svg hash changed
+    get an 'automatic update'. Rows are written with bulk queries; callers
+    are expected to wrap this in a transaction.
+    Returns a dict of created, updated and unchanged counts and a dict of
+    the imported icons by name.
+    """
+    timings = timings or Timings()
+    entries = list(dict((e.name, e) for e in entries).values())
+    with timings.phase('icons'):
+        icons = dict((i.name, i) for i in locked_icons(collection, [e.name for e in entries]))
+        new = [e.name for e in entries if e.name not in icons]
+        if new:
+            Icon.objects.bulk_create([Icon(name=n, slug=slugify(n), collection=collection, owner=owner)
+                                      for n in new])
+            icons.update((i.name, i) for i in Icon.objects.filter(
+                collection=collection, name__in=new).only('id', 'name', 'current_version'))
+            index_changed(icons=[(icons[n].id, n, collection.id) for n in new])
+            icons_added(collection.id, len(new))
+    created = set(new)
+    with timings.phase('versions'):
+        versions = []
+        for e in entries:
+            icon = icons[e.name]
+            if e.name not in created and icon.current_id and unchanged(icon.current, e):
+                continue
+            versions.append((e, IconData(icon=icon, blob_id=e.sha256, sha256=e.sha256,
+                                         original_id=svg_hash(e.original) if e.original is not None else None,
+                                         version=icon.current_version + 1,
+                                         change_log='initial import' if e.name in created else 'automatic update')))
+        if versions:
+            # identical content is stored once, only send the new bodies
+            blobs = dict((e.sha256, e) for e, d in versions)
+            originals = dict((d.original_id, e.original) for e, d in versions if d.original_id is not None)
+            existing = set(SVGBlob.objects.filter(sha256__in=set(blobs).union(originals)).values_list(
+                'sha256', flat=True))
+            blobs = [e for h, e in blobs.items() if h not in existing]
+            SVGBlob.objects.bulk_create([SVGBlob(sha256=e.sha256, svg=e.svg, template=e.template,
+                                                 size=len(e.svg.encode('utf-8')), gzip=e.gzip, brotli=e.br)
+                                         for e in blobs], ignore_conflicts=True)
+            # kept for audit only, without the served encodings
+            SVGBlob.objects.bulk_create([SVGBlob(sha256=h, svg=svg, size=len(svg.encode('utf-8')))
+                                         for h, svg in originals.items() if h not in existing], ignore_conflicts=True)
+            # the current versions being replaced, with the svg replacing them
+            replaced = dict((d.icon.current_id, e.svg) for e, d in versions
+                            if e.name not in created and d.icon.current_id is not None) if deltas.enabled() else {}
+            versions = [d for e, d in versions]
+            IconData.objects.bulk_create(versions)
+            written = IconData.objects.filter(icon__in=[d.icon for d in versions]).filter(
+                version__in=set(d.version for d in versions)).values_list('icon_id', 'version', 'id')
+            written = dict(((icon_id, version), id) for icon_id, version, id in written)
+            now = timezone.now()
+            updated = []
+            for d in versions:
+                icon = d.icon
+                icon.current_id = written[(icon.id, d.version)]
+                icon.current_version = d.version
+                icon.modified = now
+                updated.append(icon)
+            Icon.objects.bulk_update(updated, ['current', 'current_version', 'modified'])
+            if replaced:
+                IconData.demote(replaced)
+            for icon in updated:
+                invalidate_icon(icon.id)
+            resolver.invalidate()
+    with timings.phase('tags'):
+        content_type = ContentType.objects.get_for_model(Icon)
+        wanted = set()
+        for e in entries:
+            for tag in get_tags(e.tags, tag_cache):
+                wanted.add((tag.id, icons[e.name].id))
+        if wanted:
+            existing = set(TaggedItem.objects.filter(
+                content_type=content_type, object_id__in=set(i for t, i in wanted)).values_list('tag_id', 'object_id'))
+            added = wanted - existing
+            TaggedItem.objects.bulk_create([TaggedItem(tag_id=t, object_id=i, content_type=content_type)
+                                            for t, i in added])
+            index_changed(added=added)
+    counts = {
+        'created': len(created),
+        'updated': len(versions) - len(created),
+        'unchanged': len(entries) - len(versions),
+    }
+    return counts, icons
@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+
+from icon_commons.importer import bulk_import
+from icon_commons.importer import chunks
+from icon_commons.importer import open_zip
+from icon_commons.importer import read_members
+from icon_commons.models import Collection
+from icon_commons.models import UploadJob
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def job_mode():
+    """How zip uploads are imported, from ICON_COMMONS_UPLOAD_JOBS.
+
+    'thread' (the default) runs jobs in an in-process thread pool sized by
+    ICON_COMMONS_UPLOAD_JOB_THREADS, 'worker' leaves them queued for the
+    process_upload_jobs command and None imports within the request.
+    """
+    return getattr(settings, 'ICON_COMMONS_UPLOAD_JOBS', 'thread')
+
+
+def enqueue(owner, upload, tags):
+    """Queue a zip upload for import and return the UploadJob.
+
+    Raises ValueError, before anything is stored, if the upload isn't a zip
+    or exceeds the limits of open_zip.
+    """
+    open_zip(upload)
+    job = UploadJob.objects.create(owner=owner, name=upload.name, tags=json.dumps(list(tags)),
+                                   archive=b''.join(upload.chunks()))
+    if job_mode() == 'thread':
+        # along with the jobs a restart left behind
+        ids = [job.id] + requeue_stale()
+        transaction.on_commit(lambda: [_submit(id) for id in ids])
+    return job
+
+
+def _submit(job_id):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(getattr(settings, 'ICON_COMMONS_UPLOAD_JOB_THREADS', 1))
+    _executor.submit(_run_in_thread, job_id)
+
+
+def _run_in_thread(job_id):
+    try:
+        run_job(job_id)
+    except Exception:
+        logger.exception('upload job %s failed', job_id)
+    finally:
+        connection.close()
+
+
+def claim(job_id):
+    # only one runner may move a job out of the queue
+    return UploadJob.objects.filter(id=job_id, status=UploadJob.QUEUED).update(
+        status=UploadJob.RUNNING, heartbeat=timezone.now()) == 1
+
+
+def requeue_stale(timeout=None):
+    """Queue again the running jobs that haven't recorded progress for
+    timeout seconds (ICON_COMMONS_UPLOAD_JOB_TIMEOUT), their runner was
+    stopped. They start over, the icons already imported are unchanged.
+    Returns their ids."""
+    if timeout is None:
+        timeout = getattr(settings, 'ICON_COMMONS_UPLOAD_JOB_TIMEOUT', 600)
+    stale = UploadJob.objects.filter(Q(heartbeat__lt=timezone.now() - timedelta(seconds=timeout)) |
+                                     Q(heartbeat__isnull=True), status=UploadJob.RUNNING)
+    ids = list(stale.values_list('id', flat=True))
+    if ids:
+        stale.filter(id__in=ids).update(status=UploadJob.QUEUED, total=0, processed=0, failed=0, errors='[]')
+    return ids
+
+
+def run_job(job_id, batch_size=100):
+    """Import a queued job, recording progress after every batch.
+
+    Returns False if the job was already claimed by another runner.
+    """
+    if not claim(job_id):
+        return False
+    job = UploadJob.objects.select_related('owner').get(id=job_id)
+    try:
+        _import(job, batch_size)
+    except Exception as e:
+        _finish(job, UploadJob.FAILED, [str(e)])
+        raise
+    return True
+
+
+def _import(job, batch_size):
+    tags = json.loads(job.tags)
+    errors = []
+    try:
+        archive, members = open_zip(BytesIO(job.archive))
+    except ValueError as e:
+        _finish(job, UploadJob.FAILED, [str(e)])
+        return
+    UploadJob.objects.filter(id=job.id).update(total=len(members))
+    collection, created = Collection.objects.get_or_create(name=job.owner.get_username())
+    tag_cache = {}
+    for batch in chunks(read_members(archive, members, tags), batch_size):
+        entries = [e for e, error in batch if e]
+        failed = [error for e, error in batch if error]
+        try:
+            with transaction.atomic():
+                bulk_import(collection, entries, owner=job.owner, tag_cache=tag_cache)
+        except Exception as e:
+            # keep going, a bad batch shouldn't fail the files after it
+            tag_cache.clear()
+            failed.extend('%s: %s' % (entry.name, e) for entry in entries)
+            entries = []
+        errors.extend(failed)
+        UploadJob.objects.filter(id=job.id).update(processed=F('processed') + len(entries),
+                                                   failed=F('failed') + len(failed),
+                                                   errors=json.dumps(errors), heartbeat=timezone.now())
+    _finish(job, UploadJob.DONE, errors)
+
+
+def _finish(job, status, errors):
+    UploadJob.objects.filter(id=job.id).update(status=status, errors=json.dumps(errors), archive=None,
+                                               finished=timezone.now())
+
+
+def run_queued(limit=None):
+    """Run queued jobs oldest first, and the stale ones (see
+    requeue_stale), returns the number run. A failing job is logged and
+    marked failed, the others still run."""
+    requeue_stale()
+    count = 0
+    while limit is None or count < limit:
+        job_id = UploadJob.objects.filter(status=UploadJob.QUEUED).order_by('id').values_list(
+            'id', flat=True).first()
+        if job_id is None:
+            break
+        try:
+            ran = run_job(job_id)
+        except Exception as e:
+            logger.exception('upload job %s failed', job_id)
+            UploadJob.objects.filter(id=job_id, status=UploadJob.RUNNING).update(
+                status=UploadJob.FAILED, errors=json.dumps([str(e)]), archive=None, finished=timezone.now())
+            ran = True
+        if ran:
+            count += 1
+    return count
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.db.models import Sum
+from icon_commons.models import IconData
+from icon_commons.models import SVGBlob
+
+
+def blob_report():
+    """Compare the bytes referenced by every version with the bytes stored."""
+    versions = IconData.objects.filter(blob__isnull=False).aggregate(count=Count('id'), bytes=Sum('blob__size'))
+    blobs = SVGBlob.objects.aggregate(count=Count('sha256'), bytes=Sum('size'))
+    referenced = versions['bytes'] or 0
+    stored = blobs['bytes'] or 0
+    return {
+        'versions': versions['count'],
+        'blobs': blobs['count'],
+        'referenced_bytes': referenced,
+        'stored_bytes': stored,
+        'reclaimed_bytes': referenced - stored,
+        'orphans': SVGBlob.objects.filter(icondata__isnull=True, originals__isnull=True).count(),
+        'deltas': IconData.objects.filter(blob__isnull=True, delta__isnull=False).count(),
+    }
+
+
+class Command(BaseCommand):
+
+    help = 'Report the space saved by storing identical svg content once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete blobs no version references')
+
+    def handle(self, *args, **options):
+        if options['prune']:
+            pruned = SVGBlob.prune()
+            self.stdout.write('pruned %s unreferenced blobs' % pruned)
+        report = blob_report()
+        self.stdout.write('%(versions)s versions share %(blobs)s blobs (%(orphans)s unreferenced), '
+                          '%(deltas)s versions stored as deltas' % report)
+        self.stdout.write('%(referenced_bytes)s bytes referenced, %(stored_bytes)s bytes stored, '
+                          '%(reclaimed_bytes)s bytes reclaimed' % report)
@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+from icon_commons import delta as deltas
+from icon_commons.models import Icon
+from icon_commons.models import IconData
+from icon_commons.models import SVGBlob
+from icon_commons.utils import svg_hash
+
+
+def compact_icon(icon_id, interval):
+    """Store the versions of an icon as deltas, but for the current version
+    and keyframes, which are stored in full (and restored if they were
+    deltas), deleting the blobs no version uses anymore. Returns the number
+    of versions encoded and restored and the bytes the history took before
+    and after."""
+    counts = {'encoded': 0, 'restored': 0, 'before': 0, 'after': 0}
+    with transaction.atomic():
+        current = Icon.objects.select_for_update().values_list('current_id', flat=True).get(pk=icon_id)
+        rows = IconData.objects.filter(icon_id=icon_id).order_by('-version').values_list(
+            'id', 'version', 'sha256', 'delta', 'blob_id', 'blob__svg')
+        changed = []
+        blobs = set()
+        newer = None
+        for id, version, sha256, delta, blob, full in rows:
+            if full is None and newer is None:
+                raise CommandError('version %s of icon %s has no newer version to apply its delta to' % (
+                    version, icon_id))
+            svg = full if full is not None else deltas.apply(newer, delta)
+            size = len(svg.encode('utf-8')) if full is not None else len(delta)
+            counts['before'] += size
+            keep = id == current or newer is None or deltas.is_keyframe(version, interval)
+            if full is not None and not keep:
+                delta = deltas.encode(newer, svg)
+                if len(delta) < size and deltas.apply(newer, delta) == svg:
+                    changed.append(IconData(id=id, blob=None, delta=delta))
+                    blobs.add(blob)
+                    counts['encoded'] += 1
+                    size = len(delta)
+            elif full is None and keep:
+                if svg_hash(svg) != sha256:
+                    raise CommandError('version %s of icon %s does not reconstruct to its sha256' % (
+                        version, icon_id))
+                changed.append(IconData(id=id, blob=SVGBlob.store(svg), delta=None))
+                counts['restored'] += 1
+                size = len(svg.encode('utf-8'))
+            counts['after'] += size
+            newer = svg
+        IconData.objects.bulk_update(changed, ['blob', 'delta'])
+        if blobs:
+            SVGBlob.prune(blobs)
+    return counts
+
+
+class Command(BaseCommand):
+
+    help = 'Store the version history of icons as deltas from the newer versions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('icons', nargs='*', type=int, help='Icon ids, all icons if none')
+        parser.add_argument('--keyframe', type=int,
+                            help='Keep every nth version in full (default ICON_COMMONS_DELTA_KEYFRAME), '
+                                 '1 restores every version')
+
+    def handle(self, *args, **options):
+        interval = options['keyframe'] or deltas.keyframe_interval()
+        icons = Icon.objects.filter(current__isnull=False).order_by('id')
+        if options['icons']:
+            icons = icons.filter(id__in=options['icons'])
+        total = {'encoded': 0, 'restored': 0, 'before': 0, 'after': 0}
+        for icon_id in icons.values_list('id', flat=True).iterator():
+            for k, v in compact_icon(icon_id, interval).items():
+                total[k] += v
+        self.stdout.write('%(encoded)s versions delta encoded, %(restored)s restored in full' % total)
+        self.stdout.write('history of %(before)s bytes now stored in %(after)s bytes' % total)
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+from icon_commons.export import current_versions
+from icon_commons.export import formats
+from icon_commons.export import parse_since
+import sys
+
+
+class Command(BaseCommand):
+
+    help = 'Export the current version of every icon as NDJSON or a zip'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(formats), default='ndjson')
+        parser.add_argument('--collection', help='Collection id or name')
+        parser.add_argument('--since', help='Only icons modified since this ISO 8601 date or datetime')
+        parser.add_argument('-o', '--output', default='-', help='File to write, - for stdout')
+
+    def handle(self, *args, **options):
+        since = options['since']
+        if since:
+            since = parse_since(since)
+            if since is None:
+                raise CommandError('--since must be an ISO 8601 date or datetime')
+        started = timezone.now()
+        encode = formats[options['format']][0]
+        count = [0]
+
+        def counted(icons):
+            for icon in icons:
+                count[0] += 1
+                yield icon
+
+        icons = counted(current_versions(options['collection'], since))
+        out = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for chunk in encode(icons):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        self.stderr.write('%s icons exported, use --since %s for the changes after this run' % (
+            count[0], started.isoformat()))
@@ -1,49 +1,121 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
 from django.core.management.base import BaseCommand
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
+from icon_commons.importer import Timings
+from icon_commons.importer import bulk_import
+from icon_commons.importer import chunks
+from icon_commons.importer import prepare_svg
 from icon_commons.models import Collection
 from icon_commons.models import Icon
-from taggit.models import Tag
-from optparse import make_option
+from icon_commons.models import IngestManifest
 import os
 import re
-import time
-
-
-def visit(visitor, dirname, names):
-    paths = (os.path.join(dirname, n) for n in names)
-    is_svg = lambda n: os.path.isfile(n) and os.path.splitext(n)[1].lower() == '.svg'
-    for p in filter(is_svg, paths):
-        t = time.time()
-        col = visitor.collection(p)
-        svg_name = os.path.basename(p)
-        # deal w/ odd OSM paths
-        if ',' in svg_name:
-            svg_name = svg_name[svg_name.rfind(',') + 1:]
-        icon, created = Icon.objects.get_or_create(name=svg_name, collection=col)
-        icon.tags.add(*visitor.tags(p))
-        msg = 'initial import' if created else 'automatic update'
-        with open(p, 'rb') as fp:
-            data = fp.read()
-            updated = True
-            try:
-                latest = icon.icondata_set.latest('version')
-                updated = latest.svg == data
-            except ObjectDoesNotExist:
-                pass
-            if updated:
-                icon.new_version(data, msg)
-        print('imported ' if created else 'updated', p, ' in %.3f seconds' % (time.time() - t))
+
+
+def walk(dirname):
+    # yields (path, size, mtime_ns) of the svg files under dirname
+    with os.scandir(dirname) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        if entry.is_dir():
+            for found in walk(entry.path):
+                yield found
+        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() == '.svg':
+            stat = entry.stat()
+            yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def read_svgs(files):
+    # runs in the worker processes: read, validate, hash and compile
+    results = []
+    for path, size, mtime_ns in files:
+        try:
+            with open(path, 'rb') as fp:
+                results.append((path, size, mtime_ns, prepare_svg(path, fp.read()), None))
+        except (IOError, ValueError) as e:
+            results.append((path, size, mtime_ns, None, str(e)))
+    return results
+
+
+def prepared_batches(paths, batch_size, pool):
+    # keep one batch in flight in the pool while the previous one is written
+    pending = None
+    for batch in chunks(paths, batch_size):
+        if pool is None:
+            futures = [read_svgs(batch)]
+        else:
+            futures = [pool.submit(read_svgs, c) for c in chunks(batch, 64)]
+        if pending is not None:
+            yield pending
+        pending = futures
+    if pending is not None:
+        yield pending
+
+
+def icon_name(path):
+    svg_name = os.path.basename(path)
+    # deal w/ odd OSM paths
+    if ',' in svg_name:
+        svg_name = svg_name[svg_name.rfind(',') + 1:]
+    return svg_name
 
 
 _tag_splitter = re.compile('[-_ ]')
 
 
 class Visitor(object):
-    def __init__(self, base):
+    def __init__(self, base, missing_tag=None):
         self.base = base
+        self.missing_tag = missing_tag
         self.collections_cache = {}
         self.tags_cache = {}
+        self.manifest = {}
+        self.seen = set()
+
+    def reset(self):
+        self.collections_cache.clear()
+        self.tags_cache.clear()
+
+    def load_manifest(self, dirname):
+        prefix = os.path.join(os.path.abspath(dirname), '')
+        self.manifest = dict((m.path, m) for m in IngestManifest.objects.filter(path__startswith=prefix))
+
+    def changed(self, files, full=False):
+        """Filter (path, size, mtime_ns) down to the files that need reading."""
+        for path, size, mtime_ns in files:
+            path = os.path.abspath(path)
+            self.seen.add(path)
+            m = self.manifest.get(path, None)
+            if full or m is None or m.missing or m.size != size or m.mtime_ns != mtime_ns:
+                yield path, size, mtime_ns
+
+    def missing(self):
+        return [m for path, m in self.manifest.items() if path not in self.seen and not m.missing]
+
+    def record(self, batch, icons):
+        """Update the manifest for a written batch of (path, size, mtime_ns, entry)."""
+        created, updated, found = [], [], []
+        for path, size, mtime_ns, entry in batch:
+            icon = icons.get(path, None)
+            m = self.manifest.get(path, None)
+            if m is None:
+                m = IngestManifest(path=path)
+                created.append(m)
+            else:
+                updated.append(m)
+                if m.missing and m.icon_id:
+                    found.append(m.icon_id)
+            m.size, m.mtime_ns, m.sha256, m.missing = size, mtime_ns, entry.sha256, False
+            if icon is not None:
+                m.icon_id, m.version = icon.id, icon.current_version
+        IngestManifest.objects.bulk_create(created)
+        IngestManifest.objects.bulk_update(updated, ['size', 'mtime_ns', 'sha256', 'missing', 'icon', 'version'])
+        for m in IngestManifest.objects.filter(path__in=[m.path for m in created]):
+            self.manifest[m.path] = m
+        if found and self.missing_tag:
+            for icon in Icon.objects.filter(id__in=found):
+                icon.tags.remove(self.missing_tag)
 
     def collection(self, path):
         name = self.collection_name(path)
@@ -57,13 +129,6 @@ class Visitor(object):
         relpath = os.path.relpath(path, self.base)
         return os.path.split(relpath)[0]
 
-    def tag(self, name):
-        tag = self.tags_cache.get(name, None)
-        if tag is None:
-            tag, created = Tag.objects.get_or_create(name=name)
-            self.tags_cache[name] = tag
-        return tag
-
     def tags(self, path):
         relpath = os.path.relpath(path, self.base)
         # don't auto-tag OSM for now
@@ -78,25 +143,105 @@ class Visitor(object):
             found = [t for t in _tag_splitter.split(tail) if not t.isdigit()]
             tags.extend(found)
             relpath = head
-        return [self.tag(t) for t in tags]
+        return tags
+
+    def ingest(self, batch, timings):
+        """Write a batch of (path, size, mtime_ns, SVGEntry) grouped by collection."""
+        totals = {'created': 0, 'updated': 0, 'unchanged': 0}
+        icons = {}
+        # content is unchanged when only the mtime moved, skip the icon queries
+        pending = [b for b in batch if b[0] not in self.manifest or self.manifest[b[0]].missing or
+                   self.manifest[b[0]].sha256 != b[3].sha256]
+        totals['unchanged'] += len(batch) - len(pending)
+        with timings.phase('collections'):
+            pending = sorted(((self.collection(b[0]),) + b for b in pending), key=lambda c: c[0].id)
+        for col, group in groupby(pending, key=lambda c: c[0]):
+            group = list(group)
+            entries = [e._replace(name=icon_name(p), tags=self.tags(p)) for c, p, size, mtime, e in group]
+            counts, imported = bulk_import(col, entries, timings=timings, tag_cache=self.tags_cache)
+            for k, v in counts.items():
+                totals[k] += v
+            icons.update((p, imported[icon_name(p)]) for c, p, size, mtime, e in group)
+        with timings.phase('manifest'):
+            self.record(batch, icons)
+        return totals
+
+    def mark_missing(self):
+        """Tag the icons whose source files disappeared, returns the count."""
+        missing = self.missing()
+        icons = Icon.objects.filter(id__in=[m.icon_id for m in missing if m.icon_id])
+        for icon in icons:
+            icon.tags.add(self.missing_tag)
+        IngestManifest.objects.filter(id__in=[m.id for m in missing]).update(missing=True)
+        return len(missing)
+
+    def forget_missing(self):
+        missing = self.missing()
+        IngestManifest.objects.filter(id__in=[m.id for m in missing]).delete()
+        return len(missing)
 
 
 class Command(BaseCommand):
 
-    args = '<dir ...>'
     help = 'Ingest icons found in the provided directories'
-    option_list = BaseCommand.option_list + (
-        make_option('--base', help='Specify base directory'),
-    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dirs', nargs='+', metavar='dir')
+        parser.add_argument('--base', help='Specify base directory')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes reading and validating svg files, 0 to read in process')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Files written per transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Read and validate everything, then roll back')
+        parser.add_argument('--full', action='store_true',
+                            help='Read every file, not only those changed since the last run')
+        parser.add_argument('--mark-missing', nargs='?', const='missing-source', metavar='TAG',
+                            help='Tag icons whose source file disappeared (default tag: missing-source)')
 
     def handle(self, *args, **options):
-        visitor = None
-        with transaction.atomic():
-            for arg in args:
-                if not visitor:
-                    visitor = Visitor(arg)
-                else:
-                    visitor.base = arg
-                if options['base']:
-                    visitor.base = options['base']
-                os.path.walk(args[0], visit, visitor)
+        timings = Timings()
+        totals = {'files': 0, 'skipped': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0,
+                  'missing': 0}
+        pool = ProcessPoolExecutor(options['workers']) if options['workers'] > 1 else None
+        try:
+            for dirname in options['dirs']:
+                visitor = Visitor(options['base'] or dirname, options['mark_missing'])
+                with timings.phase('manifest'):
+                    visitor.load_manifest(dirname)
+                files = visitor.changed(walk(dirname), options['full'])
+                read = 0
+                for futures in prepared_batches(files, options['batch_size'], pool):
+                    with timings.phase('read'):
+                        results = [r for f in futures for r in (f if pool is None else f.result())]
+                    for path, size, mtime_ns, entry, error in results:
+                        if error:
+                            totals['failed'] += 1
+                            self.stderr.write('skipped %s' % error)
+                    batch = [r[:4] for r in results if r[3] is not None]
+                    with transaction.atomic():
+                        counts = visitor.ingest(batch, timings)
+                        if options['dry_run']:
+                            transaction.set_rollback(True)
+                            visitor.reset()
+                    read += len(results)
+                    for k, v in counts.items():
+                        totals[k] += v
+                if visitor.missing():
+                    with transaction.atomic():
+                        if options['mark_missing']:
+                            totals['missing'] += visitor.mark_missing()
+                        else:
+                            totals['missing'] += visitor.forget_missing()
+                        if options['dry_run']:
+                            transaction.set_rollback(True)
+                totals['files'] += read
+                totals['skipped'] += len(visitor.seen) - read
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.stdout.write('%(files)s files read, %(skipped)s unchanged on disk: %(created)s created, '
+                          '%(updated)s updated, %(unchanged)s unchanged, %(failed)s failed, '
+                          '%(missing)s missing' % totals +
+                          (' (dry run, nothing written)' if options['dry_run'] else ''))
+        self.stdout.write(timings.summary())
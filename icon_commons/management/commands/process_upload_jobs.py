@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from icon_commons.jobs import run_queued
+import time
+
+
+class Command(BaseCommand):
+
+    help = 'Import queued zip uploads, for ICON_COMMONS_UPLOAD_JOBS = "worker"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs queued now and exit instead of polling')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds between polls for new jobs')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_queued()
+            if count:
+                self.stdout.write('ran %s upload jobs' % count)
+            if options['once']:
+                break
+            time.sleep(options['interval'])
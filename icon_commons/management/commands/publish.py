@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from icon_commons.publish import Publisher
+
+
+class Command(BaseCommand):
+
+    help = 'Write the current version of every icon to a directory a web server can serve as is'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dir')
+        parser.add_argument('--full', action='store_true',
+                            help='Look at every icon, not only those modified since the last run')
+
+    def handle(self, *args, **options):
+        counts = Publisher(options['dir']).publish(full=options['full'])
+        self.stdout.write('%(written)s icons written, %(unchanged)s unchanged, %(removed)s removed, '
+                          '%(indexes)s collection indexes written' % counts)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from icon_commons.counters import recount
+
+
+class Command(BaseCommand):
+
+    help = 'Repair the icon counts kept on collections'
+
+    def handle(self, *args, **options):
+        self.stdout.write('%s collection counts fixed' % recount())
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+from icon_commons.models import IconData
+
+
+def savings_by_collection():
+    """Bytes saved by optimize_svg on the current version of the icons, as
+    a dict of collection name, icons, optimized icons, original bytes and
+    served bytes per collection."""
+    rows = IconData.objects.filter(icon__current=F('id')).values('icon__collection__name').annotate(
+        icons=Count('id'), optimized=Count('original'), original_bytes=Sum(Coalesce('original__size', 'blob__size')),
+        served_bytes=Sum('blob__size')).order_by('icon__collection__name')
+    return [{
+        'collection': row['icon__collection__name'],
+        'icons': row['icons'],
+        'optimized': row['optimized'],
+        'original_bytes': row['original_bytes'] or 0,
+        'served_bytes': row['served_bytes'] or 0,
+        'saved_bytes': (row['original_bytes'] or 0) - (row['served_bytes'] or 0),
+    } for row in rows]
+
+
+class Command(BaseCommand):
+
+    help = 'Report the bytes saved by optimizing the current svg of each collection'
+
+    def handle(self, *args, **options):
+        total = {'original_bytes': 0, 'served_bytes': 0, 'saved_bytes': 0}
+        for row in savings_by_collection():
+            self.stdout.write('%(collection)s: %(optimized)s of %(icons)s icons optimized, %(original_bytes)s bytes '
+                              'uploaded, %(served_bytes)s bytes served, %(saved_bytes)s bytes saved' % row)
+            for k in total:
+                total[k] += row[k]
+        self.stdout.write('total: %(original_bytes)s bytes uploaded, %(served_bytes)s bytes served, '
+                          '%(saved_bytes)s bytes saved' % total)
@@ -0,0 +1,201 @@
+from bisect import bisect_left
+from contextlib import ExitStack
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+# histogram bucket upper bounds, seconds and queries
+_second_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_query_buckets = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_local = threading.local()
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        durations = self.recorder.durations
+        durations[self.name] = durations.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class Recorder(object):
+    """Query count and time spent per phase of one request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.durations = {}
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.durations['db'] = self.durations.get('db', 0.0) + time.perf_counter() - start
+
+
+def phase(name):
+    """Time a block as phase name of the current request, a shared no-op
+    context when the request isn't recorded."""
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return _null_phase
+    return recorder.phase(name)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """Per process histograms of request phase durations and query counts,
+    by view."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.queries = {}
+        self._lock = threading.Lock()
+
+    def observe(self, view, recorder):
+        with self._lock:
+            for name, seconds in recorder.durations.items():
+                key = (view, name)
+                if key not in self.seconds:
+                    self.seconds[key] = Histogram(_second_buckets)
+                self.seconds[key].observe(seconds)
+            if view not in self.queries:
+                self.queries[view] = Histogram(_query_buckets)
+            self.queries[view].observe(recorder.queries)
+
+    def clear(self):
+        with self._lock:
+            self.seconds.clear()
+            self.queries.clear()
+
+    def prometheus(self, render_cache=None):
+        """The registry in the Prometheus text exposition format."""
+        lines = []
+
+        def histogram(metric, help, histograms, labels):
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s histogram' % metric)
+            for key, h in sorted(histograms.items()):
+                label = labels(key)
+                cumulative = 0
+                for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (metric, label, bound, cumulative))
+                lines.append('%s_sum{%s} %s' % (metric, label, h.sum))
+                lines.append('%s_count{%s} %s' % (metric, label, h.count))
+        with self._lock:
+            histogram('icon_commons_request_phase_seconds', 'Time spent per request phase.', self.seconds,
+                      lambda key: 'view="%s",phase="%s"' % key)
+            histogram('icon_commons_request_queries', 'Database queries per request.', self.queries,
+                      lambda view: 'view="%s"' % view)
+        if render_cache is not None:
+            stats = render_cache.stats()
+            for name in ('hits', 'misses', 'evictions'):
+                if name in stats:
+                    metric = 'icon_commons_render_cache_%s_total' % name
+                    lines.append('# TYPE %s counter' % metric)
+                    lines.append('%s{backend="%s"} %s' % (metric, stats['backend'], stats[name]))
+            for name in ('entries', 'bytes', 'max_bytes'):
+                if name in stats:
+                    metric = 'icon_commons_render_cache_%s' % name
+                    lines.append('# TYPE %s gauge' % metric)
+                    lines.append('%s{backend="%s"} %s' % (metric, stats['backend'], stats[name]))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def server_timing(recorder, total):
+    parts = ['db;desc="%s queries";dur=%.2f' % (recorder.queries, recorder.durations.get('db', 0.0) * 1000)]
+    for name in sorted(recorder.durations):
+        if name != 'db':
+            parts.append('%s;dur=%.2f' % (name, recorder.durations[name] * 1000))
+    parts.append('total;dur=%.2f' % (total * 1000))
+    return ', '.join(parts)
+
+
+class MetricsMiddleware(object):
+    """Records the icon_commons views: query count and time, svg processing
+    and serialization time, sent as a Server-Timing header and aggregated
+    in the process wide registry (see views.MetricsView).
+
+    Requests for other apps pass through untouched. Requests slower than
+    ICON_COMMONS_METRICS_SLOW_MS are logged with their path.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow = getattr(settings, 'ICON_COMMONS_METRICS_SLOW_MS', None)
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            recorder = getattr(request, '_icon_commons_recorder', None)
+            if recorder is not None:
+                recorder.wrappers.close()
+                _local.recorder = None
+        if recorder is not None:
+            total = time.perf_counter() - recorder.start
+            response['Server-Timing'] = server_timing(recorder, total)
+            recorder.durations['total'] = total
+            registry.observe(recorder.view, recorder)
+            if self.slow is not None and total * 1000 >= self.slow:
+                logger.warning('slow %s %s: %.1fms, %s queries', request.method, request.get_full_path(),
+                               total * 1000, recorder.queries)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not view_func.__module__.startswith('icon_commons.'):
+            return None
+        match = request.resolver_match
+        recorder = request._icon_commons_recorder = _local.recorder = Recorder()
+        recorder.view = match.url_name if match is not None and match.url_name else view_func.__name__
+        recorder.wrappers = ExitStack()
+        for alias in connections:
+            recorder.wrappers.enter_context(connections[alias].execute_wrapper(recorder.execute))
+        recorder.start = time.perf_counter()
+        return None
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+from icon_commons.utils import compile_svg
+
+
+def compile_templates(apps, schema_editor):
+    db = schema_editor.connection.alias
+    IconData = apps.get_model('icon_commons', 'IconData')
+    for data in IconData.objects.using(db).only('id', 'svg').iterator():
+        IconData.objects.using(db).filter(id=data.id).update(template=compile_svg(data.svg))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icondata',
+            name='template',
+            field=models.TextField(editable=False, null=True),
+        ),
+        migrations.RunPython(compile_templates, migrations.RunPython.noop),
+    ]
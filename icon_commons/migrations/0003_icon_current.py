@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_current(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Icon = apps.get_model('icon_commons', 'Icon')
+    IconData = apps.get_model('icon_commons', 'IconData')
+    latest = {}
+    for id, icon_id, version in IconData.objects.using(db).values_list('id', 'icon_id', 'version').iterator():
+        if version > latest.get(icon_id, (None, 0))[1]:
+            latest[icon_id] = (id, version)
+    for icon_id, (id, version) in latest.items():
+        Icon.objects.using(db).filter(id=icon_id).update(current=id, current_version=version)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0002_icondata_template'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icon',
+            name='current',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='icon_commons.IconData'),
+        ),
+        migrations.AddField(
+            model_name='icon',
+            name='current_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_current, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+from icon_commons.utils import svg_hash
+
+
+def hash_svgs(apps, schema_editor):
+    db = schema_editor.connection.alias
+    IconData = apps.get_model('icon_commons', 'IconData')
+    for data in IconData.objects.using(db).only('id', 'svg').iterator():
+        IconData.objects.using(db).filter(id=data.id).update(sha256=svg_hash(data.svg))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0003_icon_current'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icondata',
+            name='sha256',
+            field=models.CharField(default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_svgs, migrations.RunPython.noop),
+    ]
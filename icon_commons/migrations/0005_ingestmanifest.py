@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0004_icondata_sha256'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestManifest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=512, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('mtime_ns', models.BigIntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('version', models.PositiveSmallIntegerField(default=0)),
+                ('missing', models.BooleanField(default=False)),
+                ('icon', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='icon_commons.Icon')),
+            ],
+        ),
+    ]
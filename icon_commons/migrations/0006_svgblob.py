@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from icon_commons.utils import svg_hash
+
+
+def move_to_blobs(apps, schema_editor):
+    db = schema_editor.connection.alias
+    IconData = apps.get_model('icon_commons', 'IconData')
+    SVGBlob = apps.get_model('icon_commons', 'SVGBlob')
+    for data in IconData.objects.using(db).only('id', 'svg', 'template').iterator():
+        sha256 = svg_hash(data.svg)
+        if not SVGBlob.objects.using(db).filter(sha256=sha256).exists():
+            SVGBlob.objects.using(db).create(sha256=sha256, svg=data.svg, template=data.template,
+                                             size=len(data.svg.encode('utf-8')))
+        IconData.objects.using(db).filter(id=data.id).update(blob=sha256, sha256=sha256)
+
+
+def move_from_blobs(apps, schema_editor):
+    db = schema_editor.connection.alias
+    IconData = apps.get_model('icon_commons', 'IconData')
+    for data in IconData.objects.using(db).select_related('blob').iterator():
+        IconData.objects.using(db).filter(id=data.id).update(svg=data.blob.svg, template=data.blob.template)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0005_ingestmanifest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SVGBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('svg', models.TextField()),
+                ('template', models.TextField(editable=False, null=True)),
+                ('size', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='icondata',
+            name='blob',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='icon_commons.SVGBlob'),
+        ),
+        migrations.AlterField(
+            model_name='icondata',
+            name='svg',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(move_to_blobs, move_from_blobs),
+        migrations.RemoveField(
+            model_name='icondata',
+            name='svg',
+        ),
+        migrations.RemoveField(
+            model_name='icondata',
+            name='template',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+from icon_commons.utils import compress_svg
+
+
+def compress_blobs(apps, schema_editor):
+    db = schema_editor.connection.alias
+    SVGBlob = apps.get_model('icon_commons', 'SVGBlob')
+    for blob in SVGBlob.objects.using(db).only('sha256', 'svg').iterator():
+        encoded = compress_svg(blob.svg)
+        SVGBlob.objects.using(db).filter(sha256=blob.sha256).update(gzip=encoded['gzip'], brotli=encoded['br'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0007_uploadjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='svgblob',
+            name='gzip',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='svgblob',
+            name='brotli',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(compress_blobs, migrations.RunPython.noop),
+    ]
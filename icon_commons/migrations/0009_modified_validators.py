@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0008_svgblob_compressed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='icon',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_icons(apps, schema_editor):
+    Collection = apps.get_model('icon_commons', 'Collection')
+    counts = Collection.objects.using(schema_editor.connection.alias).annotate(count=Count('icon'))
+    for id, count in counts.values_list('id', 'count'):
+        Collection.objects.using(schema_editor.connection.alias).filter(id=id).update(icon_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0009_modified_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='icon_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='collection',
+            index=models.Index(fields=['name', 'id'], name='icon_common_name_44252d_idx'),
+        ),
+        migrations.RunPython(count_icons, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0010_collection_icon_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='collection',
+            name='slug',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='icon',
+            name='slug',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0011_slug_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icondata',
+            name='original',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT,
+                                    related_name='originals', to='icon_commons.SVGBlob'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0012_icondata_original'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icondata',
+            name='delta',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+    ]
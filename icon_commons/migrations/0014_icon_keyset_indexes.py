@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0013_icondata_delta'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='icon',
+            index=models.Index(fields=['name', 'id'], name='icon_common_name_718a20_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='icon',
+            index=models.Index(fields=['collection', 'name', 'id'], name='icon_common_collect_543a7f_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icon_commons', '0014_icon_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadjob',
+            name='heartbeat',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,15 +1,25 @@
 from django.db import models
+from django.db import IntegrityError
 from django.db import transaction
 from django.template.defaultfilters import slugify
 from taggit.managers import TaggableManager
 from base64 import b64encode
 from django.conf import settings
+from icon_commons import delta as deltas
+from icon_commons.cache import invalidate_icon
+from icon_commons.optimize import optimize_svg
+from icon_commons.utils import compile_svg
+from icon_commons.utils import compress_svg
+from icon_commons.utils import process_svg
+from icon_commons.utils import render_template
+from icon_commons.utils import svg_hash
 
 
 class SlugMixin(models.Model):
 
     name = models.CharField(max_length=128)
-    slug = models.CharField(max_length=128)
+    # looked up by the /<collection>/<icon> urls, see icon_commons.resolver
+    slug = models.CharField(max_length=128, db_index=True)
 
     def save(self, *args, **kw):
         self.slug = slugify(self.name)
@@ -19,13 +29,185 @@ class SlugMixin(models.Model):
         abstract = True
 
 
-class IconData(models.Model):
+class SVGBlob(models.Model):
+    """An svg body stored once per distinct content, keyed by its sha256."""
 
+    sha256 = models.CharField(max_length=64, primary_key=True)
     svg = models.TextField()
+    # precompiled recolor template, see utils.compile_svg
+    template = models.TextField(null=True, editable=False)
+    size = models.PositiveIntegerField()
+    # precompressed encodings of svg, null when they wouldn't be smaller
+    gzip = models.BinaryField(null=True)
+    brotli = models.BinaryField(null=True)
+
+    @classmethod
+    def create(cls, svg, sha256=None, template=None):
+        """Build an unsaved blob with every derived field filled in."""
+        encoded = compress_svg(svg)
+        return cls(sha256=sha256 or svg_hash(svg), svg=svg,
+                   template=template or compile_svg(svg), size=len(svg.encode('utf-8')),
+                   gzip=encoded['gzip'], brotli=encoded['br'])
+
+    @classmethod
+    def store(cls, svg, derived=True):
+        """Return the blob for svg, creating it if the content is new.
+
+        derived=False skips the template and compressed encodings, for
+        content that isn't served.
+        """
+        sha256 = svg_hash(svg)
+        try:
+            return cls.objects.get(sha256=sha256)
+        except cls.DoesNotExist:
+            pass
+        if derived:
+            blob = cls.create(svg, sha256)
+        else:
+            blob = cls(sha256=sha256, svg=svg, size=len(svg.encode('utf-8')))
+        try:
+            with transaction.atomic():
+                blob.save(force_insert=True)
+        except IntegrityError:
+            # stored concurrently by another writer
+            return cls.objects.get(sha256=sha256)
+        return blob
+
+    @classmethod
+    def prune(cls, sha256s=None):
+        """Delete the blobs (of sha256s, or any) no version references as
+        its svg or original. Returns the number deleted."""
+        blobs = cls.objects.filter(icondata__isnull=True, originals__isnull=True)
+        if sha256s is not None:
+            blobs = blobs.filter(sha256__in=sha256s)
+        return blobs.delete()[0]
+
+    def variants(self):
+        """The svg bytes by content encoding, see utils.compress_svg.
+
+        Encodings whose field was deferred are left out.
+        """
+        deferred = self.get_deferred_fields()
+        variants = {'identity': self.svg.encode('utf-8')}
+        for encoding, field in (('gzip', 'gzip'), ('br', 'brotli')):
+            value = getattr(self, field) if field not in deferred else None
+            variants[encoding] = bytes(value) if value is not None else None
+        return variants
+
+    def __unicode__(self):
+        return 'SVGBlob %s' % self.sha256
+
+
+class IconData(models.Model):
+
     version = models.PositiveSmallIntegerField()
     change_log = models.TextField(null=True)
     icon = models.ForeignKey('icon_commons.Icon', on_delete=models.CASCADE)
     modified = models.DateTimeField(auto_now=True)
+    blob = models.ForeignKey(SVGBlob, null=True, editable=False, on_delete=models.PROTECT)
+    # sha256 of svg, served as the ETag
+    sha256 = models.CharField(max_length=64, editable=False)
+    # the svg as uploaded when optimize_svg changed it, kept for audit
+    original = models.ForeignKey(SVGBlob, null=True, editable=False, related_name='originals',
+                                 on_delete=models.PROTECT)
+    # instead of a blob, the delta from the next newer version's svg to this
+    # one, see icon_commons.delta
+    delta = models.BinaryField(null=True, editable=False)
+
+    # svg assigned but not yet stored in a blob
+    _svg = None
+
+    @property
+    def svg(self):
+        if self._svg is not None:
+            return self._svg
+        if self.blob_id is None and self.delta is not None:
+            return self.reconstruct()
+        return self.blob.svg
+
+    @svg.setter
+    def svg(self, svg):
+        self._svg = svg.decode('utf-8') if isinstance(svg, bytes) else svg
+
+    def save(self, *args, **kw):
+        if self._svg is not None:
+            self.blob = SVGBlob.store(self._svg)
+            self.sha256 = self.blob.sha256
+            self._svg = None
+        super(IconData, self).save(*args, **kw)
+
+    def reconstruct(self):
+        """The svg of a delta encoded version, patched down from the
+        nearest newer version stored in full or cached."""
+        cache = deltas.get_version_cache()
+        if cache is not None:
+            svg = cache.get((self.id, self.sha256))
+            if svg is not None:
+                return svg
+        chain = []
+        svg = None
+        newer = IconData.objects.filter(icon_id=self.icon_id, version__gt=self.version).order_by('version')
+        for id, sha256, delta, full in newer.values_list('id', 'sha256', 'delta', 'blob__svg').iterator():
+            svg = full if full is not None or cache is None else cache.get((id, sha256))
+            if svg is not None:
+                break
+            chain.append((id, sha256, delta))
+        if svg is None:
+            raise IconData.DoesNotExist('No full version to reconstruct version %s from' % self.version)
+        for id, sha256, delta in reversed(chain):
+            svg = deltas.apply(svg, delta)
+            if cache is not None:
+                cache.set((id, sha256), svg)
+        svg = deltas.apply(svg, self.delta)
+        if cache is not None:
+            cache.set((self.id, self.sha256), svg)
+        return svg
+
+    @classmethod
+    def demote(cls, replaced):
+        """Delta encode the versions that were just replaced as current.
+
+        replaced maps the id of each to the svg of the version replacing it.
+        Keyframes and versions whose delta isn't smaller stay in full. Blobs
+        no version uses anymore are deleted.
+        """
+        interval = deltas.keyframe_interval()
+        rows = cls.objects.filter(id__in=replaced, blob__isnull=False).values_list(
+            'id', 'version', 'blob_id', 'blob__svg')
+        encoded = []
+        blobs = set()
+        for id, version, sha256, svg in rows:
+            if deltas.is_keyframe(version, interval):
+                continue
+            delta = deltas.encode(replaced[id], svg)
+            if len(delta) < len(svg.encode('utf-8')):
+                encoded.append(cls(id=id, blob=None, delta=delta))
+                blobs.add(sha256)
+        if encoded:
+            cls.objects.bulk_update(encoded, ['blob', 'delta'])
+            SVGBlob.prune(blobs)
+        return len(encoded)
+
+    def variants(self):
+        if self.blob_id is None:
+            # encoded as a blob would be, the ETag promises the same bytes
+            cache = deltas.get_version_cache()
+            key = (self.id, self.sha256, 'variants')
+            variants = cache.get(key) if cache is not None else None
+            if variants is None:
+                svg = self.svg
+                variants = dict(compress_svg(svg), identity=svg.encode('utf-8'))
+                if cache is not None:
+                    cache.set(key, variants)
+            return variants
+        return self.blob.variants()
+
+    def render(self, params):
+        if self.blob_id is not None and self.blob.template:
+            svg = render_template(self.blob.template, params)
+            if svg is not None:
+                return svg
+        return process_svg(self.svg, params)
 
     def data_uri(self):
         b64 = b64encode(self.svg().encode('utf-8-sig'))
@@ -43,28 +225,104 @@ class Icon(SlugMixin):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.CASCADE)
     collection = models.ForeignKey('icon_commons.Collection', on_delete=models.CASCADE)
     tags = TaggableManager()
-    modified = models.DateTimeField(auto_now=True)
+    # indexed for the list endpoint validators, see views.JSONMixin
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    # denormalized pointer to the latest IconData, maintained by new_version
+    current = models.ForeignKey(IconData, null=True, blank=True, editable=False,
+                                related_name='+', on_delete=models.SET_NULL)
+    current_version = models.PositiveSmallIntegerField(default=0, editable=False)
 
     def current_icon_data(self):
-        return IconData.objects.filter(icon=self).latest('version')
+        if self.current_id is None:
+            return IconData.objects.filter(icon=self).latest('version')
+        return self.current
 
     @transaction.atomic
     def new_version(self, svg, change_log):
-        try:
-            latest = self.icondata_set.latest('version').version
-        except IconData.DoesNotExist:
-            latest = 0
-        data = IconData.objects.create(svg=svg,
+        # lock the icon row so concurrent writers can't claim the same version
+        latest, previous = Icon.objects.select_for_update().values_list('current_version', 'current_id').get(
+            pk=self.pk)
+        svg = svg.decode('utf-8-sig') if isinstance(svg, bytes) else svg
+        optimized = optimize_svg(svg)
+        original = SVGBlob.store(svg, derived=False) if optimized != svg else None
+        data = IconData.objects.create(svg=optimized,
+                                       original=original,
                                        version=latest + 1,
                                        change_log=change_log,
                                        icon=self)
-        self.save()
+        self.current = data
+        self.current_version = data.version
+        self.save(update_fields=['current', 'current_version', 'modified'])
+        if previous is not None and deltas.enabled():
+            IconData.demote({previous: optimized})
+        invalidate_icon(self.id)
         return data
 
     class Meta:
         unique_together = ('name', 'collection')
+        # the (name, id) order IconList pages through, overall and by collection
+        indexes = [models.Index(fields=['name', 'id']), models.Index(fields=['collection', 'name', 'id'])]
 
 
 class Collection(SlugMixin):
 
     description = models.TextField(null=True)
+    modified = models.DateTimeField(auto_now=True)
+    # number of icons, maintained by icon_commons.counters
+    icon_count = models.PositiveIntegerField(default=0, editable=False)
+
+    def save(self, *args, **kw):
+        if not self._state.adding and not args and kw.get('update_fields') is None:
+            # icon_count is only written by icon_commons.counters, this copy may be stale
+            kw['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                   if not f.primary_key and f.name != 'icon_count']
+        super(Collection, self).save(*args, **kw)
+
+    class Meta:
+        # the order CollectionList pages through
+        indexes = [models.Index(fields=['name', 'id'])]
+
+
+class IngestManifest(models.Model):
+    """The state of a source file as of the last ingest run."""
+
+    path = models.CharField(max_length=512, unique=True)
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    icon = models.ForeignKey(Icon, null=True, on_delete=models.SET_NULL)
+    version = models.PositiveSmallIntegerField(default=0)
+    # set when the file disappeared and the icon was marked missing
+    missing = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return 'IngestManifest %s' % self.path
+
+
+class UploadJob(models.Model):
+    """A zip upload imported outside the request, see icon_commons.jobs."""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(s, s) for s in (QUEUED, RUNNING, DONE, FAILED)]
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    tags = models.TextField(default='[]')
+    # the uploaded zip, cleared once the job finishes
+    archive = models.BinaryField(null=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    errors = models.TextField(default='[]')
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+    # last claim or progress of its runner, see jobs.requeue_stale
+    heartbeat = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return 'UploadJob %s %s' % (self.id, self.status)
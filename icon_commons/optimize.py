@@ -0,0 +1,201 @@
+from lxml import etree
+import re
+
+from django.conf import settings
+
+
+_svg_ns = 'http://www.w3.org/2000/svg'
+_xlink_ns = 'http://www.w3.org/1999/xlink'
+_xml_space = '{http://www.w3.org/XML/1998/namespace}space'
+
+# namespaces of editor bookkeeping that doesn't affect rendering
+_editor_ns = frozenset([
+    'http://www.inkscape.org/namespaces/inkscape',
+    'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
+    'http://ns.adobe.com/AdobeIllustrator/10.0/',
+    'http://ns.adobe.com/AdobeSVGViewerExtensions/3.0/',
+    'http://ns.adobe.com/Extensibility/1.0/',
+    'http://ns.adobe.com/Flows/1.0/',
+    'http://ns.adobe.com/GenericCustomNamespace/1.0/',
+    'http://ns.adobe.com/Graphs/1.0/',
+    'http://ns.adobe.com/ImageReplacement/1.0/',
+    'http://ns.adobe.com/SaveForWeb/1.0/',
+    'http://ns.adobe.com/Variables/1.0/',
+    'http://ns.adobe.com/XPath/1.0/',
+    'http://www.bohemiancoding.com/sketch/ns',
+    'http://purl.org/dc/elements/1.1/',
+    'http://creativecommons.org/ns#',
+    'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+])
+
+# elements whose text is rendered or read, whitespace in them is kept
+_text_elements = frozenset(['text', 'tspan', 'textPath', 'title', 'desc', 'style', 'script'])
+
+_commands = frozenset('MmZzLlHhVvCcSsQqTtAa')
+_number = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_reference = re.compile(r'url\(\s*[\'"]?#([^\'")\s]+)')
+
+
+def _namespace(name):
+    return name[1:].split('}', 1)[0] if name.startswith('{') else None
+
+
+def _local(name):
+    return name.rsplit('}', 1)[-1]
+
+
+def _round(number, precision):
+    if '.' not in number and 'e' not in number.lower():
+        return number
+    out = '%.*f' % (precision, float(number))
+    if '.' in out:
+        out = out.rstrip('0').rstrip('.')
+    if out in ('-0', ''):
+        return '0'
+    # 0.5 -> .5, as short as it gets
+    if out.startswith('0.'):
+        return out[1:]
+    if out.startswith('-0.'):
+        return '-' + out[2:]
+    return out
+
+
+def round_numbers(value, precision):
+    """Round the decimal numbers of a path d or a points value to precision
+    digits. Returns value unchanged if it doesn't parse.
+
+    Arc flags may be written without separators (a1 1 0 011.5 2), they are
+    single characters and never rounded. Numbers that were run together
+    (1.5.5) are kept apart where rounding would merge them.
+    """
+    out = []
+    pos, command, arg = 0, None, 0
+    # the previous number if nothing separates it from the next one
+    last = None
+    while pos < len(value):
+        c = value[pos]
+        if c.isspace() or c == ',':
+            out.append(c)
+            last = None
+            pos += 1
+        elif c in _commands:
+            out.append(c)
+            command, arg, last = c, 0, None
+            pos += 1
+        elif command in ('A', 'a') and arg % 7 in (3, 4) and c in '01':
+            out.append(c)
+            arg += 1
+            last = None
+            pos += 1
+        else:
+            match = _number.match(value, pos)
+            if match is None:
+                return value
+            number = _round(match.group(0), precision)
+            if last is not None and (number[0].isdigit() or (number[0] == '.' and '.' not in last and
+                                                             'e' not in last.lower())):
+                out.append(' ')
+            out.append(number)
+            last = number
+            arg += 1
+            pos = match.end()
+    return ''.join(out)
+
+
+def _keeps_whitespace(el):
+    # inside a text element or under xml:space="preserve", whitespace renders
+    space = None
+    while el is not None:
+        if _local(el.tag) in _text_elements:
+            return True
+        if space is None:
+            space = el.get(_xml_space)
+        el = el.getparent()
+    return space == 'preserve'
+
+
+def _referenced(dom):
+    ids = set()
+    for el in dom.iter():
+        if not isinstance(el.tag, str):
+            continue
+        for name, value in el.attrib.items():
+            if _local(name) == 'href' and value.startswith('#'):
+                ids.add(value[1:])
+            else:
+                ids.update(_reference.findall(value))
+        if _local(el.tag) == 'style' and el.text:
+            ids.update(_reference.findall(el.text))
+    return ids
+
+
+def _optimize(dom, precision):
+    for el in list(dom.iter()):
+        if el is dom:
+            continue
+        if not isinstance(el.tag, str) or _namespace(el.tag) in _editor_ns or el.tag == '{%s}metadata' % _svg_ns:
+            # comments, processing instructions and editor elements
+            parent = el.getparent()
+            if parent is not None:
+                if el.tail and el.tail.strip():
+                    previous = el.getprevious()
+                    if previous is not None:
+                        previous.tail = (previous.tail or '') + el.tail
+                    else:
+                        parent.text = (parent.text or '') + el.tail
+                parent.remove(el)
+    for el in dom.iter(tag=etree.Element):
+        for name in list(el.attrib):
+            if _namespace(name) in _editor_ns:
+                del el.attrib[name]
+        if precision is not None and _local(el.tag) in ('path', 'glyph', 'missing-glyph'):
+            if el.get('d'):
+                el.set('d', round_numbers(el.get('d'), precision))
+        if precision is not None and _local(el.tag) in ('polygon', 'polyline') and el.get('points'):
+            el.set('points', round_numbers(el.get('points'), precision))
+        if not _keeps_whitespace(el):
+            if el.text is not None and not el.text.strip():
+                el.text = None
+            for child in el:
+                if child.tail is not None and not child.tail.strip():
+                    child.tail = None
+    referenced = _referenced(dom)
+    for defs in dom.iter('{%s}defs' % _svg_ns):
+        for el in list(defs):
+            if el.get('id') not in referenced and _local(el.tag) != 'style':
+                defs.remove(el)
+    # innermost first, so groups only holding empty groups go too
+    for el in reversed(list(dom.iter('{%s}g' % _svg_ns, '{%s}defs' % _svg_ns))):
+        if len(el) == 0 and not (el.text or '').strip() and el.get('id') not in referenced:
+            el.getparent().remove(el)
+    etree.cleanup_namespaces(dom)
+
+
+def optimize_svg(svg, precision=None):
+    """Strip what editors leave in an svg without changing how it renders:
+    comments, editor namespaces and metadata, unreferenced defs, empty
+    groups and insignificant whitespace, and round path and polygon
+    coordinates to precision decimals.
+
+    precision defaults to ICON_COMMONS_SVG_PRECISION, where None keeps the
+    coordinates. Returns svg (as str) untouched when optimization is off
+    (ICON_COMMONS_SVG_OPTIMIZE), it can't be parsed, declares an internal
+    DTD subset (entities) or nothing is saved.
+    """
+    svg = svg.decode('utf-8-sig') if isinstance(svg, bytes) else svg
+    if not getattr(settings, 'ICON_COMMONS_SVG_OPTIMIZE', True):
+        return svg
+    if precision is None:
+        precision = getattr(settings, 'ICON_COMMONS_SVG_PRECISION', 3)
+    try:
+        parser = etree.XMLParser(resolve_entities=False, huge_tree=False)
+        dom = etree.fromstring(svg.encode('utf-8'), parser)
+    except (etree.XMLSyntaxError, ValueError):
+        return svg
+    # serializing drops the internal subset, leaving its entities undefined
+    if _local(dom.tag) != 'svg' or dom.getroottree().docinfo.internalDTD is not None:
+        return svg
+    _optimize(dom, precision)
+    optimized = etree.tostring(dom, encoding='unicode')
+    return optimized if len(optimized) < len(svg) else svg
+
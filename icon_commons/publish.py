@@ -0,0 +1,167 @@
+from datetime import datetime
+from datetime import timedelta
+import gzip
+import json
+import os
+import tempfile
+
+from django.utils import timezone
+
+from icon_commons.export import current_versions
+from icon_commons.models import Collection
+from icon_commons.models import Icon
+from icon_commons.serializers import href_template
+
+
+# publish state kept in the output directory between runs
+_state_file = '.publish-state.json'
+
+# icons modified this long before the previous run started are looked at
+# again, covering transactions that committed after it read the database
+_overlap = timedelta(minutes=5)
+
+
+def write_atomic(path, data):
+    """Write data to path through a temporary file and a rename, so readers
+    see either the old or the new content."""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def remove(path):
+    for p in (path, path + '.gz'):
+        try:
+            os.unlink(p)
+        except FileNotFoundError:
+            pass
+
+
+class Publisher(object):
+    """Writes the current version of every icon under root, laid out like
+    the icon urls: <collection slug>/<icon slug> and icon/<id>, each with a
+    .gz next to it, plus a <collection slug>/index.json per collection and
+    collections.json.
+
+    The state of the last run is kept in root so reruns only write the
+    icons that changed, and remove the files of renamed or deleted ones.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.counts = {'written': 0, 'unchanged': 0, 'removed': 0, 'indexes': 0}
+
+    def load_state(self):
+        try:
+            with open(os.path.join(self.root, _state_file)) as fp:
+                state = json.load(fp)
+        except FileNotFoundError:
+            return {'published': None, 'icons': {}, 'collections': {}}
+        state['icons'] = dict((int(k), v) for k, v in state['icons'].items())
+        state['collections'] = dict((int(k), v) for k, v in state['collections'].items())
+        return state
+
+    def path(self, rel):
+        return os.path.join(self.root, *rel.split('/'))
+
+    def publish(self, full=False):
+        state = self.load_state()
+        started = timezone.now()
+        since = None
+        if state['published'] and not full:
+            since = datetime.fromisoformat(state['published']) - _overlap
+        collections = dict(Collection.objects.values_list('id', 'slug'))
+        changed = set()
+        # a collection slug change moves every icon in it
+        moved = [id for id, slug in state['collections'].items() if id in collections and collections[id] != slug]
+        seen = set()
+        for icons in [current_versions(since=since, gzip=True)] + [
+                current_versions(collection=id, gzip=True) for id in moved]:
+            for icon in icons:
+                if icon['id'] not in seen:
+                    seen.add(icon['id'])
+                    self.write_icon(state, icon, changed)
+        published = set(Icon.objects.filter(current__isnull=False).values_list('id', flat=True))
+        for id in [id for id in state['icons'] if id not in published]:
+            fqn, sha256, collection_id, version, name = state['icons'].pop(id)
+            remove(self.path(fqn))
+            remove(self.path('icon/%s' % id))
+            changed.add(collection_id)
+            self.counts['removed'] += 1
+        for id in set(state['collections']).difference(collections):
+            changed.add(id)
+        self.write_indexes(state, changed, collections)
+        state['published'] = started.isoformat()
+        write_atomic(os.path.join(self.root, _state_file), json.dumps(state).encode('utf-8'))
+        return self.counts
+
+    def write_icon(self, state, icon, changed):
+        if not icon['slug'] or not icon['collection']['slug']:
+            return
+        fqn = '%s/%s' % (icon['collection']['slug'], icon['slug'])
+        entry = [fqn, icon['sha256'], icon['collection']['id'], icon['version'], icon['name']]
+        old = state['icons'].get(icon['id'], None)
+        if old == entry:
+            self.counts['unchanged'] += 1
+            return
+        svg = icon['svg'].encode('utf-8')
+        compressed = icon['gzip']
+        if compressed is None:
+            compressed = gzip.compress(svg, 9, mtime=0)
+        for rel in (fqn, 'icon/%s' % icon['id']):
+            write_atomic(self.path(rel), svg)
+            write_atomic(self.path(rel) + '.gz', bytes(compressed))
+        if old is not None:
+            if old[0] != fqn:
+                remove(self.path(old[0]))
+            changed.add(old[2])
+        state['icons'][icon['id']] = entry
+        changed.add(icon['collection']['id'])
+        self.counts['written'] += 1
+
+    def write_indexes(self, state, changed, collections):
+        if not changed:
+            return
+        href = href_template('iconcommons_icon_view', 'id')
+        icons = {}
+        for id, entry in state['icons'].items():
+            if entry[2] in changed:
+                icons.setdefault(entry[2], []).append((id, entry))
+        for collection_id in changed:
+            old_slug = state['collections'].pop(collection_id, None)
+            if old_slug and old_slug != collections.get(collection_id):
+                remove(self.path('%s/index.json' % old_slug))
+            if collection_id not in collections:
+                continue
+            slug = collections[collection_id]
+            state['collections'][collection_id] = slug
+            if not slug:
+                continue
+            index = {
+                'id': collection_id,
+                'slug': slug,
+                'icons': [{
+                    'id': id,
+                    'name': name,
+                    'version': version,
+                    'sha256': sha256,
+                    'path': fqn,
+                    'href': href % id,
+                } for id, (fqn, sha256, c, version, name) in sorted(icons.get(collection_id, []))],
+            }
+            write_atomic(self.path('%s/index.json' % slug), json.dumps(index).encode('utf-8'))
+            self.counts['indexes'] += 1
+        counts = {}
+        for entry in state['icons'].values():
+            counts[entry[2]] = counts.get(entry[2], 0) + 1
+        index = [{'id': id, 'slug': slug, 'icons': counts.get(id, 0), 'index': '%s/index.json' % slug}
+                 for id, slug in sorted(state['collections'].items()) if slug]
+        write_atomic(os.path.join(self.root, 'collections.json'), json.dumps(index).encode('utf-8'))
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from icon_commons.models import Collection
+from icon_commons.models import Icon
+
+
+# bumped in the shared cache on every icon or collection write, entries
+# cached under an older generation are ignored by every process
+_generation_key = 'icon_commons:fqn-generation'
+
+# default number of names kept in the in-process LRU
+_default_size = 10000
+
+
+class FQNResolver(object):
+    """Resolves <collection slug>/<icon slug> names to
+    (icon id, IconData id, version, sha256, modified) of the current version.
+
+    Names are kept in a size bounded in-process LRU in front of a Django
+    cache, both dropped wholesale whenever an icon or collection changes.
+    Names without a current version aren't cached.
+    """
+
+    def __init__(self, alias, size):
+        self.alias = alias
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._generation = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation(self):
+        generation = self.cache.get(_generation_key)
+        if generation is None:
+            self.cache.add(_generation_key, 1, None)
+            generation = self.cache.get(_generation_key)
+        return generation
+
+    def resolve(self, collection, icon):
+        """Return the resolved tuple for the name, None if there is no such
+        icon or it has no versions."""
+        generation = self.generation()
+        name = (collection, icon)
+        with self._lock:
+            if self._generation != generation:
+                self._entries.clear()
+                self._generation = generation
+            entry = self._entries.get(name, None)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        key = 'icon_commons:fqn:%s:%s/%s' % (generation, collection, icon)
+        entry = self.cache.get(key)
+        if entry is None:
+            # from the primary, a lagging replica's answer would stay cached
+            entry = Icon.objects.using(DEFAULT_DB_ALIAS).filter(
+                collection__slug=collection, slug=icon, current__isnull=False).values_list(
+                'id', 'current_id', 'current_version', 'current__sha256', 'current__modified').first()
+            if entry is None:
+                return None
+            self.cache.set(key, entry)
+        with self._lock:
+            if self._generation == generation:
+                self._entries[name] = entry
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        try:
+            self.cache.incr(_generation_key)
+        except ValueError:
+            self.cache.add(_generation_key, 1, None)
+        with self._lock:
+            self._entries.clear()
+            self._generation = None
+
+    def stats(self):
+        return {
+            'backend': self.alias,
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'size': self.size,
+        }
+
+
+_resolver = None
+
+
+def get_resolver():
+    """Return the configured FQNResolver, or None if it is disabled.
+
+    The resolver answers revalidations without reading the database, so it
+    is only enabled when ICON_COMMONS_RESOLVER_CACHE names a Django cache
+    shared by every process (memcached, redis, database); invalidations
+    wouldn't reach the other processes of a per-process cache and they'd
+    keep answering 304 for replaced versions. ICON_COMMONS_FQN_CACHE_SIZE
+    bounds the in-process LRU (0 disables the resolver).
+    """
+    global _resolver
+    if _resolver is None:
+        alias = getattr(settings, 'ICON_COMMONS_RESOLVER_CACHE', None)
+        size = getattr(settings, 'ICON_COMMONS_FQN_CACHE_SIZE', _default_size)
+        if not alias or not size:
+            return None
+        _resolver = FQNResolver(alias, size)
+    return _resolver
+
+
+@receiver(setting_changed)
+def _reset_resolver(setting, **kwargs):
+    global _resolver
+    if setting in ('ICON_COMMONS_FQN_CACHE_SIZE', 'ICON_COMMONS_RESOLVER_CACHE'):
+        _resolver = None
+
+
+def invalidate(using=None):
+    """Drop every resolved name, now and again once the transaction commits
+    so readers can't cache the rows it replaces in between."""
+    resolver = get_resolver()
+    if resolver is not None:
+        resolver.invalidate()
+        transaction.on_commit(resolver.invalidate, using=using)
+
+
+@receiver(post_save, sender=Icon)
+@receiver(post_save, sender=Collection)
+def _saved(sender, instance, using, **kwargs):
+    invalidate(using)
+
+
+@receiver(post_delete, sender=Icon)
+@receiver(post_delete, sender=Collection)
+def _deleted(sender, instance, using, **kwargs):
+    invalidate(using)
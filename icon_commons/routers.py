@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+
+
+# set on responses to users who just wrote, their reads stay on the primary
+# while it lasts
+pin_cookie = 'icon_commons_primary'
+
+_local = threading.local()
+
+
+class ReplicaRouter(object):
+    """Sends the reads of views wrapped in views.replica_reads to the read
+    replica picked for the request. Everything else, writes included, is
+    left to the default database.
+
+    Add 'icon_commons.routers.ReplicaRouter' to DATABASE_ROUTERS and list
+    the replica aliases in ICON_COMMONS_READ_REPLICAS.
+    """
+
+    def db_for_read(self, model, **hints):
+        return getattr(_local, 'alias', None)
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        aliases = set([DEFAULT_DB_ALIAS]).union(replica_aliases())
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+@contextmanager
+def reading_from(alias):
+    """Route the reads of the current thread to alias."""
+    previous = getattr(_local, 'alias', None)
+    _local.alias = alias
+    try:
+        yield
+    finally:
+        _local.alias = previous
+
+
+def replica_aliases():
+    return getattr(settings, 'ICON_COMMONS_READ_REPLICAS', ())
+
+
+class ReplicaSelector(object):
+    """Picks the replica for a request.
+
+    'round-robin' rotates through the replicas that haven't failed in the
+    last retry_after seconds, None (the primary) if they all have.
+    'least-recently-failed' picks the replica whose last failure is the
+    oldest, rotating between those that never failed.
+    """
+
+    def __init__(self, aliases, mode='round-robin', retry_after=30):
+        if mode not in ('round-robin', 'least-recently-failed'):
+            raise ValueError('ICON_COMMONS_REPLICA_SELECTION must be round-robin or least-recently-failed')
+        self.aliases = list(aliases)
+        self.mode = mode
+        self.retry_after = retry_after
+        self.failed = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            if not self.aliases:
+                return None
+            n = len(self.aliases)
+            rotation = [self.aliases[(self._next + i) % n] for i in range(n)]
+            self._next = (self._next + 1) % n
+            if self.mode == 'least-recently-failed':
+                return min(rotation, key=lambda alias: self.failed.get(alias, 0))
+            now = time.time()
+            for alias in rotation:
+                if now - self.failed.get(alias, 0) >= self.retry_after:
+                    return alias
+            return None
+
+    def mark_failed(self, alias):
+        with self._lock:
+            self.failed[alias] = time.time()
+
+
+_selector = None
+
+
+def get_selector():
+    """Return the configured ReplicaSelector, None without replicas.
+
+    ICON_COMMONS_REPLICA_SELECTION is the selection mode and
+    ICON_COMMONS_REPLICA_RETRY_SECONDS how long round-robin skips a
+    replica after it failed.
+    """
+    global _selector
+    if _selector is None:
+        aliases = replica_aliases()
+        if not aliases:
+            return None
+        _selector = ReplicaSelector(aliases, getattr(settings, 'ICON_COMMONS_REPLICA_SELECTION', 'round-robin'),
+                                    getattr(settings, 'ICON_COMMONS_REPLICA_RETRY_SECONDS', 30))
+    return _selector
+
+
+@receiver(setting_changed)
+def _reset_selector(setting, **kwargs):
+    global _selector
+    if setting.startswith('ICON_COMMONS_REPLICA') or setting == 'ICON_COMMONS_READ_REPLICAS':
+        _selector = None
+
+
+def read_alias(request):
+    """The replica to read from for request, None for the primary."""
+    if pin_cookie in request.COOKIES:
+        return None
+    selector = get_selector()
+    return selector.choose() if selector is not None else None
+
+
+def pin_to_primary(response):
+    """Keep the reads of whoever gets response on the primary for
+    ICON_COMMONS_READ_YOUR_WRITES_SECONDS, so what they just wrote shows up
+    before the replicas catch up."""
+    if replica_aliases():
+        response.set_cookie(pin_cookie, '1', max_age=getattr(settings, 'ICON_COMMONS_READ_YOUR_WRITES_SECONDS', 10),
+                            httponly=True, samesite='Lax')
+    return response
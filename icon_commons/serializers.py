@@ -0,0 +1,135 @@
+from django.contrib.contenttypes.models import ContentType
+from django.urls import reverse
+from taggit.models import TaggedItem
+
+from icon_commons.models import Collection
+from icon_commons.models import Icon
+from icon_commons.models import IconData
+
+
+_sentinel = '9191919191'
+
+
+def href_template(viewname, kwarg):
+    """Reverse viewname once into a %-format string taking the kwarg value."""
+    url = reverse(viewname, kwargs={kwarg: _sentinel})
+    return url.replace('%', '%%').replace(_sentinel, '%s')
+
+
+def requested_fields(request, allowed):
+    """The optional fields asked for with fields=a,b (or repeated fields=)."""
+    fields = set(f.strip() for v in request.GET.getlist('fields') for f in v.split(','))
+    return [f for f in allowed if f in fields]
+
+
+def tags_by_icon(ids):
+    """Tag names of the icons ids in one query, as a dict of id to names."""
+    tags = dict((id, []) for id in ids)
+    items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Icon), object_id__in=ids)
+    for id, name in items.values_list('object_id', 'tag__name').order_by('tag__name'):
+        tags[id].append(name)
+    return tags
+
+
+class IconSerializer(object):
+    """Encodes Icon values() rows for the icon listings.
+
+    tags, version (the current one) and modified can be asked for on top of
+    name, owner and href; tags cost one query per page.
+    """
+
+    fields = ('tags', 'version', 'modified')
+
+    def __init__(self, fields=()):
+        self.requested = fields
+        self.href = href_template('iconcommons_icon_view', 'id')
+        self.tags = {}
+
+    def columns(self):
+        columns = ['id', 'name', 'owner__username']
+        if 'version' in self.requested:
+            columns.append('current_version')
+        if 'modified' in self.requested:
+            columns.append('modified')
+        return columns
+
+    def values(self, queryset=None):
+        return (Icon.objects.all() if queryset is None else queryset).values(*self.columns())
+
+    def prepare(self, rows):
+        if 'tags' in self.requested:
+            self.tags = tags_by_icon([r['id'] for r in rows])
+
+    def encode(self, row):
+        data = {
+            'name': row['name'],
+            'owner': row['owner__username'],
+            'href': self.href % row['id'],
+        }
+        if 'tags' in self.requested:
+            data['tags'] = self.tags.get(row['id'], [])
+        if 'version' in self.requested:
+            data['version'] = row['current_version']
+        if 'modified' in self.requested:
+            data['modified'] = row['modified'].isoformat()
+        return data
+
+
+class CollectionSerializer(object):
+    """Encodes Collection values() rows with their icon counts."""
+
+    def __init__(self):
+        self.href = href_template('iconcommons_collection_icons', 'collection')
+
+    def values(self):
+        return Collection.objects.values('id', 'name', 'icon_count')
+
+    def prepare(self, rows):
+        pass
+
+    def encode(self, row):
+        return {
+            'name': row['name'],
+            'icons': row['icon_count'],
+            'href': self.href % row['id'],
+        }
+
+
+def icon_row(id):
+    """The Icon values() row icon_info needs, None if there is no such icon."""
+    return Icon.objects.filter(id=id).values('id', 'name', 'collection_id', 'collection__name', 'collection__modified',
+                                             'modified').first()
+
+
+def icon_tags(id):
+    """The (tag id, name) of the tags of an icon."""
+    tags = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Icon), object_id=id)
+    return tuple(tags.values_list('tag_id', 'tag__name'))
+
+
+def icon_info(id, icon=None, tags=None):
+    """The IconInfoView document of an icon in three queries, one less for
+    each of its icon_row and icon_tags passed.
+
+    Raises Icon.DoesNotExist.
+    """
+    if icon is None:
+        icon = icon_row(id)
+        if icon is None:
+            raise Icon.DoesNotExist('Icon matching query does not exist.')
+    versions = IconData.objects.filter(icon_id=id).values_list('version', 'modified', 'change_log')
+    if tags is None:
+        tags = icon_tags(id)
+    return {
+        'collection': {
+            'id': icon['collection_id'],
+            'name': icon['collection__name']
+        },
+        'name': icon['name'],
+        'versions': [{
+            'version': version,
+            'modified': modified.isoformat(),
+            'changelog': change_log,
+        } for version, modified, change_log in versions],
+        'tags': [{'id': t, 'name': name} for t, name in tags]
+    }
@@ -0,0 +1,383 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import threading
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from taggit.models import Tag
+from taggit.models import TaggedItem
+
+from icon_commons.models import Icon
+
+
+# bumped in the shared cache on every committed change so all processes
+# notice when their copy of the index is behind
+_version_key = 'icon_commons:tag-index-version'
+
+
+def _grams(folded):
+    return set(folded[i:i + 3] for i in range(len(folded) - 2))
+
+
+def _insert(ids, id):
+    i = bisect_left(ids, id)
+    if i == len(ids) or ids[i] != id:
+        ids.insert(i, id)
+
+
+def _remove(ids, id):
+    i = bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        del ids[i]
+
+
+def _contains(ids, id):
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+
+def _intersect(postings):
+    postings = sorted(postings, key=len)
+    if not postings:
+        return set()
+    ids = set(postings[0])
+    for other in postings[1:]:
+        if not ids:
+            break
+        if isinstance(other, array) and len(ids) * 16 < len(other):
+            # probe the long array instead of walking it
+            ids = set(i for i in ids if _contains(other, i))
+        else:
+            ids.intersection_update(other)
+    return ids
+
+
+class TagIndex(object):
+    """In-process index of the tags applied to icons.
+
+    The ids of the icons carrying a tag, and of the icons in a collection,
+    are kept as sorted arrays for filtering and facet counts. Case folded
+    tag names are kept in a sorted list for prefix lookups and in trigram
+    postings for substring lookups.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        # tag name -> icon ids
+        self._tagged = {}
+        # collection id -> icon ids
+        self._collections = {}
+        # icon id -> (name, id, collection id), also the listing sort key
+        self._icons = {}
+        # icon id -> tag names
+        self._tags = {}
+        self._keys = []
+        self._grams = {}
+
+    def load(self, icons, items, version=None):
+        """Fill the index from (id, name, collection id) icons and
+        (icon id, tag name) items."""
+        with self._lock:
+            self._clear()
+            self.update(icons=icons, added=items)
+            self.version = version
+
+    def update(self, icons=(), deleted=(), added=(), removed=()):
+        """Apply changed or new (id, name, collection id) icons, deleted icon
+        ids and added or removed (icon id, tag name) items."""
+        with self._lock:
+            for id, name, collection_id in icons:
+                old = self._icons.get(id)
+                if old is not None:
+                    _remove(self._collections[old[2]], id)
+                self._icons[id] = (name, id, collection_id)
+                _insert(self._collections.setdefault(collection_id, array('l')), id)
+            for id in deleted:
+                old = self._icons.pop(id, None)
+                if old is not None:
+                    _remove(self._collections[old[2]], id)
+                for name in self._tags.get(id, set()).copy():
+                    self._untag(id, name)
+            for id, name in added:
+                if id in self._icons and name not in self._tags.get(id, ()):
+                    self._tags.setdefault(id, set()).add(name)
+                    ids = self._tagged.get(name)
+                    if ids is None:
+                        ids = self._tagged[name] = array('l')
+                        self._insert_name(name)
+                    _insert(ids, id)
+            for id, name in removed:
+                if name in self._tags.get(id, ()):
+                    self._untag(id, name)
+
+    def _untag(self, id, name):
+        tags = self._tags[id]
+        tags.discard(name)
+        if not tags:
+            del self._tags[id]
+        ids = self._tagged[name]
+        _remove(ids, id)
+        if not ids:
+            del self._tagged[name]
+            self._remove_name(name)
+
+    def _insert_name(self, name):
+        key = (name.casefold(), name)
+        self._keys.insert(bisect_left(self._keys, key), key)
+        for gram in _grams(key[0]):
+            self._grams.setdefault(gram, set()).add(name)
+
+    def _remove_name(self, name):
+        key = (name.casefold(), name)
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+        for gram in _grams(key[0]):
+            names = self._grams.get(gram)
+            names.discard(name)
+            if not names:
+                del self._grams[gram]
+
+    def count(self, name):
+        return len(self._tagged.get(name, ()))
+
+    def key(self, id):
+        """The (name, id) listing order key of an icon."""
+        return self._icons.get(id, ('', id))[:2]
+
+    def search(self, query, limit=None):
+        """Tag names starting with query, or containing it if it is longer
+        than 3 characters, most used first."""
+        folded = query.casefold()
+        with self._lock:
+            if len(query) > 3:
+                names = self._containing(folded)
+            else:
+                names = self._starting(folded)
+            names = sorted(names, key=lambda n: (-self.count(n), n.casefold(), n))
+        return names[:limit] if limit is not None else names
+
+    def _starting(self, folded):
+        names = []
+        for i in range(bisect_left(self._keys, (folded,)), len(self._keys)):
+            key, name = self._keys[i]
+            if not key.startswith(folded):
+                break
+            names.append(name)
+        return names
+
+    def _containing(self, folded):
+        postings = sorted((self._grams.get(g, ()) for g in _grams(folded)), key=len)
+        if not postings or not postings[0]:
+            return []
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return [name for name in candidates if folded in name.casefold()]
+
+    def filter(self, tags=(), collection=None, match_all=False):
+        """Ids of the icons tagged with any (or all) of tags, limited to a
+        collection id, ordered by icon name."""
+        with self._lock:
+            postings = []
+            if tags:
+                tagged = [self._tagged.get(t, ()) for t in set(tags)]
+                if match_all:
+                    postings.extend(tagged)
+                else:
+                    postings.append(set().union(*tagged))
+            if collection is not None:
+                postings.append(self._collections.get(collection, ()))
+            ids = _intersect(postings) if postings else self._icons
+            return sorted(ids, key=self._icons.__getitem__)
+
+    def facets(self, ids, exclude=(), limit=None):
+        """(tag name, count) of the tags on the icons ids, most used first."""
+        with self._lock:
+            counts = Counter()
+            for id in ids:
+                counts.update(self._tags.get(id, ()))
+        for name in exclude:
+            counts.pop(name, None)
+        return sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
+
+
+def load_rows():
+    """The icons and tagged items to load a TagIndex with, from the primary
+    database so replica lag doesn't end up in the shared index."""
+    icons = Icon.objects.using(DEFAULT_DB_ALIAS).values_list('id', 'name', 'collection_id')
+    items = TaggedItem.objects.using(DEFAULT_DB_ALIAS).filter(content_type=ContentType.objects.get_for_model(Icon)).values_list(
+        'object_id', 'tag__name')
+    return icons, items
+
+
+def enabled():
+    """Whether tag lookups are answered by the in-process index. Only when
+    ICON_COMMONS_TAG_INDEX_CACHE names a cache every process shares, which
+    tells each process its copy is behind; they are database queries
+    otherwise."""
+    return getattr(settings, 'ICON_COMMONS_TAG_INDEX_CACHE', None) is not None
+
+
+def _cache():
+    return caches[settings.ICON_COMMONS_TAG_INDEX_CACHE]
+
+
+def current_version():
+    """The shared version of the index, changes with every committed tag,
+    icon name or collection change. None if the index is disabled."""
+    if not enabled():
+        return None
+    cache = _cache()
+    version = cache.get(_version_key)
+    if version is None:
+        cache.add(_version_key, 1, None)
+        version = cache.get(_version_key)
+    return version
+
+
+_index = TagIndex()
+
+
+def get_tag_index():
+    """Return the process wide TagIndex, reloading it if another process
+    (or a change that couldn't be applied in place) moved the version on.
+    None if the index is disabled."""
+    if not enabled():
+        return None
+    version = current_version()
+    if _index.version is None or _index.version != version:
+        with _index._lock:
+            if _index.version is None or _index.version != version:
+                icons, items = load_rows()
+                _index.load(icons, items, version)
+    return _index
+
+
+def invalidate():
+    """Make every process reload its index on the next use."""
+    if not enabled():
+        return
+    cache = _cache()
+    try:
+        cache.incr(_version_key)
+    except ValueError:
+        cache.add(_version_key, 1, None)
+    _index.version = None
+
+
+def _apply(icons, deleted, added, removed):
+    if not enabled():
+        return
+    cache = _cache()
+    try:
+        version = cache.incr(_version_key)
+    except ValueError:
+        version = None
+    with _index._lock:
+        if version is not None and _index.version is not None and version == _index.version + 1:
+            names = {}
+            if added or removed:
+                names = dict(Tag.objects.filter(id__in=set(t for t, i in added + removed)).values_list('id', 'name'))
+            _index.update(icons, deleted, [(i, names[t]) for t, i in added if t in names],
+                          [(i, names[t]) for t, i in removed if t in names])
+            _index.version = version
+        else:
+            _index.version = None
+
+
+def index_changed(icons=(), deleted=(), added=(), removed=(), using=None):
+    """Record changes to apply to the index once the transaction commits.
+
+    icons are (id, name, collection id) of new or changed icons, deleted are
+    icon ids, added and removed are (tag id, icon id) items. Code writing
+    Icon or TaggedItem rows without signals (bulk_create, update) has to
+    call this, see importer.bulk_import.
+    """
+    if not enabled():
+        return
+    icons, deleted, added, removed = list(icons), list(deleted), list(added), list(removed)
+    if icons or deleted or added or removed:
+        transaction.on_commit(lambda: _apply(icons, deleted, added, removed), using=using)
+
+
+@receiver(setting_changed)
+def _reset_index(setting, **kwargs):
+    if setting == 'ICON_COMMONS_TAG_INDEX_CACHE':
+        # changes went unrecorded while it was off
+        _index.version = None
+
+
+def search(query, limit=None):
+    """Tag names of icons starting with query, or containing it if it is
+    longer than 3 characters, most used first."""
+    index = get_tag_index()
+    if index is not None:
+        return index.search(query, limit)
+    lookup = 'name__icontains' if len(query) > 3 else 'name__istartswith'
+    tags = TaggedItem.tags_for(Icon).filter(**{lookup: query}).annotate(count=Count('taggit_taggeditem_items'))
+    names = tags.order_by('-count', 'name').values_list('name', flat=True)
+    return list(names[:limit] if limit is not None else names)
+
+
+def facets(icons, exclude=(), limit=None):
+    """(tag name, count) of the tags on the icons, a list of ids when they
+    came from the index, a queryset otherwise, most used first."""
+    index = get_tag_index()
+    if index is not None:
+        return index.facets(icons, exclude, limit)
+    items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Icon),
+                                      object_id__in=icons.values('id')).exclude(tag__name__in=exclude)
+    counts = items.values('tag__name').annotate(count=Count('id')).order_by('-count', 'tag__name')
+    counts = counts.values_list('tag__name', 'count')
+    return list(counts[:limit] if limit is not None else counts)
+
+
+def _is_icon_item(item):
+    return item.content_type_id == ContentType.objects.get_for_model(Icon).id
+
+
+@receiver(post_save, sender=Icon)
+def _icon_saved(sender, instance, created, update_fields, using, **kwargs):
+    if update_fields is None or {'name', 'collection'}.intersection(update_fields):
+        index_changed(icons=[(instance.id, instance.name, instance.collection_id)], using=using)
+
+
+@receiver(post_delete, sender=Icon)
+def _icon_deleted(sender, instance, using, **kwargs):
+    index_changed(deleted=[instance.id], using=using)
+
+
+@receiver(post_save, sender=TaggedItem)
+def _tagged_item_saved(sender, instance, created, using, **kwargs):
+    if created and _is_icon_item(instance):
+        index_changed(added=[(instance.tag_id, instance.object_id)], using=using)
+
+
+@receiver(post_delete, sender=TaggedItem)
+def _tagged_item_deleted(sender, instance, using, **kwargs):
+    if _is_icon_item(instance):
+        index_changed(removed=[(instance.tag_id, instance.object_id)], using=using)
+
+
+@receiver(post_save, sender=Tag)
+def _tag_saved(sender, instance, created, using, **kwargs):
+    # a rename, the index is keyed by name
+    if not created:
+        transaction.on_commit(invalidate, using=using)
+
+
+@receiver(post_delete, sender=Tag)
+def _tag_deleted(sender, instance, using, **kwargs):
+    transaction.on_commit(invalidate, using=using)
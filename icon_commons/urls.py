@@ -1,19 +1,27 @@
 from django.conf.urls import url
 from icon_commons.views import SearchTags
 from icon_commons.views import CollectionList
+from icon_commons.views import ExportView
 from icon_commons.views import IconList
 from icon_commons.views import IconView
 from icon_commons.views import IconInfoView
+from icon_commons.views import IconSprite
+from icon_commons.views import MetricsView
+from icon_commons.views import UploadJobView
 from icon_commons.views import upload
 
 
 urlpatterns = [
     url(r'^$', upload, name='upload'),
+    url(r'^jobs/(?P<id>\d+)$', UploadJobView.as_view(), name='iconcommons_upload_job'),
     url(r'^search/tags$', SearchTags.as_view(), name='iconcommons_search_tags'),
     url(r'^collections$', CollectionList.as_view(), name='iconcommons_collection_list'),
     url(r'^collections/(?P<collection>[-\w\d]+)$', IconList.as_view(), name='iconcommons_collection_icons'),
     url(r'^icon$', IconList.as_view(), name='iconcommons_icon_list'),
+    url(r'^export$', ExportView.as_view(), name='iconcommons_export'),
+    url(r'^metrics$', MetricsView.as_view(), name='iconcommons_metrics'),
     url(r'^icon/(?P<id>\d+)/info$', IconInfoView.as_view(), name='iconcommons_icon_info_view'),
+    url(r'^icon/sprite$', IconSprite.as_view(), name='iconcommons_icon_sprite'),
     url(r'^icon/(?P<id>\d+)$', IconView.as_view(), name='iconcommons_icon_view'),
     url(r'^(?P<collection>[-\w\d]+)/(?P<icon>[-\w\d]+)$', IconView.as_view(), name='iconcommons_icon_by_fqn'),
 ]
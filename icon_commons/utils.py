@@ -1,10 +1,51 @@
+from django.conf import settings
 from lxml import etree
+import gzip
+import hashlib
 import re
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 _shape_paths = '|'.join(['//svg:%s' % e for e in ('path', 'polygon', 'circle', 'ellipse', 'rect', 'line', 'polyline')])
 
 
+def svg_hash(svg):
+    if isinstance(svg, str):
+        svg = svg.encode('utf-8')
+    return hashlib.sha256(svg).hexdigest()
+
+
+def derived_hash(sha256, params):
+    # content hash of process_svg(svg, params) given the hash of svg
+    return hashlib.sha256(('%s:%s:%s' % ((sha256,) + recolor_params(params))).encode('utf-8')).hexdigest()
+
+
+def compress_svg(data, best=True):
+    """Return gzip and brotli (if available) encodings of the svg bytes.
+
+    best trades time for size, for variants compressed once and stored, at
+    brotli quality ICON_COMMONS_BROTLI_QUALITY. An encoding that doesn't
+    make the body smaller is None.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    quality = getattr(settings, 'ICON_COMMONS_BROTLI_QUALITY', 9) if best else 5
+    encoded = {
+        'gzip': gzip.compress(data, 9 if best else 6, mtime=0),
+        'br': brotli.compress(data, quality=quality) if brotli else None,
+    }
+    return dict((k, v if v is not None and len(v) < len(data) else None) for k, v in encoded.items())
+
+
+def recolor_params(params):
+    # the only request params that affect process_svg output
+    return params.get('fill', None) or '', params.get('stroke', None) or ''
+
+
 # @todo testme
 def process_svg(svg, params):
     # @todo this mostly works
@@ -22,6 +63,58 @@ def process_svg(svg, params):
     return etree.tostring(dom)
 
 
+# placeholders substituted for the recolor values while compiling a template
+_fill_slot = 'iconcommonsfillslot'
+_stroke_slot = 'iconcommonsstrokeslot'
+# separates the per-mode outputs, never present in serialized xml
+_mode_separator = '\x1e'
+# values lxml serializes verbatim inside an attribute, anything else falls
+# back to process_svg so the output stays byte-identical
+_safe_value = re.compile(r'^[-#\w.,%() ]*$', re.ASCII)
+
+
+def compile_svg(svg):
+    """Precompute process_svg output for each combination of fill/stroke.
+
+    The outputs for no recolor, fill, stroke and fill+stroke are joined by
+    a separator with placeholders marking the slots a recolor replaces.
+    Returns None if the svg can't be processed.
+    """
+    if not isinstance(svg, str) or _fill_slot in svg or _stroke_slot in svg:
+        return None
+    outputs = []
+    for stroke in ('', _stroke_slot):
+        for fill in ('', _fill_slot):
+            try:
+                outputs.append(process_svg(svg, {'fill': fill, 'stroke': stroke}).decode('ascii'))
+            except Exception:
+                return None
+    return _mode_separator.join(outputs)
+
+
+def render_template(template, params):
+    """Render a compile_svg template, matching process_svg(svg, params).
+
+    Returns None if the values can't be rendered from the template.
+    """
+    fill, stroke = recolor_params(params)
+    if not (_safe_value.match(fill) and _safe_value.match(stroke)):
+        return None
+    # a value holding a placeholder would be substituted again
+    if any(slot in value for slot in (_fill_slot, _stroke_slot) for value in (fill, stroke)):
+        return None
+    start = 0
+    for _ in range(bool(fill) + 2 * bool(stroke)):
+        start = template.index(_mode_separator, start) + 1
+    end = template.find(_mode_separator, start)
+    out = template[start:end if end != -1 else None]
+    if fill:
+        out = out.replace(_fill_slot, fill)
+    if stroke:
+        out = out.replace(_stroke_slot, stroke)
+    return out.encode('ascii')
+
+
 def process_element(element, replacers):
     style = element.get('style')
     if style:
@@ -66,3 +159,34 @@ class StrokeReplacer(StyleReplacer):
 
     def should_replace(self, styles):
         return True
+
+
+_svg_ns = 'http://www.w3.org/2000/svg'
+_length = re.compile(r'^\s*([\d.]+)\s*(px)?\s*$')
+
+
+def svg_symbol(svg, id):
+    """Convert an svg document into a <symbol> element with the given id."""
+    if isinstance(svg, str):
+        svg = svg.encode('utf-8')
+    dom = etree.fromstring(svg)
+    symbol = etree.Element('{%s}symbol' % _svg_ns, nsmap={None: _svg_ns})
+    symbol.set('id', id)
+    view_box = dom.get('viewBox')
+    if view_box is None:
+        width, height = [_length.match(dom.get(a, '')) for a in ('width', 'height')]
+        if width and height:
+            view_box = '0 0 %s %s' % (width.group(1), height.group(1))
+    if view_box is not None:
+        symbol.set('viewBox', view_box)
+    if dom.get('preserveAspectRatio') is not None:
+        symbol.set('preserveAspectRatio', dom.get('preserveAspectRatio'))
+    symbol.extend(list(dom))
+    return symbol
+
+
+def svg_sprite(symbols):
+    """Serialize symbol elements into a single svg sprite document."""
+    sprite = etree.Element('{%s}svg' % _svg_ns, nsmap={None: _svg_ns})
+    sprite.extend(symbols)
+    return etree.tostring(sprite)
@@ -1,46 +1,87 @@
+from bisect import bisect_right
+import logging
 import os
-from tempfile import mkstemp
 import os.path
 from django.contrib import messages
-from django.db import connection
+from django.db import InterfaceError
+from django.db import OperationalError
+from django.db import transaction
+from django.conf import settings
+from django.core.cache import caches
 from django.db.models import Count
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Q
+from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.http import HttpResponseNotModified
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.template.defaultfilters import slugify
+from django.utils.http import quote_etag
 from django.views.generic.base import View
 from django.views.generic.base import ContextMixin
 from django.views.generic.list import MultipleObjectMixin
+from django.core.paginator import InvalidPage
+from django.core.paginator import Paginator
 
 from icon_commons.models import Collection
 from icon_commons.models import Icon
 from icon_commons.models import IconData
+from icon_commons.models import UploadJob
 from icon_commons.forms import IconForm
-from icon_commons.utils import process_svg
-from taggit.models import TaggedItem
+from icon_commons.export import current_versions
+from icon_commons.export import formats
+from icon_commons.export import parse_since
+from icon_commons.importer import bulk_import
+from icon_commons.importer import chunks
+from icon_commons.importer import prepare_svg
+from icon_commons.importer import read_zip
+from icon_commons.jobs import enqueue
+from icon_commons.jobs import job_mode
+from icon_commons.cache import get_render_cache
+from icon_commons.cache import render_svg
+from icon_commons.metrics import phase
+from icon_commons.metrics import registry
+from icon_commons.resolver import get_resolver
+from icon_commons.routers import get_selector
+from icon_commons.routers import pin_to_primary
+from icon_commons.routers import read_alias
+from icon_commons.routers import reading_from
+from icon_commons.serializers import CollectionSerializer
+from icon_commons.serializers import IconSerializer
+from icon_commons.serializers import icon_info
+from icon_commons.serializers import icon_tags
+from icon_commons.serializers import icon_row
+from icon_commons.serializers import requested_fields
+from icon_commons import tagindex
+from icon_commons.tagindex import current_version
+from icon_commons.tagindex import get_tag_index
+from icon_commons.utils import derived_hash
+from icon_commons.utils import svg_hash
+from icon_commons.utils import svg_symbol
+from icon_commons.utils import svg_sprite
+from lxml import etree
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+import hashlib
 import json
+import re
 from datetime import datetime
-import zipfile
-from django.shortcuts import render_to_response
+from django.shortcuts import get_object_or_404
+from django.shortcuts import render
 from django.http import HttpResponseRedirect
-from django.template import RequestContext
-from django.core.exceptions import ObjectDoesNotExist
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 
-_date_fmt = '%a, %d %b %Y %H:%M:%S GMT'
-
+logger = logging.getLogger(__name__)
 
-# can be used around a function to debug db queries. to wrap a generic view:
-# ViewClass.func = debug_queries(ViewClass.get)
-def debug_queries(func):
-    def inner(*args, **kw):
-        from django.conf import settings
-        settings.DEBUG = True
-        connection.queries = []
-        resp = func(*args, **kw)
-        print(len(connection.queries))
-        return resp
-
-    return inner
+_date_fmt = '%a, %d %b %Y %H:%M:%S GMT'
 
 
 def cors(cls):
@@ -56,30 +97,171 @@ def cors(cls):
     return cls
 
 
+def replica_reads(cls):
+    """Send the reads of a read only view to a replica, see
+    icon_commons.routers. The view is answered from the primary instead if
+    the replica fails."""
+    get = cls.get
+
+    def inner(self, request, *args, **kw):
+        alias = read_alias(request)
+        if alias is None:
+            return get(self, request, *args, **kw)
+        try:
+            with reading_from(alias):
+                return get(self, request, *args, **kw)
+        except (OperationalError, InterfaceError):
+            get_selector().mark_failed(alias)
+            logger.warning('read replica %s failed, reading from the primary', alias, exc_info=True)
+            return get(self, request, *args, **kw)
+
+    cls.get = inner
+    return cls
+
+
+def json_etag(request, parts):
+    """An ETag for a JSON response from the request and the validator parts."""
+    params = sorted((k, request.GET.getlist(k)) for k in request.GET)
+    return quote_etag(hashlib.sha1(repr((request.path, params, parts)).encode('utf-8')).hexdigest())
+
+
+def json_cache():
+    alias = getattr(settings, 'ICON_COMMONS_JSON_CACHE_ALIAS', None)
+    return caches[alias] if alias else None
+
+
 class JSONMixin(ContextMixin):
     def get(self, request, *args, **kwargs):
-        context = self.get_context_data(**kwargs)
-        data = self.get_json_data(context)
-        callback = request.GET.get('callback', None)
-        if callback:
-            return HttpResponse('%s(%s);' % (callback, json.dumps(data)), content_type='application/javascript')
-        else:
-            return HttpResponse(json.dumps(data), content_type='application/json')
+        # answer revalidations before building anything
+        validator = self.get_validator(**kwargs)
+        etag = modified = cached = None
+        if validator is not None:
+            parts, modified = validator
+            etag = json_etag(request, parts + (modified,))
+            matched = not_modified(request, etag, modified)
+            if matched:
+                resp = HttpResponseNotModified()
+                resp['ETag'] = matched
+                return resp
+            cache = json_cache()
+            if cache is not None:
+                cached = cache.get('icon_commons:json:%s' % etag[1:-1])
+        if cached is None:
+            context = self.get_context_data(**kwargs)
+            data = self.get_json_data(context)
+            callback = request.GET.get('callback', None)
+            with phase('serialize'):
+                if callback:
+                    cached = ('%s(%s);' % (callback, json.dumps(data)), 'application/javascript')
+                else:
+                    cached = (json.dumps(data), 'application/json')
+            if etag is not None and json_cache() is not None:
+                json_cache().set('icon_commons:json:%s' % etag[1:-1], cached)
+        resp = HttpResponse(cached[0], content_type=cached[1])
+        if etag is not None:
+            resp['ETag'] = etag
+        if modified is not None:
+            resp['Last-Modified'] = modified.strftime(_date_fmt)
+        return resp
+
+    def get_validator(self, **kwargs):
+        """Return a tuple of the values the response depends on besides the
+        request, and its last modification time (or None), to answer
+        conditional requests. None disables them."""
+        return None
 
     def get_json_data(self, context):
         return context
 
 
+def encode_cursor(key):
+    return urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        name, id = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        return str(name), int(id)
+    except (ValueError, TypeError):
+        raise Http404('Invalid cursor')
+
+
+def keyset_page(queryset, after, size):
+    """Return a page of a values() queryset ordered by (name, id) starting
+    after the (name, id) key after, and the key of its last row if more
+    follow."""
+    queryset = queryset.order_by('name', 'id')
+    if after is not None:
+        name, id = after
+        # a range on the (name, id) index rather than an OR it can't use
+        queryset = queryset.filter(name__gte=name).exclude(name=name, id__lte=id)
+    rows = list(queryset[:size + 1])
+    if len(rows) > size:
+        return rows[:size], (rows[size - 1]['name'], rows[size - 1]['id'])
+    return rows, None
+
+
+class CountedPaginator(Paginator):
+    """A Paginator that takes the object count when it is already known."""
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            # count is a cached_property
+            self.__dict__['count'] = count
+
+
 class JSONListMixin(MultipleObjectMixin, JSONMixin):
+    paginator_class = CountedPaginator
+    # page size of cursor requests for views that aren't paginated otherwise
+    cursor_paginate_by = 100
+    # set by get_validator when it counted the object list
+    known_count = None
+    # get_serializer returns an object with values(), prepare(rows) and
+    # encode(row), see serializers
+    serializer = None
+
     def get(self, request, *args, **kwargs):
         if self.context_object_name is None:
             self.context_object_name = str(self.model._meta.verbose_name_plural)
         self.object_list = self.get_queryset()
         return super(JSONListMixin, self).get(request, *args, **kwargs)
 
+    def cursor_mode(self):
+        # ?cursor= (empty for the first page) switches to keyset pagination
+        return 'cursor' in self.request.GET
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return self.paginator_class(queryset, per_page, count=self.known_count, **kwargs)
+
+    def get_paginate_by(self, queryset):
+        if self.cursor_mode():
+            return self.paginate_by or self.cursor_paginate_by
+        return self.paginate_by
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.cursor_mode():
+            return super(JSONListMixin, self).paginate_queryset(queryset, page_size)
+        cursor = self.request.GET['cursor']
+        after = decode_cursor(cursor) if cursor else None
+        if hasattr(queryset, 'keyset_page'):
+            rows, self.next_key = queryset.keyset_page(after, page_size)
+        else:
+            rows, self.next_key = keyset_page(queryset, after, page_size)
+        return None, None, rows, self.next_key is not None
+
+    def get_serializer(self):
+        if self.serializer is None:
+            self.serializer = self.create_serializer()
+        return self.serializer
+
     def get_json_data(self, context):
+        rows = list(context[self.context_object_name])
+        serializer = self.get_serializer()
+        # batched loads for the optional fields of the page
+        serializer.prepare(rows)
         data = {
-            self.context_object_name: [self.encode(o) for o in context[self.context_object_name]]
+            self.context_object_name: [serializer.encode(o) for o in rows]
         }
         paginator = context['paginator']
         if paginator:
@@ -87,121 +269,508 @@ class JSONListMixin(MultipleObjectMixin, JSONMixin):
             data['page'] = page.number
             data['pages'] = paginator.num_pages
             data['count'] = paginator.count
+        elif self.cursor_mode():
+            # counting is opt in, it costs a scan of the whole result
+            data['next'] = encode_cursor(self.next_key) if self.next_key else None
+            if self.request.GET.get('count') in ('1', 'true'):
+                data['count'] = self.object_list.count()
         return data
 
-    def encode(self, o):
+    def create_serializer(self):
         raise Exception('implement me')
 
 
+# content encodings of stored and rendered svg, in order of preference
+_encodings = (('br', 'brotli'), ('gzip', 'gzip'))
+_etag_encoding = re.compile(r'-(?:br|gzip)"$')
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, q = part.partition(';')
+        q = q.strip()
+        try:
+            if q.startswith('q=') and float(q[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    if '*' in accepted:
+        accepted.update(e for e, field in _encodings)
+    return accepted
+
+
+def not_modified(request, etag, modified):
+    """Return the validator of the request matching etag/modified, or None."""
+    # If-None-Match takes precedence over If-Modified-Since
+    matches = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if matches:
+        for e in parse_etags(matches):
+            # weak comparison, as required for GET, and any content encoding
+            strong = e[2:] if e.startswith('W/') else e
+            if strong == '*':
+                return etag
+            if _etag_encoding.sub('"', strong) == etag:
+                return e
+        return None
+    stale = request.META.get('HTTP_IF_MODIFIED_SINCE', None)
+    if stale and modified is not None:
+        try:
+            if modified.replace(microsecond=0, tzinfo=None) <= datetime.strptime(stale, _date_fmt):
+                return etag
+        except ValueError:
+            pass
+    return None
+
+
 @cors
+@replica_reads
 class IconView(View):
     def get(self, request, *args, **kwargs):
         id = kwargs.get('id', None)
+        resolved = None
+        if id is None:
+            resolver = get_resolver()
+            if resolver is not None:
+                resolved = resolver.resolve(kwargs.get('collection'), kwargs.get('icon'))
+                if resolved is None:
+                    raise Http404('No icon found')
+                id = resolved[0]
         if id is not None:
-            query = IconData.objects.filter(icon__id=kwargs['id'])
+            icons = Icon.objects.filter(id=id)
         else:
-            collection = kwargs.get('collection')
-            icon = kwargs.get('icon')
-            query = IconData.objects.filter(icon__collection__slug=collection).filter(icon__slug=icon)
+            icons = Icon.objects.filter(collection__slug=kwargs.get('collection'), slug=kwargs.get('icon'))
         params = request.GET.copy()
         version = params.pop('version', None)
+        accepted = accepted_encodings(request)
+        # don't read the precompressed variants the client can't use
+        unused = ['blob__%s' % field for e, field in _encodings if e not in accepted]
+        # revalidations can usually be answered without reading the svg blob
+        conditional = 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
         if version:
-            icon = query.filter(version=version)[0]
+            query = IconData.objects.filter(icon__in=icons, version=version[-1])
+            if not conditional:
+                query = query.select_related('blob').defer(*unused)
+            icon = get_object_or_404(query)
+        elif resolved is not None and conditional:
+            # the resolver knows the current version, the blob is only read
+            # if the client's copy is stale
+            id, current_id, current_version, sha256, modified = resolved
+            icon = IconData(id=current_id, icon_id=id, version=current_version, blob_id=sha256, sha256=sha256,
+                            modified=modified)
         else:
-            icon = query.latest('version')
-        stale = request.META.get('HTTP_IF_MODIFIED_SINCE', None)
-        if stale:
-            if icon.modified.replace(microsecond=0, tzinfo=None) <= datetime.strptime(stale, _date_fmt):
-                return HttpResponseNotModified()
-        svg = icon.svg
+            # the current version pointer makes this a single primary key lookup
+            if conditional:
+                icons = icons.select_related('current')
+            else:
+                icons = icons.select_related('current__blob').defer(*['current__' + f for f in unused])
+            icon = get_object_or_404(icons).current
+            if icon is None:
+                raise Http404('No versions of icon')
+        etag = quote_etag(derived_hash(icon.sha256, params) if params else icon.sha256)
+        matched = not_modified(request, etag, icon.modified)
+        if matched:
+            resp = HttpResponseNotModified()
+            resp['ETag'] = matched
+            patch_vary_headers(resp, ['Accept-Encoding'])
+            return resp
         if params:
-            svg = process_svg(svg, params)
-        resp = HttpResponse(svg, content_type='image/svg+xml')
+            variants, hit = render_svg(icon, params)
+        else:
+            variants, hit = icon.variants(), None
+        encoding = next((e for e, field in _encodings if e in accepted and variants.get(e)), None)
+        body = variants[encoding or 'identity']
+        resp = HttpResponse(body, content_type='image/svg+xml')
+        resp['Content-Length'] = len(body)
+        if encoding:
+            resp['Content-Encoding'] = encoding
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        patch_vary_headers(resp, ['Accept-Encoding'])
         resp['Last-Modified'] = icon.modified.strftime(_date_fmt)
+        resp['ETag'] = etag
+        if hit is not None:
+            resp['X-Render-Cache'] = 'HIT' if hit else 'MISS'
         return resp
 
 
+# <id or collection/icon>[@version][|fill=<color>][|stroke=<color>]
+_sprite_ref = re.compile(r'^(?:(?P<id>\d+)|(?P<collection>[-\w]+)/(?P<icon>[-\w]+))(?:@(?P<version>\d+))?$')
+
+
+def parse_sprite_ref(value):
+    parts = value.split('|')
+    match = _sprite_ref.match(parts[0])
+    if match is None:
+        return None
+    ref = match.groupdict()
+    ref['params'] = {}
+    for option in parts[1:]:
+        key, _, color = option.partition('=')
+        if key not in ('fill', 'stroke'):
+            return None
+        ref['params'][key] = color
+    return ref
+
+
 @cors
+class IconSprite(View):
+    """Fetch many icons at once as an svg <symbol> sprite or a JSON map."""
+
+    def get(self, request, *args, **kwargs):
+        refs = [parse_sprite_ref(v) for v in request.GET.getlist('icon')]
+        max_icons = getattr(settings, 'ICON_COMMONS_SPRITE_MAX_ICONS', 500)
+        if not refs or None in refs or len(refs) > max_icons:
+            return HttpResponseBadRequest('expected 1 to %s icon=<id or collection/icon>[@version] params' % max_icons)
+        query = Q()
+        for ref in refs:
+            if ref['id']:
+                q = Q(icon__id=ref['id'])
+            else:
+                q = Q(icon__collection__slug=ref['collection'], icon__slug=ref['icon'])
+            query |= q & Q(version=ref['version'] or F('icon__current_version'))
+        # index the results by every way a ref can name them
+        found = {}
+        for data in IconData.objects.filter(query).select_related('icon__collection', 'blob'):
+            icon = data.icon
+            versions = [data.version, None] if data.version == icon.current_version else [data.version]
+            for version in versions:
+                found[(str(icon.id), version)] = data
+                found[('%s/%s' % (icon.collection.slug, icon.slug), version)] = data
+        icons = []
+        for ref in refs:
+            name = ref['id'] or '%s/%s' % (ref['collection'], ref['icon'])
+            data = found.get((name, int(ref['version']) if ref['version'] else None), None)
+            if data is not None:
+                icons.append((self.symbol_id(data, ref), data, ref['params']))
+        if not icons:
+            raise Http404('No icons found')
+        etag = quote_etag(svg_hash(' '.join(
+            '%s:%s' % (id, derived_hash(data.sha256, params) if params else data.sha256) for id, data, params in icons)))
+        modified = max(data.modified for id, data, params in icons)
+        matched = not_modified(request, etag, modified)
+        if matched:
+            resp = HttpResponseNotModified()
+            resp['ETag'] = matched
+            return resp
+        svgs = [(id, render_svg(data, params)[0]['identity'] if params else data.svg) for id, data, params in icons]
+        if request.GET.get('format', None) == 'json':
+            with phase('serialize'):
+                body = json.dumps(dict((id, svg if isinstance(svg, str) else svg.decode('utf-8')) for id, svg in svgs))
+            resp = HttpResponse(body, content_type='application/json')
+        else:
+            symbols = []
+            with phase('svg'):
+                for id, svg in svgs:
+                    try:
+                        symbols.append(svg_symbol(svg, id))
+                    except etree.XMLSyntaxError:
+                        pass
+            with phase('serialize'):
+                body = svg_sprite(symbols)
+            resp = HttpResponse(body, content_type='image/svg+xml')
+        resp['Last-Modified'] = modified.strftime(_date_fmt)
+        resp['ETag'] = etag
+        return resp
+
+    def symbol_id(self, data, ref):
+        parts = [data.icon.collection.slug, data.icon.slug]
+        if ref['version']:
+            parts.append('v%s' % data.version)
+        for key in ('fill', 'stroke'):
+            if ref['params'].get(key, None):
+                parts.extend([key, ref['params'][key]])
+        return slugify('-'.join(parts))
+
+
+@cors
+@replica_reads
 class IconInfoView(View, JSONMixin):
+    def get_validator(self, **kwargs):
+        self.icon = icon_row(kwargs['id'])
+        if self.icon is None:
+            return None
+        self.tags = None
+        tags = current_version()
+        if tags is None:
+            # no shared index version to tell tag changes by
+            self.tags = tags = icon_tags(kwargs['id'])
+        # the collection name is part of the document
+        modified = self.icon['modified'], self.icon['collection__modified']
+        return (tags,) + modified, max(modified)
+
     def get_context_data(self, **kwargs):
-        return Icon.objects.select_related('collection').get(id=kwargs['id'])
-
-    def get_json_data(self, icon):
-        versions = [{
-                        'version': data.version,
-                        'modified': data.modified.isoformat(),
-                        'changelog': data.change_log,
-                    } for data in icon.icondata_set.all()]
-        return {
-            'collection': {
-                'id': icon.collection.id,
-                'name': icon.collection.name
-            },
-            'name': icon.name,
-            'versions': versions,
-            'tags': [{'id': t.id, 'name': t.name}
-                     for t in icon.tags.all()
-                     ]
-        }
+        return icon_info(kwargs['id'], self.icon, self.tags)
+
+
+class _Keys(object):
+    """The sort keys of ids as a sequence, for bisect."""
+
+    def __init__(self, ids, key):
+        self.ids = ids
+        self.key = key
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.key(self.ids[i])
+
+
+class IndexedIcons(object):
+    """Icon ids resolved by the tag index, fetched a page at a time."""
+
+    def __init__(self, ids, key=None, rows=None):
+        self.ids = ids
+        self.key = key
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def count(self):
+        return len(self.ids)
+
+    def keyset_page(self, after, size):
+        # ids are already in (name, id) order
+        start = 0
+        if after is not None:
+            start = bisect_right(_Keys(self.ids, self.key), tuple(after))
+        rows = self[start:start + size]
+        if start + size < len(self.ids):
+            return rows, self.key(self.ids[start + size - 1])
+        return rows, None
+
+    def __getitem__(self, k):
+        ids = self.ids[k]
+        if not isinstance(k, slice):
+            return self.rows.get(id=ids)
+        rows = dict((r['id'], r) for r in self.rows.filter(id__in=ids))
+        return [rows[i] for i in ids if i in rows]
 
 
 @cors
+@replica_reads
 class IconList(View, JSONListMixin):
     context_object_name = 'icons'
     paginate_by = 100
 
+    def create_serializer(self):
+        return IconSerializer(requested_fields(self.request, IconSerializer.fields))
+
     def get_queryset(self):
-        query = Icon.objects.all()
         collection = self.kwargs.get('collection', None)
+        tags = self.request.GET.getlist('tag', None)
+        if (tags or 'facets' in self.request.GET) and tagindex.enabled():
+            return self.get_indexed(collection, tags)
+        query = self.get_serializer().values()
+        if tags and self.request.GET.get('match') == 'all':
+            for tag in set(tags):
+                query = query.filter(tags__name=tag)
+        elif tags:
+            query = query.filter(tags__name__in=tags).distinct()
         if collection:
             if collection.isdigit():
-                query = query.filter(collection__id=collection)
+                query = query.filter(collection_id=collection)
             else:
-                query = query.filter(collection__name=collection)
-        tags = self.request.GET.getlist('tag', None)
-        if tags:
-            query = query.filter(tags__name__in=tags)
-        return query.order_by('name').distinct()
+                # by id, so pages walk the (collection, name, id) index
+                ids = list(Collection.objects.filter(name=collection).values_list('id', flat=True))
+                query = query.filter(collection_id=ids[0]) if len(ids) == 1 else query.filter(collection_id__in=ids)
+        return query.order_by('name', 'id')
+
+    def get_indexed(self, collection, tags):
+        # tag filters and facets are answered from the tag index, only the
+        # requested page is read from the db
+        self.index = get_tag_index()
+        if collection and not collection.isdigit():
+            collection = Collection.objects.filter(name=collection).values_list('id', flat=True).first()
+        if collection is None and self.kwargs.get('collection'):
+            self.ids = []
+        else:
+            self.ids = self.index.filter(tags, int(collection) if collection else None,
+                                         match_all=self.request.GET.get('match') == 'all')
+        return IndexedIcons(self.ids, self.index.key, self.get_serializer().values())
+
+    def get_validator(self, **kwargs):
+        if self.cursor_mode():
+            # a count per cursor page would defeat skipping it
+            return None
+        if isinstance(self.object_list, IndexedIcons):
+            # the ids and their order come from the tag index and change with
+            # its version, the rows listed only need reading for the page
+            count, modified, owners = self.owner_stats(Icon.objects.filter(id__in=self.page_ids()))
+            return (len(self.ids), current_version(), owners), modified
+        tagged = self.request.GET.getlist('tag') or 'facets' in self.request.GET
+        if (tagged or 'tags' in self.get_serializer().requested) and not tagindex.enabled():
+            # tag changes don't touch the icon rows, without the shared index
+            # version there is nothing to tell them by
+            return None
+        count, modified, owners = self.owner_stats(self.object_list)
+        # the paginator would count the same rows again
+        self.known_count = count
+        parts = (count, owners)
+        if 'tags' in self.get_serializer().requested:
+            parts += (current_version(),)
+        return parts, modified
+
+    def page_ids(self):
+        """The ids of the indexed icons on the requested page, none if the
+        paginator will refuse it."""
+        paginator = self.get_paginator(self.ids, self.get_paginate_by(self.ids),
+                                       orphans=self.get_paginate_orphans(),
+                                       allow_empty_first_page=self.get_allow_empty())
+        number = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg) or 1
+        try:
+            return paginator.page(paginator.num_pages if number == 'last' else number).object_list
+        except InvalidPage:
+            return []
+
+    def owner_stats(self, queryset):
+        """Count and last modification of the icons in queryset and their
+        owners' usernames, which are listed but don't touch Icon.modified
+        when renamed, in one query."""
+        rows = queryset.values('owner__username').annotate(
+            modified=Max('modified'), count=Count('id')).order_by('owner__username')
+        rows = list(rows.values_list('owner__username', 'modified', 'count'))
+        modified = max((m for u, m, c in rows), default=None)
+        return sum(c for u, m, c in rows), modified, tuple(u for u, m, c in rows)
+
+    def get_json_data(self, context):
+        data = super(IconList, self).get_json_data(context)
+        if 'facets' in self.request.GET:
+            try:
+                limit = max(int(self.request.GET['facets']), 0)
+            except ValueError:
+                limit = None
+            icons = self.ids if isinstance(self.object_list, IndexedIcons) else self.object_list
+            facets = tagindex.facets(icons, self.request.GET.getlist('tag'), limit)
+            data['facets'] = [{'name': name, 'count': count} for name, count in facets]
+        return data
 
-    def encode(self, o):
-        url = reverse('iconcommons_icon_view', kwargs={'id': o.id})
-        return {
-            'name': o.name,
-            'owner': o.owner.username,
-            'href': url
-        }
 
 
 @cors
+@replica_reads
 class CollectionList(View, JSONListMixin):
     context_object_name = 'collections'
 
+    def create_serializer(self):
+        return CollectionSerializer()
+
+    def get_validator(self, **kwargs):
+        # icon counters bump Collection.modified, see icon_commons.counters
+        stats = self.object_list.aggregate(modified=Max('modified'), count=Count('id'))
+        self.known_count = stats['count']
+        return (stats['count'],), stats['modified']
+
     def get_queryset(self):
-        return Collection.objects.all().annotate(Count('icon')).order_by('name')
+        return self.get_serializer().values().order_by('name', 'id')
 
-    def encode(self, o):
-        url = reverse('iconcommons_collection_icons', kwargs={'collection': o.id})
-        return {
-            'name': o.name,
-            'icons': o.icon__count,
-            'href': url
-        }
+
+@cors
+class ExportView(View):
+    """Stream the current version of every icon as NDJSON or a zip.
+
+    format=ndjson|zip, collection=<id or name> and since=<ISO 8601> for
+    incremental pulls; X-Export-Time is the since to use next time.
+    """
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', 'ndjson')
+        if format not in formats:
+            return HttpResponseBadRequest('format must be one of %s' % ', '.join(sorted(formats)))
+        since = request.GET.get('since', None)
+        if since:
+            since = parse_since(since)
+            if since is None:
+                return HttpResponseBadRequest('since must be an ISO 8601 date or datetime')
+        started = timezone.now()
+        encode, content_type, extension = formats[format]
+        resp = StreamingHttpResponse(encode(current_versions(request.GET.get('collection', None), since)),
+                                     content_type=content_type)
+        resp['Content-Disposition'] = 'attachment; filename="icons.%s"' % extension
+        resp['X-Export-Time'] = started.isoformat()
+        return resp
 
 
 @cors
+@replica_reads
 class SearchTags(View, JSONMixin):
-    def get_context_data(self, **kwargs):
+    tags = None
+
+    def get_validator(self, **kwargs):
+        version = current_version()
+        if version is None:
+            # the query answering it is the only way to tell a change
+            self.tags = self.search()
+            return (tuple(self.tags),), None
+        return (version,), None
+
+    def search(self):
         query = self.request.GET.get('query', None)
         if query is None:
-            return {'tags': []}
-        filter = {}
-        if len(query) > 3:
-            filter['name__icontains'] = query
-        else:
-            filter['name__istartswith'] = query
-        tags = TaggedItem.tags_for(Icon).filter(**filter).order_by('name')
+            return []
+        try:
+            limit = max(int(self.request.GET['limit']), 0)
+        except (KeyError, ValueError):
+            limit = None
+        return tagindex.search(query, limit)
+
+    def get_context_data(self, **kwargs):
         return {
-            'tags': [t.name for t in tags]
+            'tags': self.search() if self.tags is None else self.tags
+        }
+
+
+_upload_success = ('Congratulations! Your upload was successful. You can see your icons on your profile page. '
+                   'When you\'re composing a story with point layers, you\'ll be able to style your points with any '
+                   'icons uploaded by any storyteller in the Icons Commons!')
+
+
+def queued_upload(req, job, form):
+    status = reverse('iconcommons_upload_job', kwargs={'id': job.id})
+    if req.is_ajax() or 'application/json' in req.META.get('HTTP_ACCEPT', ''):
+        return JsonResponse({'job': job.id, 'status': status}, status=202)
+    messages.info(req, 'Your icons are being imported, job %s. Progress: %s' % (job.id, status))
+    return render(req, 'icons/icon_upload.html', {"icon_form": form}, status=202)
+
+
+class MetricsView(View):
+    """The request metrics of this process in the Prometheus text format.
+
+    Only served with ICON_COMMONS_METRICS_ENDPOINT on, to loopback and
+    INTERNAL_IPS clients. Recording needs icon_commons.metrics.MetricsMiddleware.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not getattr(settings, 'ICON_COMMONS_METRICS_ENDPOINT', False):
+            raise Http404('Metrics are disabled')
+        addr = request.META.get('REMOTE_ADDR', '')
+        if addr not in ('127.0.0.1', '::1') and addr not in getattr(settings, 'INTERNAL_IPS', ()):
+            raise Http404('Metrics are only served locally')
+        return HttpResponse(registry.prometheus(get_render_cache()), content_type='text/plain; version=0.0.4')
+
+
+@method_decorator(login_required, name='dispatch')
+class UploadJobView(View, JSONMixin):
+    def get(self, request, *args, **kwargs):
+        # the job's icons land on the primary first, keep reading from it
+        return pin_to_primary(super(UploadJobView, self).get(request, *args, **kwargs))
+
+    def get_context_data(self, **kwargs):
+        return get_object_or_404(UploadJob.objects.defer('archive'), id=kwargs['id'], owner=self.request.user)
+
+    def get_json_data(self, job):
+        return {
+            'id': job.id,
+            'name': job.name,
+            'status': job.status,
+            'total': job.total,
+            'processed': job.processed,
+            'failed': job.failed,
+            'errors': json.loads(job.errors),
+            'created': job.created.isoformat(),
+            'finished': job.finished.isoformat() if job.finished else None,
         }
 
 
@@ -213,67 +782,35 @@ def upload(req):
         if form.is_valid():
             tags = form.cleaned_data['tags']
             svg = req.FILES['svg']
-            collection_name = req.user
-            # If they defined a collection name, use that. Otherwise, use the name of the file/zip
-            col_name = collection_name
 
             # Two possibilities we want to handle:
-            # a) it's a zip, so unzip it and ingest all files
+            # a) it's a zip, so read all the svg members straight from the upload
             # b) it's a svg, so just ingest this one file
-            file_type = svg.name.split('.')[1]
-            if file_type == 'zip':
-                file_pointer, path = mkstemp()
-
-                with open(path, 'w') as file:
-                    for chunk in svg.chunks():
-                        file.write(chunk)
-
-                with open(path, 'r') as file:
-                    unzipped = zipfile.ZipFile(file)
-                    for file_name in unzipped.namelist():
-                        # If it doesn't have an extension, skip it
-                        if len(file_name.split('.')) == 1:
-                            continue
-                        unzipped_type = file_name.split('.')[1]
-                        if unzipped_type != 'svg':
-                            continue
-                        col, col_created = Collection.objects.get_or_create(name=col_name)
-                        icon_name = os.path.splitext(os.path.basename(file_name))[0]
-                        icon, icon_created = Icon.objects.get_or_create(name=icon_name, collection=col, owner=req.user)
-                        msg = 'initial import' if icon_created else 'automatic update'
-                        # Add tags to the icon
-                        icon.tags.add(*tags)
-                        data = unzipped.read(file_name)
-                        updated = True
-                        try:
-                            latest = icon.icondata_set.latest('version')
-                            updated = latest.svg == data
-                        except ObjectDoesNotExist:
-                            pass
-                        if updated:
-                            icon.new_version(data, msg)  # Pass req.user
-                        icon.save()
-                        messages.success(req, 'Congratulations! Your upload was successful. You can see your icons on your profile page. When you\'re composing a story with point layers, you\'ll be able to style your points with any icons uploaded by any storyteller in the Icons Commons!')
-                os.close(file_pointer)
-            elif svg.content_type == 'image/svg+xml':
-                col, col_created = Collection.objects.get_or_create(name=col_name)
-                icon_name = os.path.splitext(os.path.basename(svg.name))[0]
-                icon, icon_created = Icon.objects.get_or_create(name=icon_name, collection=col, owner=req.user)
-                msg = 'initial import' if icon_created else 'automatic update'
-                icon.tags.add(*tags)
-                data = svg.read()
-                updated = True
-                try:
-                    latest = icon.icondata_set.latest('version')
-                    updated = latest.svg == data
-                except ObjectDoesNotExist:
-                    pass
-                if updated:
-                    icon.new_version(data, msg)
-                icon.save()
-                messages.success(req, 'Congratulations! Your upload was successful. You can see your icons on your profile page. When you\'re composing a story with point layers, you\'ll be able to style your points with any icons uploaded by any storyteller in the Icons Commons!')
-            else:
-                return HttpResponseRedirect(reverse('upload'))
+            file_type = os.path.splitext(svg.name)[1].lower()
+            try:
+                if file_type == '.zip' and job_mode():
+                    return pin_to_primary(queued_upload(req, enqueue(req.user, svg, tags), form))
+                if file_type == '.zip':
+                    entries, errors = read_zip(svg, tags)
+                elif svg.content_type == 'image/svg+xml':
+                    icon_name = os.path.splitext(os.path.basename(svg.name))[0]
+                    entries, errors = [prepare_svg(icon_name, svg.read(), tags)], []
+                else:
+                    return HttpResponseRedirect(reverse('upload'))
+            except ValueError as e:
+                messages.error(req, str(e))
+                return render(req, 'icons/icon_upload.html', {"icon_form": form})
+            with transaction.atomic():
+                # the collection is named after the uploading user
+                col, col_created = Collection.objects.get_or_create(name=req.user.get_username())
+                tag_cache = {}
+                for chunk in chunks(entries, 500):
+                    bulk_import(col, chunk, owner=req.user, tag_cache=tag_cache)
+            for error in errors:
+                messages.warning(req, 'Skipped %s' % error)
+            if entries:
+                messages.success(req, _upload_success)
+            return pin_to_primary(render(req, 'icons/icon_upload.html', {"icon_form": form}))
     else:
         form = IconForm()
-    return render_to_response('icons/icon_upload.html', RequestContext(req, {"icon_form": form}))
+    return render(req, 'icons/icon_upload.html', {"icon_form": form})
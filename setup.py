@@ -25,6 +25,9 @@ setup(name="django-icon-commons",
           "django_extensions",
           "django_nose"
       ],
+      extras_require={
+          "brotli": ["brotli"],
+      },
       classifiers=[
       ],
       )
@@ -9,7 +9,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(DIRNAME, 'database.db'),
-    }
+    },
+    # only used by the tests that route reads to a replica
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(DIRNAME, 'replica.db'),
+    },
 }
 INSTALLED_APPS = (
     'django.contrib.auth',
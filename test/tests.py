@@ -1,13 +1,71 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.cache.backends.base import CacheKeyWarning
+from django.core.management import call_command
 
 from django.db import IntegrityError
+from django.db import OperationalError
+from django.db import connection
+from django.db import connections
+from django.test import Client
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from icon_commons.models import Collection
 from icon_commons.models import Icon
 from icon_commons.models import IconData
+from icon_commons.models import IngestManifest
+from icon_commons.models import SVGBlob
+from icon_commons.models import UploadJob
+from icon_commons import tagindex
+from icon_commons.cache import LocalRenderCache
+from icon_commons.cache import get_render_cache
+from icon_commons import delta as deltas
+from icon_commons.importer import bulk_import
+from icon_commons.importer import locked_icons
+from icon_commons.jobs import requeue_stale
+from icon_commons.jobs import run_queued
+from icon_commons.importer import prepare_svg
+from icon_commons.metrics import registry
+from icon_commons.optimize import optimize_svg
+from icon_commons.optimize import round_numbers
+from icon_commons.resolver import FQNResolver
+from icon_commons.resolver import get_resolver
+from icon_commons.routers import ReplicaSelector
+from icon_commons.routers import get_selector
+from icon_commons.utils import brotli
+from icon_commons.views import CollectionList
+from icon_commons.views import IconList
+from icon_commons.utils import compile_svg
+from icon_commons.utils import compress_svg
+from icon_commons.utils import process_svg
+from icon_commons.utils import render_template
+from taggit.models import Tag
+from io import BytesIO
+from io import StringIO
+from datetime import datetime
+from datetime import timedelta
 import json
+import os
+import shutil
+import gzip
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+import zipfile
+
+
+_svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10">'
+        '<path style="fill:#000000;stroke:none" d="M0 0L10 10"/>'
+        '<circle fill="#ff0000" cx="5" cy="5" r="2"/>'
+        '</svg>')
 
 
 class ModelTest(TestCase):
@@ -22,6 +80,56 @@ class ModelTest(TestCase):
         assert d2.svg == 'bye'
         assert d2.version == 2
         assert i.icondata_set.count() == 2
+        assert i.current == d2
+        assert Icon.objects.get(id=i.id).current_version == 2
+
+    def test_blob_dedupe(self):
+        c = Collection.objects.create(name='default')
+        i = Icon.objects.create(collection=c, name='icon')
+        j = Icon.objects.create(collection=c, name='other')
+        d1 = i.new_version(_svg, None)
+        d2 = i.new_version(_svg, 'automatic update')
+        d3 = j.new_version(_svg.encode('utf-8'), None)
+        j.new_version('bye', None)
+        self.assertEqual(1, len(set([d1.blob_id, d2.blob_id, d3.blob_id])))
+        self.assertEqual(_svg, IconData.objects.get(id=d3.id).svg)
+        out = StringIO()
+        call_command('blobreport', stdout=out)
+        size = len(_svg)
+        self.assertIn('4 versions share 2 blobs (0 unreferenced)', out.getvalue())
+        self.assertIn('%s bytes referenced, %s bytes stored, %s bytes reclaimed' % (
+            size * 3 + 3, size + 3, size * 2), out.getvalue())
+
+    def test_icon_count(self):
+        def counts():
+            return dict(Collection.objects.values_list('name', 'icon_count'))
+        c = Collection.objects.create(name='default')
+        other = Collection.objects.create(name='other')
+        i = Icon.objects.create(collection=c, name='icon')
+        Icon.objects.create(collection=c, name='icon2').new_version('hi', None)
+        self.assertEqual({'default': 2, 'other': 0}, counts())
+        # saving a stale copy leaves the count alone
+        c.description = 'icons'
+        c.save()
+        self.assertEqual({'default': 2, 'other': 0}, counts())
+        i.collection = other
+        i.save()
+        self.assertEqual({'default': 1, 'other': 1}, counts())
+        i.delete()
+        self.assertEqual({'default': 1, 'other': 0}, counts())
+        entries = [prepare_svg('a.svg', _svg, ['x']), prepare_svg('b.svg', _svg, [])]
+        bulk_import(other, entries)
+        bulk_import(other, entries)
+        self.assertEqual({'default': 1, 'other': 2}, counts())
+        modified = Collection.objects.get(id=c.id).modified
+        Icon.objects.create(collection=c, name='icon3')
+        self.assertGreater(Collection.objects.get(id=c.id).modified, modified)
+        # drift from writes bypassing the counters
+        Collection.objects.filter(id=c.id).update(icon_count=7)
+        out = StringIO()
+        call_command('recount', stdout=out)
+        self.assertIn('1 collection counts fixed', out.getvalue())
+        self.assertEqual({'default': 2, 'other': 2}, counts())
 
     def test_icon_unique(self):
         c = Collection.objects.create(name='default')
@@ -47,6 +155,8 @@ class ViewTest(TestCase):
         self.icon = Icon.objects.create(collection=self.collection, name='baz', owner=self.owner)
         self.icon.tags.add('foobar', 'barfoo', 'foofoobarf')
         self.data = self.icon.new_version('hi', None)
+        # changes in a TestCase never commit, start from what is in the db
+        tagindex.invalidate()
 
     def test_get_svg(self):
         r = self.client.get('/foobar/baz.svg')
@@ -86,10 +196,118 @@ class ViewTest(TestCase):
         self.assertEqual(1, len(data['icons']))
         self.assertEqual({'href': '/icon/1', 'name': 'baz', 'owner': 'user_1'}, data['icons'][0])
 
+    def test_list_queries(self):
+        def get(url, **params):
+            return json.loads(self.client.get(url, params).content.decode())
+
+        url = reverse('iconcommons_icon_list')
+        params = {'fields': 'tags,version,modified'}
+        with self.assertNumQueries(3):
+            data = get(url, **params)
+        self.assertEqual({'href': '/icon/1', 'name': 'baz', 'owner': 'user_1', 'version': 1,
+                          'modified': self.icon.modified.isoformat(),
+                          'tags': ['barfoo', 'foobar', 'foofoobarf']}, data['icons'][0])
+        for i in range(5):
+            Icon.objects.create(collection=self.collection, name='icon%s' % i).tags.add('x')
+        # validator and count, page and tags, however many icons are on the page
+        with self.assertNumQueries(3):
+            data = get(url, **params)
+        icon = data['icons'][1]
+        self.assertTrue(icon.pop('modified'))
+        self.assertEqual({'href': '/icon/%s' % Icon.objects.get(name='icon0').id, 'name': 'icon0', 'owner': None,
+                          'tags': ['x'], 'version': 0}, icon)
+        with self.assertNumQueries(2):
+            self.assertEqual(['baz', 'icon0'], [o['name'] for o in get(url, fields='tags', cursor='')['icons']][:2])
+        # validator and the list
+        with self.assertNumQueries(2):
+            self.assertEqual(6, get(reverse('iconcommons_collection_list'))['collections'][0]['icons'])
+        with self.assertNumQueries(3):
+            data = get(reverse('iconcommons_icon_info_view', kwargs={'id': self.icon.id}))
+        self.assertEqual(3, len(data['tags']))
+
+    def test_list_icons_cursor(self):
+        for name in ('a', 'c', 'b', 'bb'):
+            Icon.objects.create(collection=self.collection, name=name, owner=self.owner).tags.add('foobar')
+        tagindex.invalidate()
+
+        def walk(url, **params):
+            names, pages, cursor = [], 0, ''
+            while cursor is not None:
+                r = self.client.get(url, dict(params, cursor=cursor))
+                data = json.loads(r.content.decode())
+                self.assertNotIn('page', data)
+                names.extend(o['name'] for o in data[[k for k in data if k not in ('next', 'count')][0]])
+                cursor = data['next']
+                pages += 1
+            return names, pages
+
+        with mock.patch.object(IconList, 'paginate_by', 2):
+            # the second collection has a 'baz' as well, ties are broken by id
+            other = Collection.objects.create(name='other')
+            Icon.objects.create(collection=other, name='baz', owner=self.owner)
+            self.assertEqual((['a', 'b', 'baz', 'baz', 'bb', 'c'], 3), walk(reverse('iconcommons_icon_list')))
+            self.assertEqual((['a', 'b', 'baz', 'bb', 'c'], 3),
+                             walk(reverse('iconcommons_icon_list'), tag='foobar'))
+            url = reverse('iconcommons_collection_icons', kwargs={'collection': 'foobar'})
+            self.assertEqual((['a', 'b', 'baz', 'bb', 'c'], 3), walk(url))
+            with CaptureQueriesContext(connection) as first:
+                r = self.client.get(url, {'cursor': ''})
+            self.assertNotIn('count', json.loads(r.content.decode()))
+            r = self.client.get(url, {'cursor': '', 'count': '1'})
+            data = json.loads(r.content.decode())
+            self.assertEqual(5, data['count'])
+            # deep pages are a keyset query, no count or offset
+            with CaptureQueriesContext(connection) as deep:
+                r = self.client.get(url, {'cursor': data['next']})
+            self.assertEqual(len(first), len(deep))
+            self.assertNotIn('COUNT', ' '.join(q['sql'] for q in deep.captured_queries))
+            # walked along the (collection, name, id) index, not sorted per page
+            sql = [q['sql'] for q in deep.captured_queries if 'ORDER BY' in q['sql']][-1]
+            with connection.cursor() as c:
+                c.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = ' '.join(str(row) for row in c.fetchall())
+            self.assertNotIn('TEMP B-TREE', plan)
+            self.assertIn('INDEX icon_common_collect_', plan)
+            self.assertEqual(['baz', 'bb'], [o['name'] for o in json.loads(r.content.decode())['icons']])
+            self.assertEqual(404, self.client.get(url, {'cursor': 'nope'}).status_code)
+            # page numbers keep working
+            data = json.loads(self.client.get(url, {'page': 2}).content.decode())
+            self.assertEqual((2, 3, 5), (data['page'], data['pages'], data['count']))
+        with mock.patch.object(CollectionList, 'cursor_paginate_by', 1):
+            self.assertEqual((['foobar', 'other'], 2), walk(reverse('iconcommons_collection_list')))
+
     def test_icon_view(self):
         r = self.client.get(reverse('iconcommons_icon_view', kwargs={'id': 1}))
         self.assertEqual('hi', r.content.decode())
 
+    def test_icon_view_current_pointer(self):
+        self.icon.new_version('hi2', 'updated')
+        url = reverse('iconcommons_icon_view', kwargs={'id': self.icon.id})
+        with self.assertNumQueries(1):
+            self.assertEqual('hi2', self.client.get(url).content.decode())
+        self.assertEqual('hi', self.client.get(url, {'version': 1}).content.decode())
+        self.assertEqual(404, self.client.get(url, {'version': 3}).status_code)
+        self.assertEqual(404, self.client.get(reverse('iconcommons_icon_view', kwargs={'id': 99})).status_code)
+
+    def test_icon_view_etag(self):
+        data = self.icon.new_version(_svg, None)
+        url = reverse('iconcommons_icon_view', kwargs={'id': self.icon.id})
+        r = self.client.get(url)
+        self.assertEqual('"%s"' % data.sha256, r['ETag'])
+        with self.assertNumQueries(1):
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(304, r.status_code)
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH='W/"x", %s' % r['ETag']).status_code)
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH='"x"').status_code)
+        recolored = self.client.get(url, {'fill': 'red'})['ETag']
+        self.assertNotEqual(r['ETag'], recolored)
+        self.assertNotEqual(recolored, self.client.get(url, {'fill': 'blue'})['ETag'])
+        self.assertEqual(304, self.client.get(url, {'fill': 'red'}, HTTP_IF_NONE_MATCH=recolored).status_code)
+        self.icon.new_version('hi2', 'updated')
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('hi2', r.content.decode())
+
     def test_icon_info_view(self):
         self.icon.new_version('hi2', 'updated')
         self.icon.new_version('hi3', 'updated again')
@@ -123,3 +341,1109 @@ class ViewTest(TestCase):
     def test_iconcommons_icon_by_fqn(self):
         r = self.client.get(reverse('iconcommons_icon_by_fqn', kwargs={'collection': 'foobar', 'icon': 'baz'}))
         self.assertEqual('hi', r.content.decode())
+
+    def test_icon_by_fqn_without_resolver(self):
+        # a per-process cache can't carry invalidations, names are read every time
+        self.assertIsNone(get_resolver())
+        url = reverse('iconcommons_icon_by_fqn', kwargs={'collection': 'foobar', 'icon': 'baz'})
+        r = self.client.get(url)
+        with self.assertNumQueries(1):
+            self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=r['ETag']).status_code)
+
+    @override_settings(ICON_COMMONS_RESOLVER_CACHE='default')
+    def test_icon_by_fqn_resolver(self):
+        url = reverse('iconcommons_icon_by_fqn', kwargs={'collection': 'foobar', 'icon': 'baz'})
+        r = self.client.get(url)
+        # resolved names are a primary key lookup, revalidations need no query
+        with self.assertNumQueries(1):
+            self.assertEqual('hi', self.client.get(url).content.decode())
+        with self.assertNumQueries(0):
+            self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=r['ETag']).status_code)
+        self.icon.new_version('bye', None)
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual('bye', r.content.decode())
+        self.collection.name = 'renamed'
+        self.collection.save()
+        self.assertEqual(404, self.client.get(url).status_code)
+        url = reverse('iconcommons_icon_by_fqn', kwargs={'collection': 'renamed', 'icon': 'baz'})
+        self.assertEqual('bye', self.client.get(url).content.decode())
+        self.icon.delete()
+        self.assertEqual(404, self.client.get(url).status_code)
+
+    def test_fqn_resolver_lru(self):
+        resolver = FQNResolver('default', 1)
+        other = Icon.objects.create(collection=self.collection, name='other')
+        other.new_version('x', None)
+        self.assertEqual((self.icon.id, self.data.id, 1), resolver.resolve('foobar', 'baz')[:3])
+        self.assertEqual(other.id, resolver.resolve('foobar', 'other')[0])
+        self.assertIsNone(resolver.resolve('foobar', 'missing'))
+        self.assertEqual(1, resolver.stats()['entries'])
+        # evicted locally, still in the shared cache
+        with self.assertNumQueries(0):
+            self.assertEqual(self.icon.id, resolver.resolve('foobar', 'baz')[0])
+        # another process invalidating reaches this one through the generation
+        FQNResolver('default', 1).invalidate()
+        with self.assertNumQueries(1):
+            resolver.resolve('foobar', 'baz')
+
+
+_inkscape_svg = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!-- Created with Inkscape (http://www.inkscape.org/) -->
+<svg xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:cc="http://creativecommons.org/ns#"
+   xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://www.w3.org/2000/svg"
+   xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+   xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="24" height="24" inkscape:version="0.48">
+  <defs>
+    <linearGradient id="unused"><stop offset="0"/></linearGradient>
+    <linearGradient id="used"><stop offset="1"/></linearGradient>
+  </defs>
+  <sodipodi:namedview id="base" pagecolor="#ffffff" inkscape:zoom="1"/>
+  <metadata>
+    <rdf:RDF><cc:Work rdf:about=""><dc:format>image/svg+xml</dc:format></cc:Work></rdf:RDF>
+  </metadata>
+  <g inkscape:label="Layer 1" inkscape:groupmode="layer" id="layer1">
+    <g><g> </g></g>
+    <path style="fill:url(#used)" d="M 1.12345678,2.98765432 L 10.00000001,20.5 z" inkscape:connector-curvature="0"/>
+    <text x="1" y="2">a <tspan>b</tspan> c</text>
+  </g>
+</svg>
+"""
+
+
+class OptimizeTest(TestCase):
+
+    def test_round_numbers(self):
+        self.assertEqual('M1.2.5L0,10 1 .5', round_numbers('M1.23456.5L-0.00001,10.0001 1.04.5', 1))
+        # arc flags run together with the next number are left alone
+        self.assertEqual('a1 1 0 011.5 2', round_numbers('a1 1 0 011.5 2.0001', 2))
+        self.assertEqual('M2 1', round_numbers('M1.5.9', 0))
+        self.assertEqual('1,2 3.333,4', round_numbers('1,2 3.33333,4', 3))
+        self.assertEqual('M0 0 url(x)', round_numbers('M0 0 url(x)', 3))
+
+    def test_optimize_svg(self):
+        svg = optimize_svg(_inkscape_svg)
+        self.assertEqual('<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24">'
+                         '<defs><linearGradient id="used"><stop offset="1"/></linearGradient></defs>'
+                         '<g id="layer1"><path style="fill:url(#used)" d="M 1.123,2.988 L 10,20.5 z"/>'
+                         '<text x="1" y="2">a <tspan>b</tspan> c</text></g></svg>', svg)
+        self.assertEqual(svg, optimize_svg(svg))
+        self.assertIn('d="M 1.12345678,2.98765432', optimize_svg(_inkscape_svg.encode('utf-8'), precision=10))
+        self.assertEqual(_svg, optimize_svg(_svg))
+        self.assertEqual('hi', optimize_svg('hi'))
+        with override_settings(ICON_COMMONS_SVG_OPTIMIZE=False):
+            self.assertEqual(_inkscape_svg, optimize_svg(_inkscape_svg))
+
+    def test_preserved_whitespace(self):
+        svg = ('<svg xmlns="http://www.w3.org/2000/svg">\n  <text>a <a href="#x">b</a> <g>c</g> d</text>\n'
+               '  <g xml:space="preserve"><g>\n  <path d="M0 0"/> </g></g>\n  <g xml:space="default"> </g>\n</svg>')
+        self.assertEqual('<svg xmlns="http://www.w3.org/2000/svg"><text>a <a href="#x">b</a> <g>c</g> d</text>'
+                         '<g xml:space="preserve"><g>\n  <path d="M0 0"/> </g></g></svg>', optimize_svg(svg))
+
+    def test_entities(self):
+        # as exported by Illustrator
+        svg = ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd" [\n'
+               '\t<!ENTITY st0 "fill:#FF0000;">\n]>\n'
+               '<svg version="1.1" xmlns="http://www.w3.org/2000/svg" width="10" height="10">\n'
+               '\t<!-- Generator: Adobe Illustrator -->\n'
+               '\t<path style="&st0;" d="M0.123456 0L10 10"/>\n</svg>\n')
+        self.assertEqual(svg, optimize_svg(svg))
+        c = Collection.objects.create(name='default')
+        data = Icon.objects.create(collection=c, name='icon').new_version(svg, None)
+        self.assertEqual(svg, data.svg)
+        self.assertIn(b'fill:#00ff00', data.render({'fill': '#00ff00'}))
+
+    def test_reimport_unchanged(self):
+        c = Collection.objects.create(name='default')
+        # stored before optimize_svg, then optimized with other settings
+        with override_settings(ICON_COMMONS_SVG_OPTIMIZE=False):
+            bulk_import(c, [prepare_svg('a', _inkscape_svg)])
+        with override_settings(ICON_COMMONS_SVG_PRECISION=1):
+            bulk_import(c, [prepare_svg('b', _inkscape_svg)])
+        counts, icons = bulk_import(c, [prepare_svg('a', _inkscape_svg), prepare_svg('b', _inkscape_svg)])
+        self.assertEqual((0, 0, 2), (counts['created'], counts['updated'], counts['unchanged']))
+        self.assertEqual([1, 1], [i.current_version for i in Icon.objects.order_by('name')])
+        counts, icons = bulk_import(c, [prepare_svg('a', _svg)])
+        self.assertEqual(1, counts['updated'])
+
+    def test_stored_original(self):
+        c = Collection.objects.create(name='default')
+        i = Icon.objects.create(collection=c, name='icon')
+        data = i.new_version(_inkscape_svg, None)
+        self.assertEqual(optimize_svg(_inkscape_svg), IconData.objects.get(id=data.id).svg)
+        self.assertEqual(_inkscape_svg, data.original.svg)
+        self.assertIsNone(data.original.gzip)
+        self.assertIsNone(i.new_version(_svg, None).original)
+        entries = [prepare_svg('a', _inkscape_svg.encode('utf-8')), prepare_svg('b', _svg)]
+        bulk_import(c, entries)
+        a = Icon.objects.get(name='a').current
+        self.assertEqual(data.blob_id, a.blob_id)
+        self.assertEqual(data.original_id, a.original_id)
+        self.assertIsNone(Icon.objects.get(name='b').current.original)
+        r = self.client.get(reverse('iconcommons_icon_view', kwargs={'id': a.icon_id}))
+        self.assertEqual(optimize_svg(_inkscape_svg), r.content.decode())
+
+        out = StringIO()
+        call_command('blobreport', '--prune', stdout=out)
+        self.assertIn('pruned 0 unreferenced blobs', out.getvalue())
+        out = StringIO()
+        call_command('svgsavings', stdout=out)
+        original, served = len(_inkscape_svg) + len(_svg) * 2, len(optimize_svg(_inkscape_svg)) + len(_svg) * 2
+        self.assertIn('default: 1 of 3 icons optimized, %s bytes uploaded, %s bytes served, %s bytes saved' % (
+            original, served, original - served), out.getvalue())
+
+
+class RenderCacheTest(TestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(name='foobar')
+        self.icon = Icon.objects.create(collection=self.collection, name='baz')
+        self.icon.new_version(_svg, None)
+        get_render_cache().clear()
+
+    def get(self, **params):
+        return self.client.get(reverse('iconcommons_icon_view', kwargs={'id': self.icon.id}), params)
+
+    def test_lru_eviction(self):
+        cache = LocalRenderCache(10)
+        cache.set(1, 'a', b'12345')
+        cache.set(2, 'b', b'12345')
+        self.assertEqual(b'12345', cache.get(1, 'a'))
+        cache.set(3, 'c', b'12345')
+        self.assertIsNone(cache.get(2, 'b'))
+        self.assertEqual(b'12345', cache.get(1, 'a'))
+        stats = cache.stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(10, stats['bytes'])
+        self.assertEqual((2, 1), (stats['hits'], stats['misses']))
+        cache.invalidate(1)
+        self.assertEqual(5, cache.stats()['bytes'])
+
+    def test_icon_view_cache(self):
+        r = self.get(fill='#00ff00')
+        self.assertEqual('MISS', r['X-Render-Cache'])
+        r2 = self.get(fill='#00ff00')
+        self.assertEqual('HIT', r2['X-Render-Cache'])
+        self.assertEqual(r.content, r2.content)
+        self.assertEqual('MISS', self.get(fill='#00ff00', stroke='#0000ff')['X-Render-Cache'])
+        self.icon.new_version(_svg.replace('10 10', '8 8'), 'updated')
+        r3 = self.get(fill='#00ff00')
+        self.assertEqual('MISS', r3['X-Render-Cache'])
+        self.assertIn(b'M0 0L8 8', r3.content)
+
+    def test_django_cache_backend(self):
+        with self.settings(ICON_COMMONS_RENDER_CACHE_ALIAS='default'):
+            get_render_cache().clear()
+            self.assertEqual('MISS', self.get(fill='#00ff00')['X-Render-Cache'])
+            self.assertEqual('HIT', self.get(fill='#00ff00')['X-Render-Cache'])
+            self.icon.new_version(_svg, 'updated')
+            self.assertEqual('MISS', self.get(fill='#00ff00')['X-Render-Cache'])
+            self.assertEqual(1, get_render_cache().stats()['hits'])
+            # keys stay valid for memcached whatever the request values are
+            fill = 'rgb(1, 2, 3)' * 30
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', CacheKeyWarning)
+                self.assertEqual('MISS', self.get(fill=fill)['X-Render-Cache'])
+                self.assertEqual('HIT', self.get(fill=fill)['X-Render-Cache'])
+
+
+class RecolorTemplateTest(TestCase):
+    svgs = [
+        _svg,
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<svg xmlns="http://www.w3.org/2000/svg"><!-- \u00e9 -->\n'
+        '<g style="fill:#111"><rect style="stroke:#000; fill:red;" fill="none"/>'
+        '<polygon style="opacity:1" fill="#FFFFFF" stroke="#123"/></g>'
+        '<ellipse style="fill:none;;x" /><line/><polyline stroke="red"/></svg>',
+    ]
+    params = [
+        {}, {'fill': '#00ff00'}, {'stroke': 'blue'}, {'fill': 'rgb(1, 2, 3)', 'stroke': '#abc'},
+        {'fill': '', 'stroke': 'red'}, {'fill': 'a&b<c'},
+    ]
+
+    def test_byte_identical(self):
+        for svg in self.svgs:
+            template = compile_svg(svg)
+            for params in self.params:
+                expected = process_svg(svg, params)
+                rendered = render_template(template, params)
+                if rendered is not None:
+                    self.assertEqual(expected, rendered)
+        self.assertIsNone(render_template(compile_svg(_svg), {'fill': 'a&b'}))
+        for params in ({'fill': 'iconcommonsstrokeslot', 'stroke': 'red'}, {'stroke': 'xiconcommonsfillslot'}):
+            self.assertIsNone(render_template(compile_svg(_svg), params))
+
+    def test_compiled_on_save(self):
+        c = Collection.objects.create(name='default')
+        i = Icon.objects.create(collection=c, name='icon')
+        self.assertIsNone(i.new_version('hi', None).blob.template)
+        data = i.new_version(_svg, None)
+        self.assertTrue(data.blob.template)
+        for params in self.params:
+            self.assertEqual(process_svg(_svg, params), data.render(params))
+
+
+class IconSpriteTest(TestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(name='foobar')
+        self.icon = Icon.objects.create(collection=self.collection, name='baz')
+        self.icon.new_version(_svg, None)
+        self.icon.new_version(_svg.replace('10 10', '8 8'), None)
+        self.other = Icon.objects.create(collection=self.collection, name='qux')
+        self.other.new_version(_svg.replace(' width="10" height="10"', ' viewBox="0 0 4 4"'), None)
+
+    def sprite(self, *icons, **headers):
+        params = {'icon': list(icons), 'format': headers.pop('format', '')}
+        return self.client.get(reverse('iconcommons_icon_sprite'), params, **headers)
+
+    def test_sprite(self):
+        with self.assertNumQueries(1):
+            r = self.sprite(str(self.icon.id), 'foobar/baz@1', 'foobar/qux|fill=#00ff00')
+        self.assertEqual('image/svg+xml', r['Content-Type'])
+        self.assertEqual('*', r['Access-Control-Allow-Origin'])
+        body = r.content.decode()
+        self.assertEqual(3, body.count('<symbol'))
+        self.assertIn('<symbol id="foobar-baz" viewBox="0 0 10 10">', body)
+        self.assertIn('M0 0L8 8', body)
+        self.assertIn('<symbol id="foobar-baz-v1" viewBox="0 0 10 10">', body)
+        self.assertIn('M0 0L10 10', body)
+        self.assertIn('<symbol id="foobar-qux-fill-00ff00" viewBox="0 0 4 4">', body)
+        self.assertIn('fill="#00ff00"', body)
+        self.assertEqual(304, self.sprite(str(self.icon.id), 'foobar/baz@1', 'foobar/qux|fill=#00ff00',
+                                          HTTP_IF_NONE_MATCH=r['ETag']).status_code)
+
+    def test_sprite_json(self):
+        r = self.sprite('foobar/baz', 'foobar/missing', format='json')
+        data = json.loads(r.content.decode())
+        self.assertEqual(['foobar-baz'], list(data.keys()))
+        self.assertIn('M0 0L8 8', data['foobar-baz'])
+
+    def test_sprite_errors(self):
+        self.assertEqual(400, self.sprite().status_code)
+        self.assertEqual(400, self.sprite('foobar/baz|opacity=1').status_code)
+        self.assertEqual(404, self.sprite('foobar/missing').status_code)
+
+
+class IngestTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.write('maki/park.svg', _svg)
+        self.write('maki/rail_station.svg', _svg.replace('10 10', '3 3'))
+        self.write('osm/food/a,cafe.svg', _svg)
+        self.write('maki/broken.svg', '<svg')
+
+    def write(self, path, svg):
+        path = os.path.join(self.dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(svg)
+
+    def ingest(self, *args, **options):
+        out, err = StringIO(), StringIO()
+        call_command('ingest', self.dir, *args, stdout=out, stderr=err, **options)
+        return out.getvalue()
+
+    def test_ingest(self):
+        out = self.ingest(workers=0, batch_size=2)
+        self.assertIn('4 files read, 0 unchanged on disk: 3 created, 0 updated, 0 unchanged, 1 failed', out)
+        self.assertEqual(['maki', 'osm/food'], sorted(Collection.objects.values_list('name', flat=True)))
+        park = Icon.objects.get(name='park.svg')
+        self.assertEqual(_svg, park.current.svg)
+        self.assertEqual(1, park.current_version)
+        self.assertTrue(park.current.blob.template)
+        self.assertEqual(['rail', 'station'], sorted(Icon.objects.get(name='rail_station.svg').tags.names()))
+        self.assertEqual(['a,cafe', 'food'], sorted(Icon.objects.get(name='cafe.svg').tags.names()))
+
+        self.write('maki/park.svg', _svg.replace('10 10', '5 5'))
+        out = self.ingest(workers=2, full=True)
+        self.assertIn('4 files read, 0 unchanged on disk: 0 created, 1 updated, 2 unchanged, 1 failed', out)
+        park = Icon.objects.get(name='park.svg')
+        self.assertEqual(2, park.current_version)
+        self.assertEqual('automatic update', park.current.change_log)
+        self.assertEqual(['park'], list(park.tags.names()))
+
+    def test_incremental(self):
+        self.ingest(workers=0)
+        # only the broken file is retried
+        self.assertIn('1 files read, 3 unchanged on disk', self.ingest(workers=0))
+        os.remove(os.path.join(self.dir, 'maki/broken.svg'))
+        with self.assertNumQueries(1):
+            out = self.ingest(workers=0)
+        self.assertIn('0 files read, 3 unchanged on disk', out)
+        self.write('maki/park.svg', _svg.replace('10 10', '5 5'))
+        os.utime(os.path.join(self.dir, 'maki/rail_station.svg'), ns=(0, 0))
+        out = self.ingest(workers=0)
+        self.assertIn('2 files read, 1 unchanged on disk: 0 created, 1 updated, 1 unchanged, 0 failed', out)
+        self.assertEqual(2, Icon.objects.get(name='park.svg').current_version)
+
+        os.remove(os.path.join(self.dir, 'maki/park.svg'))
+        out = self.ingest(workers=0, mark_missing='gone')
+        self.assertIn('1 missing', out)
+        self.assertIn('gone', Icon.objects.get(name='park.svg').tags.names())
+        self.assertIn('0 missing', self.ingest(workers=0, mark_missing='gone'))
+        self.write('maki/park.svg', _svg)
+        out = self.ingest(workers=0, mark_missing='gone')
+        self.assertIn('0 created, 1 updated', out)
+        self.assertNotIn('gone', Icon.objects.get(name='park.svg').tags.names())
+        os.remove(os.path.join(self.dir, 'maki/park.svg'))
+        self.assertIn('1 missing', self.ingest(workers=0))
+        self.assertFalse(IngestManifest.objects.filter(path__endswith='park.svg').exists())
+
+    def test_locked_icons(self):
+        collection = Collection.objects.create(name='maki')
+        features = connection.features
+        # as on PostgreSQL, which can not lock the outer joined current version
+        with mock.patch.multiple(features, has_select_for_update=True, has_select_for_update_of=True):
+            query = locked_icons(collection, ['park']).query
+            sql, params = query.get_compiler(connection=connection).as_sql()
+        self.assertIn('LEFT OUTER JOIN', sql)
+        self.assertTrue(sql.endswith('FOR UPDATE OF "icon_commons_icon"'), sql)
+
+    def test_dry_run(self):
+        out = self.ingest(workers=0, dry_run=True)
+        self.assertIn('3 created', out)
+        self.assertIn('dry run', out)
+        self.assertEqual(0, Icon.objects.count())
+
+
+@override_settings(ICON_COMMONS_UPLOAD_JOBS=None)
+class UploadTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='demo')
+        self.client.force_login(self.user)
+
+    def zip(self, members):
+        fp = BytesIO()
+        with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, svg in members.items():
+                archive.writestr(name, svg)
+        return SimpleUploadedFile('icons.zip', fp.getvalue(), 'application/zip')
+
+    def upload(self, upload, tags='a, b'):
+        return self.client.post(reverse('upload'), {'tags': tags, 'svg': upload})
+
+    def test_upload_page(self):
+        self.assertEqual(200, self.client.get(reverse('upload')).status_code)
+
+    def test_upload_zip(self):
+        members = dict(('dir/icon%s.svg' % i, _svg.replace('10 10', '%s %s' % (i, i))) for i in range(20))
+        members['readme.txt'] = 'hi'
+        members['dir/broken.svg'] = '<svg'
+        with CaptureQueriesContext(connection) as queries:
+            r = self.upload(self.zip(members))
+        # a fixed number of bulk queries, not a few per icon
+        self.assertLess(len(queries), 30)
+        self.assertEqual(200, r.status_code)
+        self.assertContains(r, 'Congratulations')
+        self.assertContains(r, 'Skipped dir/broken.svg')
+        icons = Icon.objects.filter(collection__name='uploader')
+        self.assertEqual(20, icons.count())
+        icon = icons.get(name='icon3')
+        self.assertEqual(self.user, icon.owner)
+        self.assertEqual(['a', 'b'], sorted(icon.tags.names()))
+        self.assertEqual('initial import', icon.current.change_log)
+
+        members['dir/icon3.svg'] = _svg
+        self.upload(self.zip(members))
+        icon = Icon.objects.get(id=icon.id)
+        self.assertEqual(2, icon.current_version)
+        self.assertEqual('automatic update', icon.current.change_log)
+        self.assertEqual(1, Icon.objects.get(name='icon4').current_version)
+
+    def test_upload_svg(self):
+        self.upload(SimpleUploadedFile('park.svg', _svg.encode('utf-8'), 'image/svg+xml'))
+        self.assertEqual(_svg, Icon.objects.get(name='park').current.svg)
+        r = self.upload(SimpleUploadedFile('bad.svg', b'<svg', 'image/svg+xml'))
+        self.assertContains(r, 'bad')
+        self.assertFalse(Icon.objects.filter(name='bad').exists())
+
+    def test_upload_limits(self):
+        members = dict(('icon%s.svg' % i, _svg) for i in range(3))
+        with self.settings(ICON_COMMONS_UPLOAD_MAX_MEMBERS=2):
+            self.assertContains(self.upload(self.zip(members)), 'Too many icons')
+        with self.settings(ICON_COMMONS_UPLOAD_MAX_BYTES=len(_svg) * 2):
+            self.assertContains(self.upload(self.zip(members)), 'Zip file is too large')
+        self.assertEqual(0, Icon.objects.count())
+
+
+@override_settings(ICON_COMMONS_UPLOAD_JOBS='worker')
+class UploadJobTest(UploadTest):
+    def status(self, job):
+        return json.loads(self.client.get(reverse('iconcommons_upload_job', kwargs={'id': job}),
+                                          HTTP_ACCEPT='application/json').content.decode())
+
+    def test_upload_zip(self):
+        members = dict(('icon%s.svg' % i, _svg.replace('10 10', '%s %s' % (i, i))) for i in range(5))
+        members['broken.svg'] = '<svg'
+        r = self.client.post(reverse('upload'), {'tags': 'a', 'svg': self.zip(members)},
+                             HTTP_ACCEPT='application/json')
+        self.assertEqual(202, r.status_code)
+        job = json.loads(r.content.decode())['job']
+        self.assertEqual('queued', self.status(job)['status'])
+        self.assertEqual(0, Icon.objects.count())
+        call_command('process_upload_jobs', once=True, stdout=StringIO())
+        status = self.status(job)
+        self.assertEqual('done', status['status'])
+        self.assertEqual((6, 5, 1), (status['total'], status['processed'], status['failed']))
+        self.assertIn('broken.svg', status['errors'][0])
+        self.assertEqual(5, Icon.objects.filter(collection__name='uploader').count())
+        self.assertIsNone(UploadJob.objects.get(id=job).archive)
+
+        other = User.objects.create_user(username='other', password='demo')
+        self.client.force_login(other)
+        self.assertEqual(404, self.client.get(reverse('iconcommons_upload_job', kwargs={'id': job})).status_code)
+
+    def test_upload_limits(self):
+        members = dict(('icon%s.svg' % i, _svg) for i in range(3))
+        # checked before the archive is stored
+        with self.settings(ICON_COMMONS_UPLOAD_MAX_MEMBERS=2):
+            r = self.upload(self.zip(members))
+        self.assertEqual(200, r.status_code)
+        self.assertContains(r, 'Too many icons')
+        self.assertEqual(0, UploadJob.objects.count())
+        # and again by the worker
+        self.assertEqual(202, self.upload(self.zip(members)).status_code)
+        with self.settings(ICON_COMMONS_UPLOAD_MAX_MEMBERS=2):
+            call_command('process_upload_jobs', once=True, stdout=StringIO())
+        job = UploadJob.objects.get()
+        self.assertEqual('failed', job.status)
+        self.assertIn('Too many icons', job.errors)
+        self.assertEqual(0, Icon.objects.count())
+
+    def test_stale_and_failing_jobs(self):
+        members = dict(('icon%s.svg' % i, _svg.replace('10 10', '%s %s' % (i, i))) for i in range(3))
+        for i in range(3):
+            self.assertEqual(202, self.upload(self.zip(members)).status_code)
+        first, second, third = UploadJob.objects.order_by('id').values_list('id', flat=True)
+        # a runner stopped halfway through the first, the second fails to import
+        UploadJob.objects.filter(id=first).update(status=UploadJob.RUNNING, processed=1,
+                                                  heartbeat=timezone.now() - timedelta(hours=1))
+        with mock.patch('icon_commons.jobs._import', side_effect=[None, RuntimeError('boom'), None]) as run:
+            with self.assertLogs('icon_commons.jobs', 'ERROR'):
+                self.assertEqual(3, run_queued())
+        self.assertEqual([first, second, third], [c[0][0].id for c in run.call_args_list])
+        self.assertEqual('failed', UploadJob.objects.get(id=second).status)
+        self.assertIn('boom', UploadJob.objects.get(id=second).errors)
+        # recently active jobs are left to their runner
+        UploadJob.objects.filter(id=first).update(status=UploadJob.RUNNING, heartbeat=timezone.now())
+        self.assertEqual([], requeue_stale())
+        # _import was mocked out, the first and third never finished
+        self.assertEqual([first, third], sorted(requeue_stale(timeout=-1)))
+        self.assertEqual(0, UploadJob.objects.get(id=first).processed)
+
+
+class CompressionTest(TestCase):
+    svg = _svg.replace('</svg>', '<path d="M0 0L1 1"/>' * 20 + '</svg>')
+
+    def setUp(self):
+        self.collection = Collection.objects.create(name='foobar')
+        self.icon = Icon.objects.create(collection=self.collection, name='baz')
+        self.data = self.icon.new_version(self.svg, None)
+        self.url = reverse('iconcommons_icon_view', kwargs={'id': self.icon.id})
+        get_render_cache().clear()
+
+    def test_gzip(self):
+        r = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', r['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', r['Vary'])
+        self.assertEqual(str(len(r.content)), r['Content-Length'])
+        self.assertLess(len(r.content), len(self.svg))
+        self.assertEqual(self.svg, gzip.decompress(r.content).decode())
+        self.assertEqual('"%s-gzip"' % self.data.sha256, r['ETag'])
+        r2 = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(304, r2.status_code)
+        self.assertEqual(r['ETag'], r2['ETag'])
+
+        r = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(r.has_header('Content-Encoding'))
+        self.assertEqual(self.svg, r.content.decode())
+        self.assertEqual('Accept-Encoding', r['Vary'])
+
+    def test_recolored(self):
+        r = self.client.get(self.url, {'fill': 'red'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', r['Content-Encoding'])
+        self.assertEqual(process_svg(self.svg, {'fill': 'red'}), gzip.decompress(r.content))
+        r = self.client.get(self.url, {'fill': 'red'})
+        self.assertEqual('HIT', r['X-Render-Cache'])
+        self.assertFalse(r.has_header('Content-Encoding'))
+        self.assertEqual(process_svg(self.svg, {'fill': 'red'}), r.content)
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        r = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual('br', r['Content-Encoding'])
+        self.assertEqual(self.svg, brotli.decompress(r.content).decode())
+        with mock.patch.object(brotli, 'compress', wraps=brotli.compress) as compress:
+            compress_svg(self.svg)
+            with override_settings(ICON_COMMONS_BROTLI_QUALITY=11):
+                compress_svg(self.svg)
+        self.assertEqual([9, 11], [kwargs['quality'] for args, kwargs in compress.call_args_list])
+
+
+@override_settings(ICON_COMMONS_TAG_INDEX_CACHE='default')
+class TagIndexTest(TransactionTestCase):
+    def setUp(self):
+        tagindex.invalidate()
+        self.collection = Collection.objects.create(name='foobar')
+        self.icon = Icon.objects.create(collection=self.collection, name='baz')
+        self.icon.tags.add('Park', 'parking', 'car-park', 'garden')
+
+    def search(self, query, **params):
+        params['query'] = query
+        r = self.client.get(reverse('iconcommons_search_tags'), params)
+        return json.loads(r.content.decode())['tags']
+
+    def test_search(self):
+        index = tagindex.TagIndex()
+        counts = {'park': 1, 'Parking': 3, 'car-park': 2, 'garden': 5}
+        icons = [(i, 'icon%s' % i, 1) for i in range(5)]
+        index.load(icons, [(i, name) for name, n in counts.items() for i in range(n)])
+        self.assertEqual(['Parking', 'park'], index.search('PAR'))
+        self.assertEqual(['Parking', 'car-park', 'park'], index.search('park'))
+        self.assertEqual(['Parking'], index.search('park', 1))
+        self.assertEqual([], index.search('parks'))
+        index.update(added=[(1, 'park'), (2, 'park'), (0, 'pare')],
+                     removed=[(i, 'garden') for i in range(5)])
+        self.assertEqual(['park', 'Parking', 'pare'], index.search('pa'))
+        self.assertEqual([], index.search('gar'))
+        self.assertEqual([], index.search('arde'))
+        index.update(deleted=[0, 1])
+        self.assertEqual(['park', 'Parking'], index.search('pa'))
+
+    def test_filter(self):
+        index = tagindex.TagIndex()
+        index.load([(1, 'b', 1), (2, 'a', 1), (3, 'c', 2), (4, 'd', 2)],
+                   [(1, 'red'), (2, 'red'), (3, 'red'), (2, 'big'), (3, 'big'), (4, 'big'), (4, 'small')])
+        self.assertEqual([2, 1, 3], index.filter(['red']))
+        self.assertEqual([2, 1, 3, 4], index.filter(['red', 'big']))
+        self.assertEqual([2, 3], index.filter(['red', 'big'], match_all=True))
+        self.assertEqual([3], index.filter(['red', 'big'], collection=2, match_all=True))
+        self.assertEqual([3, 4], index.filter(collection=2))
+        self.assertEqual([], index.filter(['red', 'nope'], match_all=True))
+        self.assertEqual([('big', 2), ('red', 1), ('small', 1)], index.facets([3, 4]))
+        self.assertEqual([('red', 1)], index.facets([3, 4], exclude=['big'], limit=1))
+        # renamed and moved to another collection
+        index.update(icons=[(1, 'z', 2)])
+        self.assertEqual([3, 1], index.filter(['red'], collection=2))
+
+    def check_icon_list(self):
+        other = Icon.objects.create(collection=self.collection, name='abc')
+        other.tags.add('Park', 'garden')
+        third = Icon.objects.create(collection=Collection.objects.create(name='other'), name='xyz')
+        third.tags.add('Park', 'tree')
+
+        def icons(collection=None, **params):
+            kwargs = {'collection': collection} if collection else {}
+            r = self.client.get(reverse('iconcommons_collection_icons' if collection else 'iconcommons_icon_list',
+                                        kwargs=kwargs), params)
+            return json.loads(r.content.decode())
+
+        self.assertEqual(['baz', 'xyz'], [i['name'] for i in icons(tag=['parking', 'tree'])['icons']])
+        data = icons(tag=['Park', 'garden'], match='all', facets='')
+        self.assertEqual(['abc', 'baz'], [i['name'] for i in data['icons']])
+        self.assertEqual(2, data['count'])
+        self.assertEqual([{'name': 'car-park', 'count': 1}, {'name': 'parking', 'count': 1}], data['facets'])
+        self.assertEqual(['xyz'], [i['name'] for i in icons('other', tag='Park')['icons']])
+        self.assertEqual([], icons('missing', tag='Park')['icons'])
+        data = icons(str(self.collection.id), facets='1')
+        self.assertEqual(2, data['count'])
+        self.assertEqual([{'name': 'Park', 'count': 2}], data['facets'])
+        return icons
+
+    def test_icon_list(self):
+        icons = self.check_icon_list()
+        # only the validator and the page of icons are read from the db
+        with self.assertNumQueries(2):
+            icons(tag='Park')
+        with mock.patch.object(IconList, 'paginate_by', 1):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(['xyz'], [i['name'] for i in icons(tag='Park', page='last')['icons']])
+        # both for the last page's icon alone
+        icon = Icon.objects.get(name='xyz')
+        for query in queries.captured_queries:
+            self.assertIn('IN (%s)' % icon.id, query['sql'])
+
+    def test_without_index(self):
+        with override_settings(ICON_COMMONS_TAG_INDEX_CACHE=None):
+            self.assertIsNone(tagindex.get_tag_index())
+            self.check_icon_list()
+            self.assertEqual(['Park', 'parking'], self.search('par'))
+            self.assertEqual(['Park'], self.search('par', limit=1))
+            self.assertEqual(['Park', 'car-park', 'parking'], self.search('park'))
+            # changes made meanwhile aren't applied to the index
+            self.icon.tags.remove('parking')
+        self.assertEqual(['Park'], self.search('par'))
+
+    def test_incremental(self):
+        self.assertEqual(['Park', 'parking'], self.search('par'))
+        other = Icon.objects.create(collection=self.collection, name='other')
+        other.tags.add('parking')
+        index = tagindex.get_tag_index()
+        version = index.version
+        # changes are applied in place, searching doesn't reload from the db
+        with self.assertNumQueries(0):
+            self.assertEqual(['parking', 'Park'], tagindex.get_tag_index().search('par'))
+        self.icon.tags.remove('parking', 'garden')
+        other.delete()
+        self.assertEqual(['car-park', 'Park'], self.search('park'))
+        self.assertEqual(['Park'], self.search('par', limit=1))
+        # applied in place again, not reloaded
+        self.assertEqual(cache.get(tagindex._version_key), index.version)
+        self.assertGreater(index.version, version)
+
+    def test_bulk_import(self):
+        self.assertEqual(['garden'], self.search('gar'))
+        bulk_import(self.collection, [prepare_svg('new', _svg, ['garage', 'garden'])])
+        with self.assertNumQueries(0):
+            self.assertEqual(['garden', 'garage'], tagindex.get_tag_index().search('gar'))
+
+    def test_other_process(self):
+        self.assertEqual(['garden'], self.search('gar'))
+        # a write that bypassed this process's signal handlers
+        items = self.icon.tags.through.objects.filter(tag__name='garden')
+        items.update(tag=Tag.objects.create(name='gardens'))
+        self.assertEqual(['garden'], self.search('gar'))
+        # is picked up once the writer bumps the shared version
+        cache.incr(tagindex._version_key)
+        self.assertEqual(['gardens'], self.search('gar'))
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(name='maki')
+        self.park = Icon.objects.create(collection=self.collection, name='park')
+        self.park.tags.add('green')
+        self.park.new_version(_svg, None)
+        self.park.new_version(_svg.replace('10', '20'), 'bigger')
+        other = Collection.objects.create(name='osm')
+        self.shop = Icon.objects.create(collection=other, name='shop.svg')
+        self.shop.new_version('<svg/>', None)
+        # no versions yet, not exported
+        Icon.objects.create(collection=other, name='empty')
+
+    def export(self, **params):
+        r = self.client.get(reverse('iconcommons_export'), params)
+        self.assertEqual(200, r.status_code)
+        self.assertIn('X-Export-Time', r)
+        return b''.join(r.streaming_content)
+
+    def test_ndjson(self):
+        lines = [json.loads(l) for l in self.export().decode().splitlines()]
+        self.assertEqual(['park', 'shop.svg'], [l['name'] for l in lines])
+        park = lines[0]
+        self.assertEqual(2, park['version'])
+        self.assertEqual(_svg.replace('10', '20'), park['svg'])
+        self.assertEqual(['green'], park['tags'])
+        self.assertEqual({'id': self.collection.id, 'name': 'maki', 'slug': 'maki'}, park['collection'])
+        self.assertEqual('/icon/%s' % self.park.id, park['href'])
+        self.assertEqual(['shop.svg'], [json.loads(l)['name'] for l in
+                                        self.export(collection='osm').decode().splitlines()])
+        self.assertEqual(1, len(self.export(collection=str(self.collection.id)).splitlines()))
+
+    def test_since(self):
+        Icon.objects.filter(id=self.shop.id).update(modified=datetime(2020, 1, 1))
+        IconData.objects.filter(icon=self.shop).update(modified=datetime(2020, 1, 1))
+        self.assertEqual(1, len(self.export(since='2021-01-01').splitlines()))
+        self.assertEqual(2, len(self.export(since='2019-12-31T12:00:00').splitlines()))
+        r = self.client.get(reverse('iconcommons_export'), {'since': 'yesterday'})
+        self.assertEqual(400, r.status_code)
+        r = self.client.get(reverse('iconcommons_export'), {'format': 'tar'})
+        self.assertEqual(400, r.status_code)
+
+    def test_zip(self):
+        archive = zipfile.ZipFile(BytesIO(self.export(format='zip')))
+        self.assertEqual(['maki/park.svg', 'osm/shop.svg'], archive.namelist())
+        self.assertEqual('<svg/>', archive.read('osm/shop.svg').decode())
+        # names that clean up to the same member are told apart by id
+        other = Icon.objects.create(collection=self.collection, name='Park')
+        other.new_version('<svg/>', None)
+        archive = zipfile.ZipFile(BytesIO(self.export(format='zip')))
+        self.assertEqual(['maki/park.svg', 'osm/shop.svg', 'maki/Park-%s.svg' % other.id], archive.namelist())
+
+    def test_command(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        path = os.path.join(d, 'icons.zip')
+        err = StringIO()
+        call_command('export', format='zip', collection='maki', output=path, stderr=err)
+        self.assertEqual(['maki/park.svg'], zipfile.ZipFile(path).namelist())
+        self.assertIn('1 icons exported, use --since ', err.getvalue())
+
+
+class PublishTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.collection = Collection.objects.create(name='Maki')
+        self.park = Icon.objects.create(collection=self.collection, name='Park')
+        self.park.new_version(_svg, None)
+        self.shop = Icon.objects.create(collection=self.collection, name='shop')
+        self.shop.new_version('<svg/>', None)
+
+    def publish(self, **options):
+        out = StringIO()
+        call_command('publish', self.root, stdout=out, **options)
+        return out.getvalue().strip()
+
+    def read(self, path):
+        with open(os.path.join(self.root, path), 'rb') as fp:
+            return fp.read()
+
+    def test_publish(self):
+        self.assertEqual('2 icons written, 0 unchanged, 0 removed, 1 collection indexes written', self.publish())
+        # the same paths IconView answers
+        self.assertEqual(_svg.encode(), self.read('maki/park'))
+        self.assertEqual(_svg.encode(), self.read('icon/%s' % self.park.id))
+        self.assertEqual(self.client.get('/maki/park').content, self.read('maki/park'))
+        self.assertEqual(b'<svg/>', gzip.decompress(self.read('maki/shop.gz')))
+        index = json.loads(self.read('maki/index.json').decode())
+        self.assertEqual(['Park', 'shop'], [i['name'] for i in index['icons']])
+        self.assertEqual('maki/park', index['icons'][0]['path'])
+        self.assertEqual([{'id': self.collection.id, 'slug': 'maki', 'icons': 2, 'index': 'maki/index.json'}],
+                         json.loads(self.read('collections.json').decode()))
+        self.assertEqual([], [f for f in os.listdir(os.path.join(self.root, 'maki')) if f.startswith('.tmp')])
+
+        # only what changed is written again
+        self.assertEqual('0 icons written, 2 unchanged, 0 removed, 0 collection indexes written', self.publish())
+        self.park.new_version('<svg>2</svg>', None)
+        self.assertEqual('1 icons written, 1 unchanged, 0 removed, 1 collection indexes written', self.publish())
+        self.assertEqual(b'<svg>2</svg>', self.read('maki/park'))
+
+        # renames move the file, deletes remove it
+        self.shop.name = 'store'
+        self.shop.save()
+        self.park.delete()
+        self.assertEqual('1 icons written, 0 unchanged, 1 removed, 1 collection indexes written', self.publish())
+        self.assertEqual(['index.json', 'store', 'store.gz'], sorted(os.listdir(os.path.join(self.root, 'maki'))))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'icon', str(self.park.id))))
+
+    def test_collection_rename(self):
+        self.publish()
+        self.collection.name = 'Temaki'
+        self.collection.save()
+        self.assertEqual('2 icons written, 0 unchanged, 0 removed, 1 collection indexes written', self.publish())
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'maki', 'park')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'maki', 'index.json')))
+        self.assertEqual(_svg.encode(), self.read('temaki/park'))
+        self.assertEqual('temaki', json.loads(self.read('collections.json').decode())[0]['slug'])
+
+
+@override_settings(ICON_COMMONS_TAG_INDEX_CACHE='default')
+class JSONValidatorTest(TestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(name='maki')
+        self.icon = Icon.objects.create(collection=self.collection, name='park')
+        self.icon.tags.add('green')
+        self.icon.new_version(_svg, None)
+        tagindex.invalidate()
+
+    def revalidate(self, url, **params):
+        r = self.client.get(url, params)
+        self.assertEqual(200, r.status_code)
+        etag = r['ETag']
+        r = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        return etag, r
+
+    def test_not_modified(self):
+        urls = [reverse('iconcommons_icon_list'), reverse('iconcommons_collection_list'),
+                reverse('iconcommons_icon_info_view', kwargs={'id': self.icon.id}),
+                reverse('iconcommons_collection_icons', kwargs={'collection': 'maki'})]
+        for url in urls:
+            etag, r = self.revalidate(url)
+            self.assertEqual(304, r.status_code, url)
+            self.assertEqual(etag, r['ETag'])
+            self.assertEqual(b'', r.content)
+        # 304s are answered from the validator query alone
+        etag, r = self.revalidate(reverse('iconcommons_icon_list'))
+        with self.assertNumQueries(1):
+            r = self.client.get(reverse('iconcommons_icon_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, r.status_code)
+        # the tag index is loaded by the first search
+        etag = self.client.get(reverse('iconcommons_search_tags'), {'query': 'gr'})['ETag']
+        with self.assertNumQueries(0):
+            r = self.client.get(reverse('iconcommons_search_tags'), {'query': 'gr'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, r.status_code)
+        # the params are part of the validator
+        r = self.client.get(reverse('iconcommons_search_tags'), {'query': 'gre'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, r.status_code)
+        r = self.client.get(reverse('iconcommons_icon_list'), {'page': 1})
+        self.assertTrue(r['Last-Modified'])
+        r = self.client.get(reverse('iconcommons_icon_list'), {'page': 1}, HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+        self.assertEqual(304, r.status_code)
+
+    def test_modified_since_without_modified(self):
+        since = 'Sat, 01 Jan 2000 00:00:00 GMT'
+        r = self.client.get(reverse('iconcommons_search_tags'), {'query': 'gr'}, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(200, r.status_code)
+        Icon.objects.all().delete()
+        r = self.client.get(reverse('iconcommons_icon_list'), HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual([], json.loads(r.content.decode())['icons'])
+
+    def test_changes(self):
+        lists = reverse('iconcommons_icon_list')
+        etag, r = self.revalidate(lists)
+        Icon.objects.create(collection=self.collection, name='shop')
+        self.assertEqual(200, self.client.get(lists, HTTP_IF_NONE_MATCH=etag).status_code)
+        etag, r = self.revalidate(lists)
+        Icon.objects.filter(name='shop').delete()
+        self.assertEqual(200, self.client.get(lists, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        info = reverse('iconcommons_icon_info_view', kwargs={'id': self.icon.id})
+        etag, r = self.revalidate(info)
+        Icon.objects.filter(id=self.icon.id).update(modified=self.icon.modified.replace(year=2000))
+        self.assertEqual(200, self.client.get(info, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        tags = reverse('iconcommons_search_tags')
+        etag, r = self.revalidate(tags, query='gr')
+        self.icon.tags.add('grey')
+        tagindex.invalidate()
+        r = self.client.get(tags, {'query': 'gr'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(['green', 'grey'], json.loads(r.content.decode())['tags'])
+
+        collections = reverse('iconcommons_collection_list')
+        etag, r = self.revalidate(collections)
+        self.collection.name = 'temaki'
+        self.collection.save()
+        self.assertEqual(200, self.client.get(collections, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    @override_settings(ICON_COMMONS_TAG_INDEX_CACHE=None)
+    def test_without_tag_index(self):
+        tags = reverse('iconcommons_search_tags')
+        etag, r = self.revalidate(tags, query='gr')
+        self.assertEqual(304, r.status_code)
+        self.icon.tags.add('grey')
+        r = self.client.get(tags, {'query': 'gr'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(['green', 'grey'], json.loads(r.content.decode())['tags'])
+
+        info = reverse('iconcommons_icon_info_view', kwargs={'id': self.icon.id})
+        etag, r = self.revalidate(info)
+        self.assertEqual(304, r.status_code)
+        self.icon.tags.remove('grey')
+        r = self.client.get(info, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(['green'], [t['name'] for t in json.loads(r.content.decode())['tags']])
+        with self.assertNumQueries(3):
+            self.client.get(info)
+
+        # no validator tells tag changes of the listed icons
+        for params in ({'tag': 'green'}, {'facets': ''}, {'fields': 'tags'}):
+            r = self.client.get(reverse('iconcommons_icon_list'), params)
+            self.assertEqual(200, r.status_code)
+            self.assertFalse(r.has_header('ETag'))
+
+    def test_renames(self):
+        info = reverse('iconcommons_icon_info_view', kwargs={'id': self.icon.id})
+        etag, r = self.revalidate(info)
+        self.collection.name = 'temaki'
+        self.collection.save()
+        r = self.client.get(info, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('temaki', json.loads(r.content.decode())['collection']['name'])
+
+        owner = User.objects.create_user('bob')
+        Icon.objects.filter(id=self.icon.id).update(owner=owner)
+        for url, params in ((reverse('iconcommons_icon_list'), {}), (reverse('iconcommons_icon_list'), {'tag': 'green'})):
+            etag, r = self.revalidate(url, **params)
+            self.assertEqual(304, r.status_code)
+            owner.username = 'robert'
+            owner.save()
+            r = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(200, r.status_code)
+            self.assertEqual('robert', json.loads(r.content.decode())['icons'][0]['owner'])
+            owner.username = 'bob'
+            owner.save()
+
+    @override_settings(ICON_COMMONS_JSON_CACHE_ALIAS='default')
+    def test_body_cache(self):
+        url = reverse('iconcommons_icon_list')
+        body = self.client.get(url).content
+        with self.assertNumQueries(1):
+            self.assertEqual(body, self.client.get(url).content)
+        r = self.client.get(url, {'callback': 'cb'})
+        self.assertEqual('application/javascript', r['Content-Type'])
+        self.assertTrue(r.content.startswith(b'cb('))
+
+
+@override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['icon_commons.metrics.MetricsMiddleware'])
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(name='maki')
+        self.icon = Icon.objects.create(collection=self.collection, name='park')
+        self.icon.new_version(_svg, None)
+        get_render_cache().clear()
+        registry.clear()
+
+    def timings(self, r):
+        return dict((p.split(';')[0], p) for p in r['Server-Timing'].split(', '))
+
+    def test_server_timing(self):
+        r = self.client.get(reverse('iconcommons_icon_view', kwargs={'id': self.icon.id}), {'fill': '#ff0000'})
+        timings = self.timings(r)
+        self.assertIn('desc="1 queries"', timings['db'])
+        self.assertEqual(['db', 'svg', 'total'], sorted(timings))
+        r = self.client.get(reverse('iconcommons_icon_list'))
+        self.assertIn('serialize', self.timings(r))
+        with override_settings(MIDDLEWARE=settings.MIDDLEWARE[:-1]):
+            r = Client().get(reverse('iconcommons_icon_list'))
+            self.assertFalse(r.has_header('Server-Timing'))
+
+    def test_endpoint(self):
+        url = reverse('iconcommons_metrics')
+        self.assertEqual(404, self.client.get(url).status_code)
+        self.client.get(reverse('iconcommons_icon_view', kwargs={'id': self.icon.id}), {'fill': '#ff0000'})
+        self.client.get(reverse('iconcommons_icon_view', kwargs={'id': self.icon.id}), {'fill': '#ff0000'})
+        with override_settings(ICON_COMMONS_METRICS_ENDPOINT=True):
+            self.assertEqual(404, self.client.get(url, REMOTE_ADDR='10.0.0.1').status_code)
+            r = self.client.get(url)
+        self.assertEqual(200, r.status_code)
+        text = r.content.decode()
+        self.assertIn('icon_commons_request_phase_seconds_count{view="iconcommons_icon_view",phase="svg"} 1', text)
+        self.assertIn('icon_commons_request_phase_seconds_count{view="iconcommons_icon_view",phase="total"} 2', text)
+        self.assertIn('icon_commons_request_queries_bucket{view="iconcommons_icon_view",le="1"} 2', text)
+        self.assertIn('icon_commons_request_queries_bucket{view="iconcommons_icon_view",le="+Inf"} 2', text)
+        self.assertIn('icon_commons_render_cache_hits_total{backend="local"} ', text)
+        self.assertIn('icon_commons_render_cache_entries{backend="local"} 1', text)
+
+    def test_slow_log(self):
+        with override_settings(ICON_COMMONS_METRICS_SLOW_MS=0):
+            with self.assertLogs('icon_commons.metrics', 'WARNING') as logs:
+                self.client.get(reverse('iconcommons_collection_list'))
+        self.assertIn('slow GET /collections', logs.output[0])
+
+
+@override_settings(DATABASE_ROUTERS=['icon_commons.routers.ReplicaRouter'], ICON_COMMONS_READ_REPLICAS=['replica'])
+class ReplicaTest(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        # the replica lags behind, it hasn't seen the rename yet
+        Collection.objects.create(name='maki')
+        Collection.objects.using('replica').create(name='temaki')
+        cache.clear()
+
+    def names(self, client=None):
+        r = (client or self.client).get(reverse('iconcommons_collection_list'))
+        return [c['name'] for c in json.loads(r.content.decode())['collections']]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(['temaki'], self.names())
+        with override_settings(ICON_COMMONS_READ_REPLICAS=[]):
+            self.assertEqual(['maki'], self.names())
+
+    def test_read_your_writes(self):
+        user = User.objects.create_user('bob')
+        self.client.force_login(user)
+        r = self.client.post(reverse('upload'), {
+            'tags': 'a', 'svg': SimpleUploadedFile('park.svg', _svg.encode(), 'image/svg+xml')})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(10, r.cookies['icon_commons_primary']['max-age'])
+        self.assertEqual(['bob', 'maki'], self.names())
+        self.client.cookies.pop('icon_commons_primary')
+        self.assertEqual(['temaki'], self.names())
+
+    def test_failover(self):
+        with mock.patch.object(connections['replica'], 'ensure_connection', side_effect=OperationalError('down')):
+            with self.assertLogs('icon_commons.views', 'WARNING'):
+                self.assertEqual(['maki'], self.names())
+        self.assertIn('replica', get_selector().failed)
+        # skipped until it is retried
+        self.assertEqual(['maki'], self.names())
+        with override_settings(ICON_COMMONS_REPLICA_RETRY_SECONDS=0):
+            self.assertEqual(['temaki'], self.names())
+
+    def test_selector(self):
+        selector = ReplicaSelector(['a', 'b'])
+        self.assertEqual(['a', 'b', 'a'], [selector.choose() for i in range(3)])
+        selector.mark_failed('a')
+        self.assertEqual(['b', 'b'], [selector.choose() for i in range(2)])
+        selector.mark_failed('b')
+        self.assertIsNone(selector.choose())
+        selector = ReplicaSelector(['a', 'b'], 'least-recently-failed')
+        selector.mark_failed('a')
+        selector.mark_failed('b')
+        self.assertEqual(['a', 'a'], [selector.choose() for i in range(2)])
+        with self.assertRaises(ValueError):
+            ReplicaSelector(['a'], 'random')
+
+
+def _versioned_svg(n):
+    # a long path where each version moves one point
+    points = ' '.join('L%d %d' % (i, (i * 7 + (n if i == n * 3 else 0)) % 100) for i in range(200))
+    return '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><path d="M0 0 %s"/></svg>' % points
+
+
+class DeltaTest(TestCase):
+    def setUp(self):
+        self.collection = Collection.objects.create(name='maki')
+        self.icon = Icon.objects.create(collection=self.collection, name='park')
+        get_render_cache().clear()
+        deltas.get_version_cache().clear()
+
+    def responses(self):
+        """Everything the views answer about each version of the icon."""
+        get_render_cache().clear()
+        deltas.get_version_cache().clear()
+        url = reverse('iconcommons_icon_view', kwargs={'id': self.icon.id})
+        responses = []
+        for version in range(1, self.icon.current_version + 1):
+            for params, encoding in (({}, 'identity'), ({}, 'gzip, br'), ({'fill': '#ff0000'}, 'gzip')):
+                r = self.client.get(url, dict(params, version=version), HTTP_ACCEPT_ENCODING=encoding)
+                responses.append((r.status_code, r.content, r['ETag'], r['Last-Modified'],
+                                  r.get('Content-Encoding')))
+        r = self.client.get(reverse('iconcommons_icon_info_view', kwargs={'id': self.icon.id}))
+        responses.append((r.status_code, r.content))
+        return responses
+
+    def stored(self):
+        return [d is None for d in IconData.objects.filter(icon=self.icon).order_by('version').values_list(
+            'blob', flat=True)]
+
+    def test_encode_apply(self):
+        for base, svg in ((_svg, _versioned_svg(1)), (_versioned_svg(1), _versioned_svg(2)), (_svg, _svg),
+                          ('', _svg), (_svg, ''), ('<text>caf\u00e9</text>', '<text>na\u00efve caf\u00e9</text>')):
+            self.assertEqual(svg, deltas.apply(base, deltas.encode(base, svg)))
+        self.assertLess(len(deltas.encode(_versioned_svg(1), _versioned_svg(2))), 100)
+
+    def test_compact(self):
+        for n in range(1, 8):
+            self.icon.new_version(_versioned_svg(n), 'v%s' % n)
+        before = self.responses()
+        out = StringIO()
+        call_command('compacthistory', keyframe=3, stdout=out)
+        self.assertIn('4 versions delta encoded, 0 restored', out.getvalue())
+        self.assertEqual([True, True, False, True, True, False, False], self.stored())
+        self.assertFalse(SVGBlob.objects.filter(icondata__isnull=True, originals__isnull=True).exists())
+        self.assertEqual(before, self.responses())
+        # versions of the same icon share the reconstructed ones
+        deltas.get_version_cache().clear()
+        with self.assertNumQueries(2):
+            IconData.objects.get(icon=self.icon, version=4).svg
+        with self.assertNumQueries(1):
+            IconData.objects.get(icon=self.icon, version=5).svg
+        call_command('compacthistory', keyframe=1, stdout=out)
+        self.assertEqual([False] * 7, self.stored())
+        self.assertEqual(before, self.responses())
+
+    @override_settings(ICON_COMMONS_DELTA_HISTORY=True, ICON_COMMONS_DELTA_KEYFRAME=2)
+    def test_new_versions(self):
+        # the same content in another icon
+        other = Icon.objects.create(collection=self.collection, name='shared').new_version(_versioned_svg(1), None)
+        for n in range(1, 5):
+            self.icon.new_version(_versioned_svg(n), 'v%s' % n)
+        self.assertEqual([True, False, True, False], self.stored())
+        # the blobs of the delta encoded versions are gone, unless shared
+        self.assertEqual({other.sha256} | set(IconData.objects.values_list('original', flat=True)) - {None} |
+                         set(IconData.objects.values_list('blob', flat=True)) - {None},
+                         set(SVGBlob.objects.values_list('sha256', flat=True)))
+        self.assertEqual(optimize_svg(_versioned_svg(1)), IconData.objects.get(id=other.id).svg)
+        for n in range(1, 5):
+            self.assertEqual(optimize_svg(_versioned_svg(n)), IconData.objects.get(icon=self.icon, version=n).svg)
+        owner = User.objects.create_user('bob')
+        bulk_import(self.collection, [prepare_svg('park', _versioned_svg(5), ['a'])], owner=owner)
+        self.assertEqual([True, False, True, False, False], self.stored())
+        bulk_import(self.collection, [prepare_svg('park', _versioned_svg(6), ['a'])], owner=owner)
+        self.assertEqual([True, False, True, False, True, False], self.stored())
+        self.assertFalse(SVGBlob.objects.filter(icondata__isnull=True, originals__isnull=True).exists())
+        self.assertEqual(optimize_svg(_versioned_svg(5)), IconData.objects.get(icon=self.icon, version=5).svg)